@@ -0,0 +1,154 @@
+# --- START OF FILE bench/fake_telegram.py ---
+"""
+Поддельный Telegram для проверки режима вебхука без доступа к api.telegram.org.
+
+Изображает Bot API (getMe, setWebhook, sendMessage, ...) на локальном порту, дожидается,
+пока бот зарегистрирует вебхук, и отправляет на него POST-запросами команды от N пользователей
+по M штук. Каждая команда - `/cancel <номер>`: бот отвечает на нее мгновенно и с номером в тексте,
+поэтому по ответам видно, сохраняется ли порядок команд каждого пользователя.
+
+Запуск (в двух терминалах, сначала поддельный Telegram):
+
+    python bench/fake_telegram.py --users 20 --messages 10
+    TELEGRAM_TOKEN=123:fake TELEGRAM_API_URL=http://127.0.0.1:8081/bot \\
+        WEBHOOK_URL=http://127.0.0.1:8443 python bot.py
+"""
+import argparse
+import json
+import re
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}
+
+
+class FakeTelegram:
+    def __init__(self):
+        self.webhook_url: str | None = None
+        self.secret_token: str | None = None
+        self.webhook_set = threading.Event()
+        self.replies: dict[int, list[tuple[float, str]]] = {}  # chat_id -> [(время, текст)]
+        self.api_calls: dict[str, int] = {}
+        self._message_id = 0
+        self._lock = threading.Lock()
+
+    def call(self, method: str, params: dict) -> object:
+        with self._lock:
+            self.api_calls[method] = self.api_calls.get(method, 0) + 1
+            if method == "getMe":
+                return BOT_USER
+            if method == "setWebhook":
+                self.webhook_url = params.get("url")
+                self.secret_token = params.get("secret_token")
+                self.webhook_set.set()
+                return True
+            if method in ("sendMessage", "editMessageText"):
+                chat_id = int(params["chat_id"])
+                self.replies.setdefault(chat_id, []).append((time.monotonic(), params.get("text", "")))
+                self._message_id += 1
+                return {
+                    "message_id": int(params.get("message_id") or self._message_id),
+                    "date": int(time.time()),
+                    "chat": {"id": chat_id, "type": "private"},
+                    "from": BOT_USER,
+                    "text": params.get("text", ""),
+                }
+            return True
+
+
+def make_handler(telegram: FakeTelegram):
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            match = re.match(r"^/bot[^/]+/(\w+)$", self.path)
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            if not match:
+                self.send_error(404)
+                return
+            if self.headers.get("Content-Type", "").startswith("application/json"):
+                params = json.loads(body or b"{}")
+            else:
+                params = {k: v[0] for k, v in parse_qs(body.decode()).items()}
+            payload = json.dumps({"ok": True, "result": telegram.call(match.group(1), params)}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def post_update(telegram: FakeTelegram, update_id: int, user_id: int, text: str) -> None:
+    update = {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"},
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}],
+        },
+    }
+    request = urllib.request.Request(
+        telegram.webhook_url,
+        data=json.dumps(update).encode(),
+        headers={"Content-Type": "application/json", "X-Telegram-Bot-Api-Secret-Token": telegram.secret_token or ""},
+    )
+    urllib.request.urlopen(request, timeout=30).read()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Поддельный Telegram для проверки режима вебхука")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--messages", type=int, default=10)
+    parser.add_argument("--timeout", type=float, default=60, help="сколько ждать ответов бота (сек.)")
+    args = parser.parse_args()
+
+    telegram = FakeTelegram()
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), make_handler(telegram))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Bot API: http://127.0.0.1:{args.port}/bot, жду регистрации вебхука...")
+    telegram.webhook_set.wait()
+    print(f"Вебхук: {telegram.webhook_url}")
+
+    # Команды одного пользователя уходят по очереди, разные пользователи - параллельно, как у настоящего Telegram
+    started = time.monotonic()
+
+    def user_session(user: int) -> None:
+        for n in range(1, args.messages + 1):
+            post_update(telegram, user * args.messages + n, 1000 + user, f"/cancel {n}")
+
+    with ThreadPoolExecutor(max_workers=min(args.users, 64)) as pool:
+        for future in [pool.submit(user_session, user) for user in range(args.users)]:
+            future.result()
+
+    expected = args.users * args.messages
+    deadline = time.monotonic() + args.timeout
+    while sum(len(r) for r in telegram.replies.values()) < expected and time.monotonic() < deadline:
+        time.sleep(0.05)
+    wall = time.monotonic() - started
+    server.shutdown()
+
+    received = sum(len(r) for r in telegram.replies.values())
+    out_of_order = 0
+    for replies in telegram.replies.values():
+        numbers = [int(m.group(1)) for _, text in replies if (m := re.search(r"#(\d+)", text))]
+        out_of_order += sum(1 for a, b in zip(numbers, numbers[1:]) if b < a)
+    print(f"Ответов: {received} из {expected} за {wall:.2f} сек. ({received / wall:.1f} в секунду)")
+    print(f"Нарушений порядка внутри пользователя: {out_of_order}")
+    print("Вызовы Bot API: " + ", ".join(f"{k} {v}" for k, v in sorted(telegram.api_calls.items())))
+
+
+if __name__ == "__main__":
+    main()
+
+# --- END OF FILE bench/fake_telegram.py ---
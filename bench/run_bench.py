@@ -0,0 +1,242 @@
+# --- START OF FILE bench/run_bench.py ---
+"""
+Офлайн-бенчмарк отправки без настоящих WhatsApp и Telegram.
+
+Поднимает локальный HTTP-сервер с имитацией WhatsApp Web (whatsapp_standin.html), направляет
+на нее бота через WHATSAPP_URL и вызывает send_command_internal поддельными апдейтами Telegram
+от N пользователей по M сообщений. В конце печатает отправки в секунду, перцентили задержки,
+перцентили фаз из метрик бота и память Chromium на аккаунт.
+
+Настройки бота (BROWSER_POOL_SIZE, RESET_MODE, MAX_LIVE_CONTEXTS, ...) берутся из окружения как обычно,
+поэтому варианты сравниваются так:
+
+    RESET_MODE=soft   python bench/run_bench.py --users 10 --messages 20
+    RESET_MODE=reload python bench/run_bench.py --users 10 --messages 20
+"""
+import argparse
+import asyncio
+import functools
+import http.server
+import itertools
+import os
+import sys
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+# Терминальные статусы отправки в сообщении бота
+FINAL_PREFIXES = ("✅", "⚠️", "❌")
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Бенчмарк отправки на локальной имитации WhatsApp Web")
+    parser.add_argument("--users", type=int, default=5, help="количество имитируемых аккаунтов")
+    parser.add_argument("--messages", type=int, default=10, help="сообщений на аккаунт")
+    parser.add_argument("--file-every", type=int, default=0, help="каждое N-е сообщение отправлять файлом (0 - только текст)")
+    parser.add_argument("--file-size", type=int, default=256 * 1024, help="размер файла в байтах")
+    parser.add_argument("--interval", type=float, default=0.0, help="пауза между командами одного аккаунта (сек.)")
+    parser.add_argument("--chats", type=int, default=200, help="чатов в списке имитации")
+    parser.add_argument("--load-ms", type=int, default=500, help="время загрузки интерфейса имитации")
+    parser.add_argument("--sent-ms", type=int, default=300, help="задержка одной галочки")
+    parser.add_argument("--delivered-ms", type=int, default=800, help="задержка двух галочек")
+    parser.add_argument("--lang", choices=("en", "ru"), default="en", help="язык подписей имитации")
+    parser.add_argument("--output", help="дописать отчет в файл (например, bench_output.txt)")
+    return parser.parse_args()
+
+
+def serve_standin() -> http.server.ThreadingHTTPServer:
+    """Раздает каталог bench на случайном локальном порту в фоновом потоке."""
+    handler = functools.partial(QuietHandler, directory=BENCH_DIR)
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+# --- Поддельные объекты Telegram ---
+
+class FakeStatusMessage:
+    """Сообщение бота со статусом отправки: запоминает правки и момент финального статуса."""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, chat_id: int, text: str, stats: dict):
+        self.chat_id = chat_id
+        self.message_id = next(self._ids)
+        self.text = text
+        self._stats = stats
+        self.done = asyncio.Event()
+        self._check()
+
+    async def edit_text(self, text: str, **kwargs) -> "FakeStatusMessage":
+        self._stats["api_calls"] += 1
+        self.text = text
+        self._check()
+        return self
+
+    def _check(self) -> None:
+        if self.text.startswith(FINAL_PREFIXES):
+            self.done.set()
+
+
+class FakeFile:
+    def __init__(self, size: int):
+        self.file_size = size
+
+    async def download_as_bytearray(self) -> bytearray:
+        return bytearray(os.urandom(self.file_size))
+
+    async def download_to_drive(self, custom_path: str) -> None:
+        with open(custom_path, "wb") as f:
+            f.write(os.urandom(self.file_size))
+
+
+class FakeBot:
+    def __init__(self, file_size: int, stats: dict):
+        self._file_size = file_size
+        self._stats = stats
+
+    async def get_file(self, file_id: str) -> FakeFile:
+        self._stats["api_calls"] += 1
+        return FakeFile(self._file_size)
+
+
+class FakeMessage:
+    def __init__(self, chat_id: int, text: str | None, document, stats: dict):
+        self.chat_id = chat_id
+        self.text = None if document else text
+        self.caption = text if document else None
+        self.effective_attachment = document
+        self._stats = stats
+        self.replies: list[FakeStatusMessage] = []
+
+    async def reply_text(self, text: str, **kwargs) -> FakeStatusMessage:
+        self._stats["api_calls"] += 1
+        reply = FakeStatusMessage(self.chat_id, text, self._stats)
+        self.replies.append(reply)
+        return reply
+
+
+def percentile(values: list[float], q: float) -> float:
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def run(args: argparse.Namespace) -> str:
+    from telegram import Document
+    import bot
+
+    stats = {"api_calls": 0}
+    fake_bot = FakeBot(args.file_size, stats)
+    user_data = {}
+    latencies: list[float] = []
+    rejected = 0
+    peak_rss = 0.0
+
+    async def one_send(user_id: int, n: int) -> None:
+        nonlocal rejected
+        chat = f"Chat {(user_id + n) % args.chats + 1}"
+        if args.file_every and n % args.file_every == 0:
+            document = Document(file_id=f"f{user_id}_{n}", file_unique_id=f"u{user_id}_{n}",
+                                file_name=f"report_{n}.bin", file_size=args.file_size)
+            message = FakeMessage(user_id, f'/send "{chat}"', document, stats)
+        else:
+            message = FakeMessage(user_id, f'/send "{chat}" "Бенчмарк {user_id}-{n}"', None, stats)
+        update = SimpleNamespace(effective_message=message, message=message, effective_user=SimpleNamespace(id=user_id))
+        context = SimpleNamespace(bot=fake_bot, user_data=user_data.setdefault(user_id, {}))
+
+        started = time.monotonic()
+        await bot.send_command_internal(update, context)
+        if not message.replies or message.replies[-1].done.is_set():
+            # Команда отклонена сразу, в очередь ничего не попало
+            rejected += 1
+            return
+        await message.replies[-1].done.wait()
+        latencies.append(time.monotonic() - started)
+
+    async def user_load(user_id: int) -> None:
+        sends = []
+        for n in range(args.messages):
+            sends.append(asyncio.create_task(one_send(user_id, n)))
+            if args.interval:
+                await asyncio.sleep(args.interval)
+        await asyncio.gather(*sends)
+
+    async def sample_memory() -> None:
+        nonlocal peak_rss
+        while True:
+            peak_rss = max(peak_rss, bot.browser_manager.rss_mb())
+            await asyncio.sleep(1)
+
+    sampler = asyncio.create_task(sample_memory())
+    started = time.monotonic()
+    try:
+        await asyncio.gather(*(user_load(user_id) for user_id in range(1, args.users + 1)))
+    finally:
+        wall = time.monotonic() - started
+        sampler.cancel()
+        final_rss = bot.browser_manager.rss_mb()
+        live_browsers = bot.browser_manager.live_browsers
+        await bot.browser_manager.stop()
+
+    total = len(latencies)
+    title = f"Бенчмарк: {args.users} аккаунтов x {args.messages} сообщений"
+    if args.file_every:
+        title += f" (файл каждое {args.file_every}-е)"
+    lines = [
+        title,
+        f"RESET_MODE={bot.RESET_MODE}, BROWSER_POOL_SIZE={bot.BROWSER_POOL_SIZE}, "
+        f"MAX_LIVE_CONTEXTS={bot.MAX_LIVE_CONTEXTS}, NETWORK_FILTER={int(bot.NETWORK_FILTER)}",
+        f"Время: {wall:.1f} сек., отправок: {total}, {total / wall if wall else 0:.2f} отправок/сек.",
+        f"Задержка от команды до итогового статуса, сек.: p50 {percentile(latencies, 0.5):.2f}, "
+        f"p95 {percentile(latencies, 0.95):.2f}, p99 {percentile(latencies, 0.99):.2f}, "
+        f"max {max(latencies, default=0):.2f}",
+        "Результаты: " + ", ".join(f"{dict(k)['outcome']} {int(v)}" for k, v in sorted(bot.SEND_OUTCOMES.values.items()))
+        + (f", отклонено командой {rejected}" if rejected else ""),
+        f"Вызовов Bot API: {stats['api_calls']} ({stats['api_calls'] / max(total, 1):.1f} на отправку)",
+        f"Chromium: процессов {live_browsers}, память пик {peak_rss:.0f} МБ, в конце {final_rss:.0f} МБ, "
+        f"на аккаунт {peak_rss / max(args.users, 1):.0f} МБ",
+        "Фазы (сек., p50 / p95 / p99 · количество):",
+    ]
+    for key in sorted(bot.PHASE_SECONDS.series):
+        labels = dict(key)
+        count = bot.PHASE_SECONDS.series[key][2]
+        p50, p95, p99 = (bot.PHASE_SECONDS.quantile(q, **labels) for q in (0.5, 0.95, 0.99))
+        lines.append(f"  {labels['phase']}: {p50:.2f} / {p95:.2f} / {p99:.2f} · {count}")
+    return "\n".join(lines)
+
+
+def main() -> None:
+    args = parse_args()
+    server = serve_standin()
+    query = (f"chats={args.chats}&load={args.load_ms}&sent={args.sent_ms}"
+             f"&delivered={args.delivered_ms}&lang={args.lang}")
+    os.environ["WHATSAPP_URL"] = f"http://127.0.0.1:{server.server_port}/whatsapp_standin.html?{query}"
+    # Отдельный каталог состояний, чтобы не трогать настоящие сессии и индексы чатов
+    state_dir = tempfile.TemporaryDirectory(prefix="bench_states_")
+    os.environ["PLAYWRIGHT_STATE_DIR"] = state_dir.name
+    try:
+        report = asyncio.run(run(args))
+    finally:
+        server.shutdown()
+        state_dir.cleanup()
+    print(report)
+    if args.output:
+        with open(args.output, "a", encoding="utf-8") as f:
+            f.write(report + "\n\n")
+
+
+if __name__ == "__main__":
+    main()
+
+# --- END OF FILE bench/run_bench.py ---
@@ -1,6 +1,5 @@
 # --- START OF FILE bot.py ---
 import re
-import glob
 import asyncio
 import os
 import shlex
@@ -9,8 +8,17 @@ import logging
 import io
 import datetime
 import time
+import contextlib
+import mimetypes
+import shutil
+import tempfile
+import signal
+import zlib
+from dataclasses import dataclass
+from urllib.parse import urljoin
+from zoneinfo import ZoneInfo
 from dotenv import load_dotenv
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Document
+from telegram import Bot, Message, Update, InlineKeyboardButton, InlineKeyboardMarkup, Document
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -18,30 +26,225 @@ from telegram.ext import (
     filters,
     ContextTypes,
     CallbackQueryHandler,
+    TypeHandler,
+)
+from playwright.async_api import Page, TimeoutError
+
+from browser_manager import BrowserManager, COLD, WARMING, READY, EXPIRED, INSTANCE_ENV
+from profile_store import ProfileStore
+from chat_index import ChatIndex
+from delivery_tracker import DeliveryTracker, DeliveryWaiter
+from network_policy import NetworkPolicy, DEFAULT_MEDIA_HOSTS, DEFAULT_STUB_HOSTS
+from metrics import Registry, start_metrics_server
+from proc_utils import kill_orphans
+from send_queue import SendQueue
+from pacing import Pacer
+from outbox import Outbox, OutboxEntry, QUEUED, SENDING, SENT, DELIVERED, FAILED
+from session_watchdog import SessionWatchdog, NEEDS_QR
+from status_reporter import StatusReporter
+from update_processor import PerUserUpdateProcessor
+from wa_selectors import ANY_LANGUAGE, UiSelectors, detect_ui_language, selectors_for
+from supervisor import Supervisor, read_worker_updates, worker_for
+from scheduler import Scheduler, ScheduledJob, parse_when
+from sqlite_persistence import SqlitePersistence
+from broadcast import (
+    Broadcast, BroadcastStore, BroadcastValidationError, iter_recipients, RUNNING, PAUSED, DONE, CANCELLED,
+    ROW_SENDING, ROW_SENT, ROW_UNCONFIRMED, ROW_FAILED,
 )
-from playwright.async_api import async_playwright, Page, TimeoutError
 
 # --- CONFIGURATION ---
 load_dotenv()
 
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")  # Другой адрес Bot API, например поддельный Telegram для тестов
 ADMIN_ID = int(os.getenv("ADMIN_ID", 0))
 
 SUPPORT_REQUEST_INTERVAL = 5  # Запрашивать поддержку каждые команд
 SUPPORT_URL = "https://rest-check.onrender.com/"
 
-PLAYWRIGHT_STATE_DIR = "playwright_states"
+PLAYWRIGHT_STATE_DIR = os.getenv("PLAYWRIGHT_STATE_DIR", "playwright_states")
 os.makedirs(PLAYWRIGHT_STATE_DIR, exist_ok=True)
 
 def get_user_state_path(user_id: int) -> str:
     return os.path.join(PLAYWRIGHT_STATE_DIR, f"{user_id}.json")
 
+def get_chat_index_path(user_id: int) -> str:
+    return os.path.join(PLAYWRIGHT_STATE_DIR, f"{user_id}.chats.json")
+
+# Адрес WhatsApp Web (переопределяется бенчмарком, чтобы открыть локальную имитацию)
+WHATSAPP_URL = os.getenv("WHATSAPP_URL", "https://web.whatsapp.com/")
+
+# Таймауты поиска чата (сек.): для чата из индекса и для неизвестного названия
+CHAT_SEARCH_TIMEOUT_KNOWN = int(os.getenv("CHAT_SEARCH_TIMEOUT_KNOWN", 15))
+CHAT_SEARCH_TIMEOUT_UNKNOWN = int(os.getenv("CHAT_SEARCH_TIMEOUT_UNKNOWN", 8))
+# Сколько ждать открытия чата по прямой ссылке с номером телефона (сек.)
+CHAT_LINK_TIMEOUT = int(os.getenv("CHAT_LINK_TIMEOUT", 30))
+
+# Файлы до этого размера (байт) передаются из Telegram в WhatsApp через память, без временных файлов
+RELAY_MEMORY_LIMIT = int(os.getenv("RELAY_MEMORY_LIMIT", 20 * 1024 * 1024))
+TEMP_FILES_DIR = "temp_files"
+
+# Получение апдейтов: если задан WEBHOOK_URL (публичный адрес бота), используется вебхук вместо long polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8443))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+# Сколько апдейтов разных пользователей обрабатывать одновременно (апдейты одного пользователя - всегда по очереди)
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", 32))
+
+# Несколько процессов: супервизор принимает апдейты и раздает пользователей WORKER_PROCESSES воркерам (0 - один процесс)
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", 0))
+# Задаются супервизором для процессов-воркеров
+WORKER_INDEX = int(os.getenv("WORKER_INDEX", -1))
+WORKER_COUNT = int(os.getenv("WORKER_COUNT", 1))
+
+def owns_user(user_id: int) -> bool:
+    """Обслуживает ли этот процесс пользователя (в однопроцессном режиме - всех)."""
+    return WORKER_INDEX < 0 or worker_for(user_id, WORKER_COUNT) == WORKER_INDEX
+
+# Метка процессов браузера этого экземпляра бота: каталог сессий определяет установку, номер - воркера
+DEPLOYMENT_TAG = f"{zlib.crc32(os.path.abspath(PLAYWRIGHT_STATE_DIR).encode()):08x}"
+INSTANCE_TAG = f"{DEPLOYMENT_TAG}:{WORKER_INDEX if WORKER_INDEX >= 0 else 'main'}"
+
+# Метрики в формате Prometheus на http://METRICS_HOST:METRICS_PORT/metrics (0 - выключено)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))
+if METRICS_PORT and WORKER_INDEX >= 0:
+    METRICS_PORT += WORKER_INDEX  # У каждого воркера свой порт: METRICS_PORT, METRICS_PORT + 1, ...
+
+# Восстановление сохраненных сессий при старте
+RESTORE_CONCURRENCY = int(os.getenv("RESTORE_CONCURRENCY", 3))  # Сколько сессий прогревать одновременно
+RESTORE_MAX_SESSIONS = int(os.getenv("RESTORE_MAX_SESSIONS", 50))  # 0 - восстанавливать все
+
+DELIVERY_TIMEOUT = int(os.getenv("DELIVERY_TIMEOUT", 60))  # Сколько ждать подтверждения доставки (сек.)
+
+# Сколько процессов Chromium держать на весь бот (контексты пользователей распределяются между ними)
+BROWSER_POOL_SIZE = int(os.getenv("BROWSER_POOL_SIZE", 1))
+# Лимиты живых сессий: при превышении давно не использовавшиеся сессии усыпляются (0 - без лимита)
+MAX_LIVE_CONTEXTS = int(os.getenv("MAX_LIVE_CONTEXTS", 0))
+MAX_CHROMIUM_RSS_MB = int(os.getenv("MAX_CHROMIUM_RSS_MB", 0))
+SESSION_IDLE_SECONDS = int(os.getenv("SESSION_IDLE_SECONDS", 1800))  # Усыплять сессию после простоя
+# Сколько сессий может загружаться одновременно и минимальный интервал между созданием контекстов (сек.)
+CONTEXT_LAUNCH_CONCURRENCY = int(os.getenv("CONTEXT_LAUNCH_CONCURRENCY", 4))
+CONTEXT_LAUNCH_INTERVAL = float(os.getenv("CONTEXT_LAUNCH_INTERVAL", 0.5))
+
+# Хранение сессий: state - JSON storage_state и общий Chromium, profile - постоянный профиль Chromium на аккаунт
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "state")
+PROFILE_DIR = os.getenv("PROFILE_DIR", "browser_profiles")
+PROFILE_QUOTA_MB = int(os.getenv("PROFILE_QUOTA_MB", 500))  # При превышении после закрытия сессии удаляются кэши (0 - без квоты)
+PROFILE_MAX_AGE_DAYS = int(os.getenv("PROFILE_MAX_AGE_DAYS", 30))  # Удалять профили, не открывавшиеся столько дней (0 - никогда)
+
+# Фоновая проверка живых сессий: интервал (сек., 0 - выключена), сколько ждать ответа страницы (сек.)
+# и предельный размер кучи JavaScript страницы WhatsApp в МБ (0 - без лимита)
+WATCHDOG_INTERVAL = float(os.getenv("WATCHDOG_INTERVAL", 120))
+WATCHDOG_PAGE_TIMEOUT = float(os.getenv("WATCHDOG_PAGE_TIMEOUT", 10))
+# Сколько неудачных проверок подряд (нет ответа страницы, неясное состояние входа) нужно для пересоздания сессии
+WATCHDOG_MAX_FAILURES = int(os.getenv("WATCHDOG_MAX_FAILURES", 3))
+MAX_PAGE_HEAP_MB = int(os.getenv("MAX_PAGE_HEAP_MB", 0))
+
+# Остановка: сколько ждать завершения начатых отправок (сек.)
+SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", 60))
+# При старте завершать процессы Chromium и драйвера Playwright, оставшиеся от аварийно завершенного запуска
+REAP_ORPHANS = os.getenv("REAP_ORPHANS", "1") == "1"
+
+BROWSER_LAUNCH_ARGS = ['--no-sandbox', '--disable-setuid-sandbox', '--disable-blink-features=AutomationControlled']
+BROWSER_USER_AGENT = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
+
+def env_list(name: str, default: str = "") -> tuple[str, ...]:
+    return tuple(item.strip() for item in os.getenv(name, default).split(",") if item.strip())
+
+# Фильтрация сетевых запросов WhatsApp Web: картинки, медиа, шрифты и телеметрия не загружаются.
+# Выключена по умолчанию: перехват запросов отключает HTTP-кэш Chromium и не видит запросы Service Worker
+NETWORK_FILTER = os.getenv("NETWORK_FILTER", "0") == "1"
+NETWORK_BLOCK_TYPES = env_list("NETWORK_BLOCK_TYPES", "image,media,font")
+NETWORK_STUB_HOSTS = env_list("NETWORK_STUB_HOSTS")  # Дополнительные хосты телеметрии
+NETWORK_MEDIA_HOSTS = env_list("NETWORK_MEDIA_HOSTS")  # Дополнительные хосты медиа (блокируются GET)
+NETWORK_ALLOW_HOSTS = env_list("NETWORK_ALLOW_HOSTS")  # Хосты, которые никогда не фильтруются
+
+# Обновление статусных сообщений: промежуточный статус показывается не чаще раза в STATUS_PROGRESS_DELAY сек.,
+# не чаще раза в STATUS_CHAT_INTERVAL сек. на чат и не более STATUS_GLOBAL_RATE изменений в секунду на бота
+STATUS_PROGRESS_DELAY = float(os.getenv("STATUS_PROGRESS_DELAY", 3.0))
+STATUS_CHAT_INTERVAL = float(os.getenv("STATUS_CHAT_INTERVAL", 1.0))
+STATUS_GLOBAL_RATE = float(os.getenv("STATUS_GLOBAL_RATE", 25))
+
+# Сброс интерфейса после отправки: soft - закрыть чат и диалоги без перезагрузки, reload - всегда перезагружать WhatsApp Web
+RESET_MODE = os.getenv("RESET_MODE", "soft")
+
+# Встроенный планировщик (/schedule)
+SCHEDULER_DB_PATH = os.getenv("SCHEDULER_DB_PATH", "scheduler.sqlite3")
+SCHEDULE_GRACE_SECONDS = int(os.getenv("SCHEDULE_GRACE_SECONDS", 3600))  # Сколько можно опоздать после простоя бота
+SCHEDULE_SPREAD_SECONDS = float(os.getenv("SCHEDULE_SPREAD_SECONDS", 1.0))  # Минимальный интервал между запусками заданий
+SCHEDULE_TZ = ZoneInfo(os.getenv("SCHEDULE_TIMEZONE")) if os.getenv("SCHEDULE_TIMEZONE") else None
+
+# Хранение user_data (счетчики команд и т.п.) между перезапусками; пустой путь - не сохранять
+PERSISTENCE_DB_PATH = os.getenv("PERSISTENCE_DB_PATH", "bot_data.sqlite3")
+PERSISTENCE_INTERVAL = float(os.getenv("PERSISTENCE_INTERVAL", 5))  # Как часто записывать изменения (сек.)
+
+# Рассылки /broadcast по CSV
+BROADCAST_DB_PATH = os.getenv("BROADCAST_DB_PATH", "broadcast.sqlite3")
+BROADCAST_MAX_ROWS = int(os.getenv("BROADCAST_MAX_ROWS", 1000))  # Максимум получателей в одном файле
+BROADCAST_MAX_FILE_MB = int(os.getenv("BROADCAST_MAX_FILE_MB", 5))
+BROADCAST_SENT_TIMEOUT = int(os.getenv("BROADCAST_SENT_TIMEOUT", 20))  # Сколько ждать отметки "отправлено" (сек.)
+
+# Журнал отправок /send: защита от повторной отправки и повторы после временных ошибок; пустой путь - выключен
+OUTBOX_DB_PATH = os.getenv("OUTBOX_DB_PATH", "outbox.sqlite3")
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", 3))
+OUTBOX_RETRY_DELAY = float(os.getenv("OUTBOX_RETRY_DELAY", 15))  # Пауза перед первым повтором (сек.), дальше удваивается
+
+# Темп отправки для каждого аккаунта: до PACING_BURST сообщений подряд, дальше не чаще PACING_PER_MINUTE в минуту
+PACING_BURST = int(os.getenv("PACING_BURST", 3))
+PACING_PER_MINUTE = float(os.getenv("PACING_PER_MINUTE", 6))  # 0 - без ограничения
+PACING_JITTER = float(os.getenv("PACING_JITTER", 0.3))  # Случайная добавка к паузе (доля)
+PACING_MAX_SLOWDOWN = float(os.getenv("PACING_MAX_SLOWDOWN", 8))  # Во сколько раз можно замедлиться при признаках ограничений
+PACING_SLOW_SENT_SECONDS = float(os.getenv("PACING_SLOW_SENT_SECONDS", 10))  # Отметка "отправлено" позже - признак ограничений
+
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     level=logging.WARNING #замените на DEBUG, чтобы увидеть все сообщения
 )
 logger = logging.getLogger(__name__)
 
+chat_indexes: dict[int, ChatIndex] = {}
+warmup_tasks: dict[int, asyncio.Task] = {}
+rewarm_tasks: set[asyncio.Task] = set()  # ссылки на фоновые прогревы после пересоздания сессии
+
+delivery_tracker = DeliveryTracker()
+network_policy = NetworkPolicy(
+    enabled=NETWORK_FILTER,
+    block_types=NETWORK_BLOCK_TYPES,
+    stub_hosts=DEFAULT_STUB_HOSTS + NETWORK_STUB_HOSTS,
+    media_hosts=DEFAULT_MEDIA_HOSTS + NETWORK_MEDIA_HOSTS,
+    allow_hosts=NETWORK_ALLOW_HOSTS,
+)
+
+status_reporter = StatusReporter(
+    progress_delay=STATUS_PROGRESS_DELAY,
+    chat_interval=STATUS_CHAT_INTERVAL,
+    global_rate=STATUS_GLOBAL_RATE,
+)
+
+pacer = Pacer(PACING_BURST, PACING_PER_MINUTE, PACING_JITTER, PACING_MAX_SLOWDOWN)
+profile_store = (ProfileStore(PROFILE_DIR, PROFILE_QUOTA_MB, PROFILE_MAX_AGE_DAYS, owns=owns_user)
+                 if SESSION_BACKEND == "profile" else None)
+
+browser_manager = BrowserManager(
+    state_path_fn=get_user_state_path,
+    # HTTP-кэш постоянного профиля ограничен частью квоты, чтобы профиль не разрастался за долгую сессию
+    launch_args=BROWSER_LAUNCH_ARGS + ([f"--disk-cache-size={PROFILE_QUOTA_MB * 1024 * 1024 // 4}"]
+                                       if profile_store and PROFILE_QUOTA_MB else []),
+    user_agent=BROWSER_USER_AGENT,
+    pool_size=BROWSER_POOL_SIZE,
+    context_hooks=[delivery_tracker.install, network_policy.install],
+    max_live_contexts=MAX_LIVE_CONTEXTS,
+    max_rss_mb=MAX_CHROMIUM_RSS_MB,
+    idle_seconds=SESSION_IDLE_SECONDS,
+    launch_concurrency=CONTEXT_LAUNCH_CONCURRENCY,
+    launch_interval=CONTEXT_LAUNCH_INTERVAL,
+    instance_tag=INSTANCE_TAG,
+    profile_store=profile_store,
+)
+
 
 # --- НОВЫЙ БЛОК: ЛОГИКА ЗАПРОСА ПОДДЕРЖКИ ---
 
@@ -122,93 +325,185 @@ async def take_screenshot(page: Page, name: str):
     pass
 
 
-async def get_whatsapp_page(context: ContextTypes.DEFAULT_TYPE, user_id: int, force_new: bool = False) -> Page | None:
-    user_data = context.user_data
-
-    # Флаг для определения, нужна ли полная переинициализация Playwright
-    needs_full_reinitialization = force_new or \
-                                  'browser' not in user_data or \
-                                  not user_data['browser'].is_connected() or \
-                                  'playwright_context' not in user_data or \
-                                  user_data['playwright_context'] is None
+async def get_whatsapp_page(user_id: int, force_new: bool = False) -> Page | None:
+    """
+    Возвращает страницу WhatsApp пользователя из общего менеджера браузеров.
+    Каждому пользователю выделяется собственный BrowserContext внутри общего Chromium.
+    """
+    try:
+        with PHASE_SECONDS.time(phase="browser_page"):
+            return await browser_manager.get_page(user_id, force_new=force_new)
+    except Exception as e:
+        logger.error(f"Не удалось запустить Playwright для пользователя {user_id}: {e}")
+        return None
+
+# Состояния страницы WhatsApp Web, которые распознает probe_login_state
+LOGIN_LOGGED_IN = "logged_in"
+LOGIN_QR = "qr"
+LOGIN_USE_HERE = "use_here"
+LOGIN_PHONE_DISCONNECTED = "phone_disconnected"
+LOGIN_LOADING_ERROR = "loading_error"
+LOGIN_UNKNOWN = "unknown"
+
+QR_SELECTOR = 'canvas[aria-label="Scan this QR code to link a device!"], canvas[aria-label*="QR"]'
+
+def login_state_locators(page: Page) -> dict:
+    # Язык интерфейса до входа неизвестен (или мог смениться на телефоне), поэтому здесь подписи всех языков
+    ui = ANY_LANGUAGE
+    return {
+        LOGIN_LOGGED_IN: page.locator(ui.search_box),
+        LOGIN_QR: page.locator(QR_SELECTOR),
+        LOGIN_USE_HERE: page.get_by_role("button", name=ui.use_here_button),
+        LOGIN_PHONE_DISCONNECTED: page.get_by_text(ui.phone_disconnected),
+        LOGIN_LOADING_ERROR: page.get_by_text(ui.loading_error),
+    }
+
+async def first_visible(locators: dict, timeout: float) -> str | None:
+    """Одновременно ждет несколько элементов и возвращает ключ первого появившегося или None по таймауту."""
+    tasks = {
+        asyncio.create_task(locator.first.wait_for(state="visible", timeout=timeout * 1000)): state
+        for state, locator in locators.items()
+    }
+    try:
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if not task.exception():
+                    return tasks[task]
+        return None
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
 
-    if needs_full_reinitialization:
-        if 'browser' in user_data and user_data['browser'].is_connected():
-            logger.info("Закрытие существующего экземпляра браузера для пользователя %s перед полной переинициализацией.", user_id)
-            await user_data['browser'].close()
-        
-        logger.info("Полная инициализация нового экземпляра Playwright для пользователя %s...", user_id)
-        # Очищаем все связанные с Playwright данные пользователя
-        for key in ['browser', 'playwright_context', 'whatsapp_page']:
-            user_data.pop(key, None)
+async def probe_login_state(page: Page, timeout: float = 60) -> str:
+    """
+    Одновременно ждет все известные состояния WhatsApp Web (список чатов, QR-код, "Использовать здесь",
+    "Телефон не подключен", ошибка загрузки) и возвращает первое появившееся.
+    Если ничего не появилось за timeout секунд, возвращает LOGIN_UNKNOWN.
+    """
+    return await first_visible(login_state_locators(page), timeout) or LOGIN_UNKNOWN
+
+async def settle_login_state(page: Page, timeout: float = 60) -> str:
+    """Состояние входа по probe_login_state; диалог "Использовать здесь" подтверждается автоматически."""
+    state = await probe_login_state(page, timeout)
+    if state == LOGIN_USE_HERE:
+        logger.info("WhatsApp открыт в другом окне, нажимаю 'Использовать здесь'.")
+        await login_state_locators(page)[LOGIN_USE_HERE].first.click()
+        state = await probe_login_state(page, timeout)
+
+    if state == LOGIN_LOGGED_IN:
+        await take_screenshot(page, "login_success")
+        logger.info("Сессия WhatsApp активна.")
+    else:
+        logger.info(f"Сессия WhatsApp неактивна: {state}.")
+        await take_screenshot(page, "login_timeout")
+    return state
 
-        try:
-            p = await async_playwright().start()
-            browser = await p.chromium.launch(headless=True, args=['--no-sandbox', '--disable-setuid-sandbox', '--disable-blink-features=AutomationControlled'])
-            user_data['browser'] = browser
-            user_state_path = get_user_state_path(user_id)
-            storage_state = user_state_path if os.path.exists(user_state_path) else None
-
-            pw_context = await browser.new_context(
-                storage_state=storage_state,
-                #locale="ru-RU",
-                user_agent="Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
-            )
-            user_data['playwright_context'] = pw_context
+async def check_login_status(page: Page, timeout: float = 60) -> bool:
+    """Проверяет, что вход выполнен. Диалог "Использовать здесь" подтверждается автоматически."""
+    return await settle_login_state(page, timeout) == LOGIN_LOGGED_IN
 
-            page = await pw_context.new_page()
-            user_data['whatsapp_page'] = page
-            return page
-        except Exception as e:
-            logger.error(f"Не удалось запустить Playwright для пользователя {user_id}: {e}")
-            return None
-    else:
-        # Если браузер и контекст существуют и действительны, пытаемся использовать существующую страницу или создать новую
-        pw_context = user_data['playwright_context']
-        page = user_data.get('whatsapp_page')
+def css_string(value: str) -> str:
+    """Экранирует строку для использования в CSS-селекторе атрибута."""
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
 
-        if page and not page.is_closed():
-            logger.info("Используется существующая страница WhatsApp для пользователя %s.", user_id)
-            return page
-        
-        logger.info("Страница закрыта для пользователя %s, создаем новую.", user_id)
-        try:
-            page = await pw_context.new_page()
-            user_data['whatsapp_page'] = page
-            return page
-        except Exception as e:
-            logger.error(f"Не удалось создать новую страницу Playwright для пользователя {user_id} в существующем контексте: {e}")
-            # Если создание новой страницы не удалось, это может указывать на проблему с контекстом, поэтому принудительно переинициализируем
-            logger.info("Попытка полной переинициализации Playwright для пользователя %s из-за ошибки создания страницы.", user_id)
-            return await get_whatsapp_page(context, user_id, force_new=True) # Рекурсивный вызов с force_new=True
+def ui_selectors(user_id: int) -> UiSelectors:
+    """Селекторы на языке интерфейса пользователя; пока язык не определен - на всех известных языках."""
+    return selectors_for(browser_manager.ui_language(user_id))
 
-async def check_login_status(page: Page) -> bool:
+async def remember_ui_language(user_id: int, page: Page) -> None:
+    """Один раз определяет язык интерфейса WhatsApp по загруженной странице и запоминает его для сессии."""
+    if browser_manager.ui_language(user_id):
+        return
     try:
-        search_box_selector = 'div[aria-placeholder="Поиск или новый чат"], div[aria-placeholder="Search or start a new chat"]'
-        await page.wait_for_selector(search_box_selector, timeout=60000)
-        await take_screenshot(page, "login_success")      
-        logger.info("Сессия WhatsApp активна.")
-        return True
-    except TimeoutError:
-        logger.info("Сессия WhatsApp неактивна или не успела загрузиться.")
-        await take_screenshot(page,"login_timeout")
+        lang = await detect_ui_language(page)
+    except Exception as e:
+        logger.warning(f"Не удалось определить язык интерфейса WhatsApp пользователя {user_id}: {e}")
+        return
+    browser_manager.set_ui_language(user_id, lang)
+    logger.info(f"Язык интерфейса WhatsApp пользователя {user_id}: {lang or 'неизвестен'}.")
+
+def get_chat_index(user_id: int) -> ChatIndex:
+    index = chat_indexes.get(user_id)
+    if index is None:
+        index = chat_indexes[user_id] = ChatIndex(get_chat_index_path(user_id))
+    return index
+
+def unknown_chat_suggestions(user_id: int, chat_name: str, index: ChatIndex | None = None) -> list[str]:
+    """Похожие названия, если чата нет в индексе; пустой список - название можно отправлять в WhatsApp."""
+    index = index or get_chat_index(user_id)
+    if normalize_phone(chat_name) or not len(index) or index.lookup(chat_name):
+        return []
+    # Похожих нет - возможно, это контакт без переписки, проверим поиском WhatsApp
+    return index.suggest(chat_name)
+
+async def reject_unknown_chat(message: Message, user_id: int, chat_name: str) -> bool:
+    """
+    Мгновенно отклоняет название, которого нет в индексе чатов, если в индексе есть похожие.
+    Возвращает True, если команда отклонена.
+    """
+    suggestions = unknown_chat_suggestions(user_id, chat_name)
+    if not suggestions:
         return False
-
-async def find_and_click_chat(page: Page, chat_name: str) -> bool:
-    search_box_selector = 'div[aria-placeholder="Поиск или новый чат"], div[aria-placeholder="Search or start a new chat"]'
+    await message.reply_text(
+        f"❌ Чат '{chat_name}' не найден.\nВозможно, вы имели в виду:\n"
+        + "\n".join(f"• {name}" for name in suggestions)
+    )
+    return True
+
+def normalize_phone(value: str) -> str | None:
+    """Номер телефона в международном формате ("+7 999 123-45-67") -> только цифры; не номер -> None."""
+    if not value.startswith("+"):
+        return None
+    digits = re.sub(r"[\s()\-]", "", value[1:])
+    return digits if re.fullmatch(r"\d{7,15}", digits) else None
+
+# Результаты open_chat_by_phone
+LINK_OPENED = "opened"
+LINK_INVALID = "invalid"
+LINK_LOGGED_OUT = "logged_out"
+LINK_TIMEOUT = "timeout"
+
+async def open_chat_by_phone(page: Page, phone: str, ui: UiSelectors = ANY_LANGUAGE) -> str:
+    """
+    Открывает личный чат прямой ссылкой send?phone=, без поиска в списке чатов.
+    Готовность определяется по первому из состояний: открытый чат, сообщение о неверном номере или QR-код.
+    """
+    await page.goto(f"{urljoin(WHATSAPP_URL, 'send')}?phone={phone}", wait_until="domcontentloaded",
+                    timeout=CHAT_LINK_TIMEOUT * 1000)
+    state = await first_visible({
+        LINK_OPENED: page.locator('#main footer'),
+        LINK_INVALID: page.get_by_text(ui.invalid_phone),
+        LINK_LOGGED_OUT: page.locator(QR_SELECTOR),
+    }, CHAT_LINK_TIMEOUT)
+    logger.info(f"Открытие чата по номеру {phone}: {state or LINK_TIMEOUT}.")
+    return state or LINK_TIMEOUT
+
+async def find_and_click_chat(page: Page, chat_name: str, index: ChatIndex | None = None,
+                              ui: UiSelectors = ANY_LANGUAGE) -> bool:
+    search_box_selector = ui.search_box
+    known_name = index.lookup(chat_name) if index else None
+    chat_title_selector = f'span[title={css_string(known_name or chat_name)}]'
+    chat_container = page.locator(f'div[role="listitem"]:has({chat_title_selector})').first
     try:
-        logger.info(f"Поиск чата: '{chat_name}'")
-        await page.locator(search_box_selector).fill(chat_name)
-        await asyncio.sleep(1)
-        
-        chat_title_selector = f'span[title="{chat_name}"]'
-        await page.wait_for_selector(chat_title_selector, timeout=60000)
-        
-        chat_container = page.locator(f'div[role="listitem"]:has({chat_title_selector})')
+        if known_name and await chat_container.count():
+            # Самый быстрый путь: чат уже виден в списке, поиск не нужен
+            logger.info(f"Чат '{known_name}' найден в списке без поиска.")
+        else:
+            logger.info(f"Поиск чата: '{chat_name}'")
+            await page.locator(search_box_selector).fill(known_name or chat_name)
+            # Известный по индексу чат точно есть, неизвестный ищем недолго вместо прежних 60 секунд
+            timeout = CHAT_SEARCH_TIMEOUT_KNOWN if known_name else CHAT_SEARCH_TIMEOUT_UNKNOWN
+            await page.wait_for_selector(chat_title_selector, timeout=timeout * 1000)
+
         await chat_container.click()
+        await page.wait_for_selector('#main footer', timeout=10000)
 
         logger.info(f"Чат '{chat_name}' найден и открыт.")
-        await asyncio.sleep(0.5)
+        if index is not None and not known_name and index.merge([chat_name]):
+            index.save()
         await take_screenshot(page, f"chat_opened_{chat_name.replace(' ', '_')}")
         return True
     except TimeoutError:
@@ -216,6 +511,283 @@ async def find_and_click_chat(page: Page, chat_name: str) -> bool:
         await page.locator(search_box_selector).fill("") # Очищаем поиск
         return False
 
+async def soft_reset(page: Page, ui: UiSelectors = ANY_LANGUAGE) -> bool:
+    """
+    Возвращает интерфейс WhatsApp в исходное состояние без перезагрузки страницы:
+    закрывает диалоги и меню, закрывает открытый чат и очищает поиск.
+    """
+    search_box_selector = ui.search_box
+    # Escape закрывает всплывающие меню, диалоги, превью вложения и, последним, сам чат
+    for _ in range(4):
+        if not await page.locator('#main, div[role="dialog"], [data-animate-modal-popup="true"]').count():
+            break
+        await page.keyboard.press("Escape")
+        await asyncio.sleep(0.15)
+
+    search_box = page.locator(search_box_selector)
+    await search_box.fill("", timeout=3000)
+
+    # Интерфейс в известном состоянии: список чатов на месте, нет открытого чата и диалогов
+    if await page.locator('#main, div[role="dialog"]').count():
+        return False
+    return await search_box.is_visible()
+
+async def reset_whatsapp_state(page: Page, ui: UiSelectors = ANY_LANGUAGE) -> tuple[str | None, float]:
+    """
+    Сбрасывает состояние страницы после отправки. Сначала пробует дешевый сброс (RESET_MODE=soft),
+    полная перезагрузка WhatsApp Web используется только как запасной вариант.
+    Возвращает (режим, длительность в секундах); режим None означает, что сброс не удался.
+    """
+    started = time.monotonic()
+    if RESET_MODE == "soft":
+        try:
+            if await soft_reset(page, ui):
+                return "soft", time.monotonic() - started
+            logger.warning("Мягкий сброс не привел интерфейс в исходное состояние, перезагружаю страницу.")
+        except Exception as e:
+            logger.warning(f"Ошибка мягкого сброса, перезагружаю страницу: {e}")
+
+    try:
+        await take_screenshot(page, "wap_before_updating")
+        await page.goto(WHATSAPP_URL, wait_until="domcontentloaded", timeout=15000)
+        return "reload", time.monotonic() - started
+    except Exception as e:
+        logger.error(f"Не удалось вернуться на главную страницу: {e}")
+        return None, time.monotonic() - started
+
+# --- ПРОГРЕВ СЕССИЙ ---
+
+class SessionLaunchError(Exception):
+    """Браузер не запустился или WhatsApp Web не загрузился: о входе пользователя ничего не известно."""
+
+async def _warm_up(user_id: int) -> Page | None:
+    async with browser_manager.launch_slot(), browser_manager.in_use(user_id):
+        page = await get_whatsapp_page(user_id)
+        if not page:
+            raise SessionLaunchError("не удалось запустить браузер")
+        browser_manager.set_readiness(user_id, WARMING)
+        try:
+            with PHASE_SECONDS.time(phase="goto"):
+                await page.goto(WHATSAPP_URL, timeout=60000)
+        except TimeoutError:
+            logger.warning(f"Таймаут загрузки WhatsApp Web при прогреве сессии пользователя {user_id}.")
+        except Exception as e:
+            browser_manager.set_readiness(user_id, COLD)
+            raise SessionLaunchError(f"не удалось открыть WhatsApp Web: {e}") from e
+        with PHASE_SECONDS.time(phase="login_check"):
+            state = await settle_login_state(page)
+        if state == LOGIN_LOGGED_IN:
+            browser_manager.set_readiness(user_id, READY)
+            await remember_ui_language(user_id, page)
+            return page
+        if state in (LOGIN_UNKNOWN, LOGIN_LOADING_ERROR):
+            # Страница не загрузилась - это не выход из аккаунта: следующее обращение попробует снова
+            browser_manager.set_readiness(user_id, COLD)
+            raise SessionLaunchError(f"WhatsApp Web не загрузился ({state})")
+        browser_manager.set_readiness(user_id, EXPIRED)
+        return None
+
+async def ensure_whatsapp_ready(user_id: int) -> Page | None:
+    """
+    Возвращает уже загруженную страницу WhatsApp пользователя с выполненным входом.
+    Если сессия еще холодная, загружает ее; если она прогревается в фоне, дожидается прогрева.
+    Возвращает None, если вход не выполнен; SessionLaunchError - если браузер или страница не загрузились.
+    """
+    task = warmup_tasks.get(user_id)
+    if task is None or task.done():
+        if browser_manager.readiness(user_id) == READY:
+            page = await get_whatsapp_page(user_id)
+            if page and browser_manager.readiness(user_id) == READY:
+                return page
+        task = warmup_tasks[user_id] = asyncio.create_task(_warm_up(user_id))
+    # shield: отмена ожидающего обработчика не должна прерывать общий прогрев
+    return await asyncio.shield(task)
+
+def saved_session_user_ids() -> list[int]:
+    """Пользователи с сохраненной сессией, начиная с недавно активных (по времени изменения state-файла)."""
+    sessions = []
+    for name in os.listdir(PLAYWRIGHT_STATE_DIR):
+        match = re.fullmatch(r"(\d+)\.json", name)
+        if match:
+            mtime = os.path.getmtime(os.path.join(PLAYWRIGHT_STATE_DIR, name))
+            if owns_user(int(match.group(1))):
+                sessions.append((mtime, int(match.group(1))))
+    return [user_id for _, user_id in sorted(sessions, reverse=True)]
+
+def mark_user_active(user_id: int) -> None:
+    """Отмечает активность пользователя, обновляя время изменения его state-файла."""
+    try:
+        os.utime(get_user_state_path(user_id))
+    except OSError:
+        pass
+
+async def restore_sessions() -> None:
+    """Фоновое восстановление сохраненных сессий после старта с ограниченным параллелизмом."""
+    user_ids = saved_session_user_ids()
+    if RESTORE_MAX_SESSIONS:
+        user_ids = user_ids[:RESTORE_MAX_SESSIONS]
+    if not user_ids:
+        return
+    logger.info(f"Восстановление {len(user_ids)} сохраненных сессий...")
+    semaphore = asyncio.Semaphore(RESTORE_CONCURRENCY)
+
+    async def restore(user_id: int) -> None:
+        async with semaphore:
+            if browser_manager.readiness(user_id) != COLD:
+                return  # пользователь уже сам начал работу
+            try:
+                await ensure_whatsapp_ready(user_id)
+            except Exception as e:
+                logger.warning(f"Не удалось восстановить сессию пользователя {user_id}: {e}")
+            logger.info(f"Сессия пользователя {user_id}: {browser_manager.readiness(user_id)}.")
+
+    await asyncio.gather(*(restore(user_id) for user_id in user_ids))
+
+
+# --- ПРОВЕРКА ЗДОРОВЬЯ СЕССИЙ ---
+
+async def watchdog_check_login(page: Page) -> str | None:
+    """Для SessionWatchdog: None, если вход в порядке, NEEDS_QR или причина пересоздания сессии."""
+    state = await probe_login_state(page, timeout=WATCHDOG_PAGE_TIMEOUT)
+    # "Телефон не подключен" - проблема телефона, новая сессия тут не поможет
+    if state in (LOGIN_LOGGED_IN, LOGIN_PHONE_DISCONNECTED):
+        return None
+    if state == LOGIN_QR:
+        return NEEDS_QR
+    return f"login_{state}"
+
+def on_session_recycled(user_id: int, reason: str) -> None:
+    """Неисправная сессия закрыта: сразу прогреваем новую, чтобы следующая отправка не ждала загрузки."""
+    WATCHDOG_RECYCLES.inc(reason=reason)
+    task = asyncio.create_task(rewarm_session(user_id))
+    rewarm_tasks.add(task)
+    task.add_done_callback(rewarm_done)
+
+async def rewarm_session(user_id: int) -> None:
+    try:
+        await ensure_whatsapp_ready(user_id)
+    except SessionLaunchError as e:
+        logger.warning(f"Не удалось заново прогреть сессию пользователя {user_id}: {e}")
+
+def rewarm_done(task: asyncio.Task) -> None:
+    rewarm_tasks.discard(task)
+    if not task.cancelled() and task.exception():
+        logger.error(f"Ошибка прогрева пересозданной сессии: {task.exception()}")
+
+async def notify_needs_qr(application: Application, user_id: int) -> None:
+    """
+    Сообщает пользователю, что сессия завершилась. Отметка об уведомлении хранится в user_data
+    (с PERSISTENCE_DB_PATH - переживает перезапуск) и снимается после /login. Пользователям,
+    которые ни разу не входили (нет сохраненного состояния), сообщать не о чем.
+    """
+    user_data = application.user_data[user_id]
+    if user_data.get('qr_notified') or not os.path.exists(get_user_state_path(user_id)):
+        return
+    # Чат с ботом - личный, его id совпадает с id пользователя
+    await application.bot.send_message(
+        user_id,
+        "⚠️ Сессия WhatsApp завершилась: нужно заново отсканировать QR-код. Выполните /login, "
+        "иначе отправки и запланированные задания не будут выполнены."
+    )
+    user_data['qr_notified'] = True
+
+
+# --- ПЕРЕДАЧА ФАЙЛОВ ---
+
+@dataclass
+class FileRelay:
+    """Файл из Telegram, подготовленный для file_chooser.set_files."""
+    name: str
+    size: int
+    payload: dict | str  # {"name", "mimeType", "buffer"} для файлов в памяти или путь к временному файлу
+    phases: dict[str, float]
+
+@contextlib.asynccontextmanager
+async def relay_telegram_file(bot: Bot, file_id: str, file_name: str):
+    """
+    Скачивает файл из Telegram для отправки в WhatsApp.
+    Файлы до RELAY_MEMORY_LIMIT передаются в Playwright прямо из памяти, более крупные
+    скачиваются в уникальный временный файл задания, который удаляется в любом случае.
+    """
+    phases = {}
+    started = time.monotonic()
+    tg_file = await bot.get_file(file_id)
+    phases["get_file"] = time.monotonic() - started
+
+    temp_path = None
+    started = time.monotonic()
+    try:
+        if tg_file.file_size is not None and tg_file.file_size <= RELAY_MEMORY_LIMIT:
+            data = bytes(await tg_file.download_as_bytearray())
+            mime_type = mimetypes.guess_type(file_name)[0] or "application/octet-stream"
+            payload = {"name": file_name, "mimeType": mime_type, "buffer": data}
+            size = len(data)
+        else:
+            os.makedirs(TEMP_FILES_DIR, exist_ok=True)
+            # Уникальный каталог на задание: одинаковые имена файлов разных пользователей не пересекаются,
+            # а WhatsApp видит исходное имя файла
+            temp_dir = tempfile.mkdtemp(prefix="relay_", dir=TEMP_FILES_DIR)
+            temp_path = os.path.join(temp_dir, os.path.basename(file_name) or "file")
+            await tg_file.download_to_drive(custom_path=temp_path)
+            payload = temp_path
+            size = os.path.getsize(temp_path)
+        phases["download"] = time.monotonic() - started
+
+        relay = FileRelay(name=file_name, size=size, payload=payload, phases=phases)
+        yield relay
+        logger.info(
+            f"Файл '{file_name}' передан ({size} байт, {'диск' if temp_path else 'память'}): "
+            + ", ".join(f"{phase} {seconds:.2f} сек." for phase, seconds in phases.items())
+        )
+    finally:
+        if temp_path:
+            shutil.rmtree(os.path.dirname(temp_path), ignore_errors=True)
+            logger.info(f"Временный файл удален: {temp_path}")
+
+
+# --- ОЧЕРЕДЬ ОТПРАВКИ ---
+
+@dataclass
+class SendJob:
+    """Задание на отправку в WhatsApp. Хранит все нужное воркеру, без ссылок на Update."""
+    user_id: int
+    chat_id: int
+    bot: Bot
+    chat_name: str
+    message_text: str | None = None
+    file_id: str | None = None
+    file_name: str | None = None
+    status_message: Message | None = None
+    outcome: str = "error"  # Заполняется воркером: delivered, unconfirmed, chat_not_found, ...
+    outbox_id: int | None = None  # Запись журнала отправок (только для /send)
+    sending: bool = False  # Нажата кнопка "Отправить": повторять задание уже нельзя
+
+
+@dataclass
+class LoginJob:
+    """Вход по QR-коду: выполняется воркером очереди, чтобы не перехватить страницу у идущей отправки."""
+    user_id: int
+    chat_id: int
+    bot: Bot
+    command: Message  # команда /login: на нее бот отвечает QR-кодом и итогом входа
+    user_data: dict
+    force_new: bool = False
+    status_message: Message | None = None
+    outcome: str = "login"
+
+
+@dataclass
+class BroadcastJob:
+    """Задание рассылки: все строки выполняются одним заданием очереди, без перезагрузки сессии между ними."""
+    broadcast_id: int
+    user_id: int
+    chat_id: int
+    bot: Bot
+    status_message: Message | None = None
+    outcome: str = "broadcast"
+    error: str | None = None  # почему рассылка приостановлена, если не из-за выхода из WhatsApp
+
+
 # --- TELEGRAM COMMAND HANDLERS ---
 
 @command_wrapper
@@ -224,73 +796,124 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         "👋 **Привет! Я бот для отправки сообщений в WhatsApp.**\n\n"
         "**Как пользоваться:**\n"
         "1️⃣ `/login` - привяжите свой WhatsApp.\n"
-        "2️⃣ `/send \"Имя чата\" \"Текст\"` - для отправки текста.\n"
+        "2️⃣ `/send \"Имя чата\" \"Текст\"` - для отправки текста. Вместо имени можно указать номер: `/send +79991234567 \"Текст\"`.\n"
         "3️⃣ Прикрепите файл и в подписи напишите `/send \"Имя чата\"` для отправки файла.\n\n"
         "💡 **Отложенная отправка:**\n"
-        "Чтобы отправить сообщение или файл в нужное время, просто зажмите кнопку отправки в Telegram и выберите 'Отправить позже'. Бот обработает команду, когда она придет.",
+        "`/schedule \"Имя чата\" \"18:30\" \"Текст\"` - запланировать сообщение (для файла - в подписи без текста).\n"
+        "`/jobs` - список заданий, `/cancel <номер>` - отменить задание.\n"
+        "`/status` - последние отправки, `/status <номер>` - состояние отправки.\n"
+        "Задания хранятся на сервере и будут выполнены даже после перезапуска бота.\n\n"
+        "📣 **Рассылка:** прикрепите CSV-файл с колонкой `chat` и в подписи напишите "
+        "`/broadcast \"Здравствуйте, {name}!\"` - значения колонок подставятся в шаблон.",
         parse_mode='Markdown'
     )
 
 @command_wrapper
 async def login(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    force_new = 'new' in (context.args or [])
-    msg = await update.message.reply_text("🔄 Инициализация браузера...")
-    page = await get_whatsapp_page(context, update.effective_user.id, force_new=force_new)
+    user_id = update.effective_user.id
+    ahead = send_queue.pending(user_id)
+    # Вход работает со страницей WhatsApp, поэтому идет через очередь, как и отправки
+    msg = await update.message.reply_text(
+        f"⏳ Вход начнется после заданий в очереди: {ahead}." if ahead else "🔄 Инициализация браузера..."
+    )
+    send_queue.enqueue(user_id, LoginJob(
+        user_id=user_id,
+        chat_id=update.effective_chat.id,
+        bot=context.bot,
+        command=update.message,
+        user_data=context.user_data,
+        force_new='new' in (context.args or []),
+        status_message=msg,
+    ))
+
+async def run_login(job: LoginJob) -> None:
+    """Вход по QR-коду. Вызывается только воркером очереди пользователя."""
+    msg = job.status_message
+    if msg.text != "🔄 Инициализация браузера...":
+        await msg.edit_text("🔄 Инициализация браузера...")
+    page = await get_whatsapp_page(job.user_id, force_new=job.force_new)
     if not page:
         await msg.edit_text("❌ Не удалось запустить браузер. Попробуйте снова.")
         return
 
     try:
         await msg.edit_text("🔄 Переход на WhatsApp Web (ждите, это долго)...")
-        await page.goto("https://web.whatsapp.com/", timeout=60000)
+        await page.goto(WHATSAPP_URL, timeout=60000)
         await take_screenshot(page, "login_goto")
 
-        qr_selector = 'canvas[aria-label="Scan this QR code to link a device!"]'
-        chat_list_selector = 'div[aria-placeholder="Поиск или новый чат"], div[aria-placeholder="Search or start a new chat"]'
+        state = await probe_login_state(page)
+        if state == LOGIN_USE_HERE:
+            await login_state_locators(page)[LOGIN_USE_HERE].first.click()
+            state = await probe_login_state(page)
 
-        try:
-            # Ждем QR
-            await page.wait_for_selector(qr_selector, timeout=60000)
-            await msg.edit_text("📷 Найден QR-код. Отправляю...")
-
-            qr_element = page.locator(qr_selector)
-            await take_screenshot(page, "login_qr_found")
-            qr_code_screenshot = await qr_element.screenshot()
-
-            # Удаляем старое сообщение и отправляем QR-картинку
-            await context.bot.delete_message(chat_id=update.effective_chat.id, message_id=msg.message_id)
-            await update.message.reply_photo(
-                photo=io.BytesIO(qr_code_screenshot),
-                caption="Отсканируйте QR-код с помощью приложения WhatsApp. У вас есть 60 секунд."
-            )
+        if state == LOGIN_LOGGED_IN:
+            browser_manager.set_readiness(job.user_id, READY)
+            await remember_ui_language(job.user_id, page)
+            await msg.edit_text("✅ Вы уже вошли в WhatsApp. Сессия активна.")
+            await take_screenshot(page, "login_already_logged_in")
+            return
+        if state == LOGIN_PHONE_DISCONNECTED:
+            await msg.edit_text("📵 WhatsApp сообщает, что телефон не подключен. Проверьте интернет на телефоне и повторите /login.")
+            return
+        if state != LOGIN_QR:
+            await take_screenshot(page, "login_error")
+            await msg.edit_text("❌ Не удалось найти QR-код или вход не удался. Попробуйте снова.")
+            return
 
-            # Ждем появления списка чатов
-            try:
-                await page.wait_for_selector(chat_list_selector, timeout=60000)
-                await take_screenshot(page, "login_success")
-                user_state_path = get_user_state_path(update.effective_user.id)
-                await context.user_data['playwright_context'].storage_state(path=user_state_path)
-                logger.info(f"Состояние сессии сохранено для пользователя {update.effective_user.id}.")
-                await update.message.reply_text("✅ Вход выполнен успешно! Сессия сохранена.")
+        await msg.edit_text("📷 Найден QR-код. Отправляю...")
+        qr_element = page.locator(QR_SELECTOR).first
+        await take_screenshot(page, "login_qr_found")
+        qr_code_screenshot = await qr_element.screenshot()
 
-            except TimeoutError:
-                await take_screenshot(page, "login_timeout")
-                await update.message.reply_text("❌ Не удалось найти список чатов. Сессия может быть неактивной.")
+        # Удаляем старое сообщение и отправляем QR-картинку
+        await job.bot.delete_message(chat_id=job.chat_id, message_id=msg.message_id)
+        await job.command.reply_photo(
+            photo=io.BytesIO(qr_code_screenshot),
+            caption="Отсканируйте QR-код с помощью приложения WhatsApp. У вас есть 60 секунд."
+        )
 
+        # Ждем появления списка чатов
+        try:
+            await page.wait_for_selector(ANY_LANGUAGE.search_box, timeout=60000)
+            await take_screenshot(page, "login_success")
+            await remember_ui_language(job.user_id, page)
+            await browser_manager.save_state(job.user_id)
+            browser_manager.set_readiness(job.user_id, READY)
+            job.user_data.pop('qr_notified', None)
+            logger.info(f"Состояние сессии сохранено для пользователя {job.user_id}.")
+            await job.command.reply_text("✅ Вход выполнен успешно! Сессия сохранена.")
+            try:
+                await get_chat_index(job.user_id).refresh_full(page)
+            except Exception as e:
+                logger.warning(f"Не удалось составить индекс чатов после входа: {e}")
 
         except TimeoutError:
-            # Если QR не появился — проверяем, может уже вошли
-            if await check_login_status(page):
-                await msg.edit_text("✅ Вы уже вошли в WhatsApp. Сессия активна.")
-                await take_screenshot(page, "login_already_logged_in")
-            else:
-                await take_screenshot(page, "login_error")
-                await msg.edit_text("❌ Не удалось найти QR-код или вход не удался. Попробуйте снова.")
+            await take_screenshot(page, "login_timeout")
+            await job.command.reply_text("❌ Не удалось найти список чатов. Сессия может быть неактивной.")
 
     except Exception as e:
         logger.error(f"Произошла ошибка при входе: {e}")
         await take_screenshot(page, "login_unhandled_exception")
-        await update.message.reply_text(f"❌ Произошла ошибка: {e}\nПопробуйте /login снова.")
+        await job.command.reply_text(f"❌ Произошла ошибка: {e}\nПопробуйте /login снова.")
+
+async def check_document_attachment(message: Message, attachment, usage: str) -> bool:
+    """Проверяет, что вложение отправлено как документ. Иначе отвечает пользователю и возвращает False."""
+    if isinstance(attachment, tuple):  # фото
+        await message.reply_text(
+            "⚠️ Фото можно отправлять **только как файлы**.\n"
+            "Пожалуйста, используйте опцию 'Отправить как файл' в Telegram и подпишите:\n"
+            f"`{usage}`",
+            parse_mode='Markdown'
+        )
+        return False
+
+    if not isinstance(attachment, Document):
+        await message.reply_text(
+            "⚠️ Неподдерживаемый тип файла. Отправляйте только документы.",
+            parse_mode='Markdown'
+        )
+        return False
+    return True
 
 async def send_command_internal(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     message = update.effective_message
@@ -308,20 +931,7 @@ async def send_command_internal(update: Update, context: ContextTypes.DEFAULT_TY
 
         # --- ИЗМЕНЕНИЕ: Раздельная проверка для файла и текста ---
         if attachment: # Логика для файла
-            if isinstance(attachment, tuple):  # фото
-                await message.reply_text(
-                    "⚠️ Фото можно отправлять **только как файлы**.\n"
-                    "Пожалуйста, используйте опцию 'Отправить как файл' в Telegram и подпишите:\n"
-                    "`/send \"Имя чата\"`",
-                    parse_mode='Markdown'
-                )
-                return
-
-            if not isinstance(attachment, Document):
-                await message.reply_text(
-                    "⚠️ Неподдерживаемый тип файла. Отправляйте только документы.",
-                    parse_mode='Markdown'
-                )
+            if not await check_document_attachment(message, attachment, '/send "Имя чата"'):
                 return
             chat_name = args[1].strip()
             message_text = None # Подпись к файлу не поддерживается
@@ -340,162 +950,611 @@ async def send_command_internal(update: Update, context: ContextTypes.DEFAULT_TY
         await message.reply_text("Ошибка в команде. Убедитесь, что имя чата и текст заключено в двойные кавычки.")
         return
 
+    if await reject_unknown_chat(message, update.effective_user.id, chat_name):
+        return
+
+    user_id = update.effective_user.id
+    file_id = attachment.file_id if attachment else None
+    file_name = (attachment.file_name or f"{attachment.file_unique_id}.bin") if attachment else None
+    outbox_id = None
+    if outbox:
+        # Telegram может доставить ту же команду повторно (например, после перезапуска бота)
+        entry, created = outbox.add(user_id, message.chat_id, message.message_id, chat_name, message_text, file_id, file_name)
+        if not created:
+            await message.reply_text(
+                f"ℹ️ Эта команда уже принята: отправка #{entry.id}, {OUTBOX_STATUS_LABELS[entry.status]}. "
+                f"Подробнее: /status {entry.id}"
+            )
+            return
+        outbox_id = entry.id
+
     # Если проверка прошла, увеличиваем счетчик
     context.user_data['request_count'] = context.user_data.get('request_count', 0) + 1
     logger.info(f"Счетчик команд для {update.effective_user.id} увеличен до {context.user_data['request_count']}")
 
-    msg_status = await message.reply_text("🔄 Проверяю сессию WhatsApp...")
-    page = await get_whatsapp_page(context, update.effective_user.id)
-    if not page or not await check_login_status(page):
-        await msg_status.edit_text("❌ Вы не вошли в WhatsApp. Пожалуйста, используйте команду /login.")
-        return
-
-    await msg_status.edit_text(f"Ищу чат '{chat_name}'...")
-    if not await find_and_click_chat(page, chat_name):
-        await msg_status.edit_text(f"❌ Чат с именем '{chat_name}' не найден. Проверьте название и попробуйте снова.")
-        return
-
-    download_path=None
+    ahead = send_queue.pending(user_id)
+    if ahead:
+        msg_status = await message.reply_text(
+            f"⏳ Задание поставлено в очередь: позиция {ahead + 1}, "
+            f"начало примерно через {int(send_queue.eta(user_id, ahead))} сек."
+        )
+    else:
+        msg_status = await message.reply_text("🔄 Проверяю сессию WhatsApp...")
+    status_reporter.track(msg_status)
+
+    send_queue.enqueue(user_id, SendJob(
+        user_id=user_id,
+        chat_id=message.chat_id,
+        bot=context.bot,
+        chat_name=chat_name,
+        message_text=message_text,
+        file_id=file_id,
+        file_name=file_name,
+        status_message=msg_status,
+        outbox_id=outbox_id,
+    ))
+
+
+async def attach_and_send_document(page: Page, user_id: int, msg_status: Message, relay: FileRelay, ui: UiSelectors,
+                                   on_sending=None) -> str:
+    """Прикрепляет документ в открытом чате, отправляет его и ждет доставки. Возвращает результат отправки."""
+    # Нажимаем «Прикрепить»
+    await page.locator(ui.attach_button).click()
+    await asyncio.sleep(2)  # ждём анимацию меню
+
+    # Жмём «Документ»
+    button_container = page.get_by_role("button", name=ui.document_button)
+    span_to_click = button_container.locator(ui.document_label)
+
+    async with page.expect_file_chooser() as fc_info:
+        await span_to_click.nth(1).click()
+    file_chooser = await fc_info.value
+    started = time.monotonic()
+    await file_chooser.set_files(relay.payload)
+    relay.phases["upload"] = time.monotonic() - started
+
+    # Отслеживание включаем до нажатия «Отправить», чтобы не пропустить появление сообщения
+    waiter = await delivery_tracker.arm(page)
     try:
-        if attachment:
-            await msg_status.edit_text("Подготовка файла к отправке...")
-
-            # --- Получаем правильный объект файла ---
-            file_to_download = attachment[-1] if isinstance(attachment, tuple) else attachment
-            file_id = file_to_download.file_id
-            tg_file = await context.bot.get_file(file_id)
-            file_name = getattr(file_to_download, 'file_name', f"{file_to_download.file_unique_id}.jpg")
+        if on_sending:
+            on_sending()
+        await page.locator(ui.send_button).click(timeout=60000)
+        started = time.monotonic()
+        outcome = await report_delivery(msg_status, page, user_id, ui, waiter, is_file=True)
+        relay.phases["delivery"] = time.monotonic() - started
+        return outcome
+    finally:
+        await waiter.close()
 
-            download_path = os.path.join("temp_files", file_name)
-            os.makedirs("temp_files", exist_ok=True)
-            await tg_file.download_to_drive(custom_path=download_path)
 
-            # Считаем количество сообщений "доставлено" до отправки
-            delivered_selector = 'span[aria-label=" Доставлено "], span[aria-label=" Delivered "]'
-            before_count = await page.locator(delivered_selector).count()
-            logger.info(f"Количество сообщений до отправки: {before_count}")
+async def report_delivery(msg_status: Message, page: Page, user_id: int, ui: UiSelectors,
+                          waiter: DeliveryWaiter, is_file: bool) -> str:
+    """
+    Ждет подтверждения доставки именно отправленного сообщения и сообщает результат пользователю.
+    Возвращает результат: "delivered", "unconfirmed" или "not_found".
+    """
+    what, sent = ("Файл", "отправлен") if is_file else ("Сообщение", "отправлено")
+    delivered = await waiter.wait_for("delivered", DELIVERY_TIMEOUT)
+    # Отметка "отправлено" у файла приходит после загрузки, поэтому ее задержка для файлов не учитывается
+    await report_pacing(page, user_id, ui, waiter, check_slow=not is_file)
+    if delivered:
+        delay = pacer.delay(user_id)
+        status_reporter.update(
+            msg_status,
+            f"✅ {what} успешно {sent} и доставлен{'' if is_file else 'о'}!"
+            + (f" Следующая отправка - не раньше чем через {delay:.0f} сек." if delay >= 5 else ""),
+            final=True,
+        )
+        return "delivered"
+    elif waiter.status in ("pending", "sent"):
+        status_reporter.update(msg_status, f"⚠️ {what} {sent}, но не удалось дождаться подтверждения доставки.", final=True)
+        return "unconfirmed"
+    else:
+        status_reporter.update(msg_status, f"⚠️ {what} {sent}, но не удалось найти его в чате для подтверждения доставки.", final=True)
+        return "not_found"
 
-            await msg_status.edit_text(f"Отправляю файл '{file_name}' в '{chat_name}'...")
 
-            # Нажимаем «Прикрепить»
-            attach_button_selector = '[aria-label="Прикрепить"], [aria-label="Attach"]'
-            await page.locator(attach_button_selector).click()
-            await asyncio.sleep(2)  # ждём анимацию меню
+async def throttle_signal(page: Page, ui: UiSelectors, waiter: DeliveryWaiter, check_slow: bool = True) -> str | None:
+    """
+    Признак того, что WhatsApp ограничивает отправку: сообщение так и не получило отметку "отправлено"
+    или получило ее слишком поздно, либо на странице баннер ожидания или потери соединения.
+    """
+    sent_seconds = waiter.seconds_to("sent")
+    if sent_seconds is None:
+        return "not_sent"
+    if check_slow and sent_seconds > PACING_SLOW_SENT_SECONDS:
+        return "slow_sent"
+    try:
+        if await page.get_by_text(ui.throttle_banner).count():
+            return "banner"
+    except Exception as e:
+        logger.debug(f"Не удалось проверить баннеры WhatsApp: {e}")
+    return None
+
+async def report_pacing(page: Page, user_id: int, ui: UiSelectors, waiter: DeliveryWaiter, check_slow: bool = True) -> None:
+    signal = await throttle_signal(page, ui, waiter, check_slow)
+    pacer.report(user_id, signal)
+    if signal:
+        PACING_SIGNALS.inc(signal=signal)
+
+async def wait_send_slot(user_id: int, on_wait=None) -> None:
+    """Дожидается разрешенного темпом аккаунта момента отправки. def on_wait(delay) - сообщить о паузе."""
+    delay = pacer.delay(user_id)
+    if delay >= 1 and on_wait:
+        on_wait(delay)
+    waited = await pacer.acquire(user_id)
+    if waited:
+        PHASE_SECONDS.observe(waited, phase="pacing_wait")
+
+async def open_chat(page: Page, user_id: int, index: ChatIndex, chat_name: str, ui: UiSelectors,
+                    progress=None) -> str | None:
+    """
+    Открывает чат для отправки. Номер телефона, которого нет в списке чатов, открывается прямой ссылкой
+    (переход на send?phone= перезагружает WhatsApp Web, поэтому только там, где поиск не поможет);
+    все остальное ищется по названию. def progress(text) - промежуточный статус.
+    Возвращает ошибку или None. Ошибки: not_logged_in, invalid_phone, link_failed, chat_not_found.
+    """
+    phone = normalize_phone(chat_name)
+    if phone and not index.lookup(chat_name):
+        if progress:
+            progress(f"Открываю чат '{chat_name}'...")
+        with PHASE_SECONDS.time(phase="chat_link"):
+            try:
+                link = await open_chat_by_phone(page, phone, ui)
+            except Exception as e:
+                logger.warning(f"Не удалось открыть чат по номеру {phone}: {e}")
+                link = LINK_TIMEOUT
+        if link == LINK_OPENED:
+            return None
+        if link == LINK_LOGGED_OUT:
+            browser_manager.set_readiness(user_id, EXPIRED)
+            return "not_logged_in"
+        await reset_whatsapp_state(page, ui)
+        return "invalid_phone" if link == LINK_INVALID else "link_failed"
+
+    if progress:
+        progress(f"Ищу чат '{chat_name}'...")
+    with PHASE_SECONDS.time(phase="chat_search"):
+        found = await find_and_click_chat(page, chat_name, index, ui)
+    return None if found else "chat_not_found"
+
+def chat_error_text(error: str, chat_name: str) -> str:
+    return {
+        "not_logged_in": "❌ Сессия WhatsApp завершилась. Пожалуйста, используйте команду /login.",
+        "launch_error": "❌ Не удалось запустить браузер или загрузить WhatsApp Web. Попробуйте снова.",
+        "invalid_phone": f"❌ Номер {chat_name} не зарегистрирован в WhatsApp.",
+        "link_failed": f"❌ Не удалось открыть чат с номером {chat_name}. Попробуйте снова.",
+    }.get(error, f"❌ Чат с именем '{chat_name}' не найден. Проверьте название и попробуйте снова.")
+
+
+async def run_send_job(job: SendJob) -> None:
+    """Выполняет одно задание отправки. Вызывается только воркером очереди пользователя."""
+    chat_name = job.chat_name
+    message_text = job.message_text
+    msg_status = job.status_message
+    if status_reporter.current_text(msg_status) != "🔄 Проверяю сессию WhatsApp...":
+        status_reporter.update(msg_status, "🔄 Проверяю сессию WhatsApp...")
+    try:
+        with PHASE_SECONDS.time(phase="session_ready"):
+            page = await ensure_whatsapp_ready(job.user_id)
+    except SessionLaunchError as e:
+        logger.error(f"Сессия пользователя {job.user_id} не загрузилась: {e}")
+        job.outcome = "launch_error"
+        status_reporter.update(msg_status, chat_error_text(job.outcome, chat_name), final=True)
+        return
+    if not page:
+        job.outcome = "not_logged_in"
+        status_reporter.update(msg_status, "❌ Вы не вошли в WhatsApp. Пожалуйста, используйте команду /login.", final=True)
+        return
+    mark_user_active(job.user_id)
+    ui = ui_selectors(job.user_id)
 
-            # Жмём «Документ»
-            button_container = page.get_by_role("button", name=re.compile("^(Документ|Document)$"))
-            span_to_click = button_container.locator('span:has-text("Документ"), span:has-text("Document")')
+    index = get_chat_index(job.user_id)
+    if not index.complete:
+        status_reporter.update(msg_status, "📇 Составляю список чатов (только при первой отправке)...")
+        try:
+            await index.refresh_full(page)
+        except Exception as e:
+            logger.warning(f"Не удалось составить индекс чатов для пользователя {job.user_id}: {e}")
 
-            async with page.expect_file_chooser() as fc_info:
-                await span_to_click.nth(1).click()
-            file_chooser = await fc_info.value
-            await file_chooser.set_files(download_path)
+    error = await open_chat(
+        page, job.user_id, index, chat_name, ui, progress=lambda text: status_reporter.update(msg_status, text),
+    )
+    if error:
+        job.outcome = error
+        status_reporter.update(msg_status, chat_error_text(error, chat_name), final=True)
+        return
 
-            # Жмём «Отправить»
-            send_button_selector = '[aria-label="Отправить"], [aria-label="Send"]'
-            await page.locator(send_button_selector).click(timeout=60000)
+    def pause_notice(delay: float) -> None:
+        status_reporter.update(msg_status, f"⏳ Пауза {delay:.0f} сек. перед отправкой: WhatsApp ограничивает частоту сообщений.")
 
-            # Ждём доставки (увеличение delivered-иконок)
-            try:
-                await page.wait_for_function(
-                    """([selector, before]) => {
-                        const elements = document.querySelectorAll(selector);
-                        return elements.length > before;
-                    }""",
-                    arg=(delivered_selector, before_count),
-                    timeout=60000
+    try:
+        if job.file_id:
+            status_reporter.update(msg_status, "Подготовка файла к отправке...")
+            async with relay_telegram_file(job.bot, job.file_id, job.file_name) as relay:
+                await wait_send_slot(job.user_id, pause_notice)
+                status_reporter.update(
+                    msg_status,
+                    f"Отправляю файл '{job.file_name}' ({relay.size / 1024 / 1024:.1f} МБ) в '{chat_name}'...",
                 )
-                await msg_status.edit_text(
-                    "✅ Файл успешно отправлен и доставлен! "
-                    "Из-за ограничений сервера придётся подождать перед отправкой следующего файла."
+                job.outcome = await attach_and_send_document(
+                    page, job.user_id, msg_status, relay, ui, on_sending=functools.partial(mark_job_sending, job),
                 )
-            except TimeoutError:
-                await msg_status.edit_text("⚠️ Файл отправлен, но не удалось дождаться подтверждения доставки.")
-
-            if os.path.exists(download_path):
-                os.remove(download_path)
+            for phase, seconds in relay.phases.items():
+                PHASE_SECONDS.observe(seconds, phase=f"file_{phase}")
 
         elif message_text:
-            await msg_status.edit_text(f"Отправляю сообщение в '{chat_name}'...")
-            msg_box_selector = 'div[aria-placeholder="Введите сообщение"], div[aria-placeholder="Type a message"]'
-            await page.locator(msg_box_selector).fill(message_text)
+            await wait_send_slot(job.user_id, pause_notice)
+            status_reporter.update(msg_status, f"Отправляю сообщение в '{chat_name}'...")
+            await page.locator(ui.message_box).fill(message_text)
 
-            send_button_selector = '[aria-label="Отправить"], [aria-label="Send"]'
-            await page.locator(send_button_selector).click()
-
-            # Для текста можно сделать такую же проверку доставки
+            waiter = await delivery_tracker.arm(page)
             try:
-                delivered_selector = 'span[aria-label=" Доставлено "], span[aria-label=" Delivered "]'
-                before_count = await page.locator(delivered_selector).count()
-                await page.wait_for_function(
-                    """([selector, before]) => {
-                        const elements = document.querySelectorAll(selector);
-                        return elements.length > before;
-                    }""",
-                    arg=(delivered_selector, before_count),
-                    timeout=60000
-                )
-                await msg_status.edit_text(
-                    "✅ Сообщение успешно отправлено и доставлено! "
-                    "Из-за ограничений сервера придётся подождать перед отправкой следующего сообщения."
-                )
-            except TimeoutError:
-                await msg_status.edit_text("⚠️ Сообщение отправлено, но не удалось дождаться подтверждения доставки.")
-
+                mark_job_sending(job)
+                await page.locator(ui.send_button).click()
+                with PHASE_SECONDS.time(phase="delivery_wait"):
+                    job.outcome = await report_delivery(msg_status, page, job.user_id, ui, waiter, is_file=False)
+            finally:
+                await waiter.close()
 
     except Exception as e:
+        job.outcome = "error"
         logger.error(f"Ошибка при отправке: {e}")
-        await msg_status.edit_text(f"❌ Не удалось отправить: {e}")
+        # Возможно, на телефоне сменили язык и точные селекторы больше не подходят: определим язык заново
+        browser_manager.set_ui_language(job.user_id, None)
+        status_reporter.update(msg_status, f"❌ Не удалось отправить: {e}", final=True)
         await take_screenshot(page, "send_universal_error")
     finally:
-        logger.info("Сброс состояния: возврат на главную страницу WhatsApp.")
-        
-        timer_msg = None # Инициализируем переменную для сообщения с таймером
+        await reset_after_send(page, job.user_id, index, ui)
+
+
+def mark_job_sending(job: SendJob) -> None:
+    job.sending = True
+    if job.outbox_id and outbox:
+        outbox.set_status(job.outbox_id, SENDING)
+
+
+async def reset_after_send(page: Page, user_id: int, index: ChatIndex, ui: UiSelectors) -> None:
+    """Возвращает страницу в исходное состояние после отправки и обновляет индекс видимых чатов."""
+    mode, reset_seconds = await reset_whatsapp_state(page, ui)
+    if mode is not None:
         try:
+            await index.refresh_visible(page)
+        except Exception as e:
+            logger.warning(f"Не удалось обновить индекс чатов: {e}")
+    # Короткая проверка, как у фоновой: медленно загружающаяся страница - еще не выход из аккаунта,
+    # сессию помечаем завершенной только по QR-коду
+    if mode == "reload" and await settle_login_state(page, timeout=WATCHDOG_PAGE_TIMEOUT) == LOGIN_QR:
+        browser_manager.set_readiness(user_id, EXPIRED)
+    if mode is None:
+        # Если даже перезагрузка не удалась, возможно, браузер "умер", лучше перезапустить
+        await get_whatsapp_page(user_id, force_new=True)
+    PHASE_SECONDS.observe(reset_seconds, phase=f"reset_{mode or 'failed'}")
+    # Штатный сброс виден в метриках; в журнал при уровне WARNING попадает только незапланированный
+    # (перезагрузка вместо мягкого сброса или неудача) вместе с его стоимостью
+    log = logger.debug if mode == RESET_MODE else logger.warning
+    log(f"Сброс состояния для пользователя {user_id}: режим {mode}, {reset_seconds:.2f} сек.")
+
+
+# --- РАССЫЛКИ ---
+
+def broadcast_progress_text(broadcast_id: int, current: str | None = None) -> str:
+    broadcast = broadcast_store.get(broadcast_id)
+    counts = broadcast_store.counts(broadcast_id)
+    done = broadcast.total - counts.get("pending", 0)
+    text = (
+        f"📣 Рассылка #{broadcast_id}: {done} из {broadcast.total}\n"
+        f"✅ отправлено: {counts.get(ROW_SENT, 0)}, ⚠️ без подтверждения: {counts.get(ROW_UNCONFIRMED, 0)}, "
+        f"❌ ошибок: {counts.get(ROW_FAILED, 0)}"
+    )
+    return text + (f"\n{current}" if current else "")
 
-            total_duration = 10
-            update_interval = 2
+async def send_broadcast_row(page: Page, user_id: int, index: ChatIndex, ui: UiSelectors, row, on_wait=None) -> str:
+    """
+    Отправляет одну строку рассылки и записывает результат. Ждем только отметку "отправлено":
+    доставка проверяется не для каждого получателя, чтобы сразу переходить к следующему.
+    """
+    error = await open_chat(page, user_id, index, row.chat_name, ui)
+    if error == "not_logged_in":
+        return error  # строка останется необработанной и будет отправлена после /login
+    try:
+        if error:
+            broadcast_store.mark(row, ROW_FAILED, chat_error_text(error, row.chat_name).removeprefix("❌ "))
+            return error
+
+        await wait_send_slot(user_id, on_wait)
+        # Отметка до отправки: если бот остановится на этой строке, она не будет отправлена повторно
+        broadcast_store.mark(row, ROW_SENDING)
+        await page.locator(ui.message_box).fill(row.message)
+        waiter = await delivery_tracker.arm(page)
+        try:
+            await page.locator(ui.send_button).click()
+            with PHASE_SECONDS.time(phase="broadcast_sent_wait"):
+                sent = await waiter.wait_for("sent", BROADCAST_SENT_TIMEOUT)
+            await report_pacing(page, user_id, ui, waiter)
+        finally:
+            await waiter.close()
+        if sent:
+            broadcast_store.mark(row, ROW_SENT)
+        else:
+            broadcast_store.mark(row, ROW_UNCONFIRMED, "не дождались отметки об отправке")
+        return "sent" if sent else "unconfirmed"
 
-            start_time = time.monotonic()  # реальное время старта
-            end_time = start_time + total_duration
+    except Exception as e:
+        logger.error(f"Ошибка при отправке строки {row.line_no} рассылки #{row.broadcast_id}: {e}")
+        browser_manager.set_ui_language(user_id, None)
+        broadcast_store.mark(row, ROW_FAILED, str(e).splitlines()[0][:200] if str(e) else type(e).__name__)
+        return "error"
+    finally:
+        await reset_after_send(page, user_id, index, ui)
 
-            timer_msg = await update.effective_message.reply_text(
-                f"⏳ Сбрасываю состояние WhatsApp для отправки нового сообщения через {total_duration} сек..."
-            )
+async def run_broadcast(job: BroadcastJob) -> None:
+    """
+    Выполняет рассылку с первой необработанной строки. Сессия остается загруженной между получателями:
+    после каждого сообщения выполняется только сброс интерфейса, без повторной проверки входа.
+    """
+    broadcast_id = job.broadcast_id
+    msg_status = job.status_message
+    broadcast = broadcast_store.get(broadcast_id)
+    if not broadcast:
+        return
+    if broadcast.status != RUNNING:
+        # Рассылку отменили, пока она ждала в очереди
+        await finish_broadcast(job)
+        return
+    status_reporter.update(msg_status, broadcast_progress_text(broadcast_id, "🔄 Проверяю сессию WhatsApp..."))
+    index = get_chat_index(job.user_id)
+
+    while broadcast_store.get(broadcast_id).status == RUNNING:
+        row = broadcast_store.next_row(broadcast_id)
+        if row is None:
+            broadcast_store.set_status(broadcast_id, DONE)
+            break
+        # Для загруженной сессии это только проверка состояния; после сбоя страницы сессия загрузится заново
+        try:
+            page = await ensure_whatsapp_ready(job.user_id)
+        except SessionLaunchError as e:
+            logger.error(f"Рассылка #{broadcast_id}: сессия пользователя {job.user_id} не загрузилась: {e}")
+            job.error = "launch_error"
+            broadcast_store.set_status(broadcast_id, PAUSED)
+            break
+        if not page:
+            broadcast_store.set_status(broadcast_id, PAUSED)
+            break
+        if not index.complete:
+            try:
+                await index.refresh_full(page)
+            except Exception as e:
+                logger.warning(f"Не удалось составить индекс чатов для пользователя {job.user_id}: {e}")
+        mark_user_active(job.user_id)
+
+        status_reporter.update(msg_status, broadcast_progress_text(broadcast_id, f"Отправляю в '{row.chat_name}'..."))
+        started = time.monotonic()
+        outcome = await send_broadcast_row(
+            page, job.user_id, index, ui_selectors(job.user_id), row,
+            on_wait=lambda delay: status_reporter.update(
+                msg_status, broadcast_progress_text(broadcast_id, f"⏳ Пауза {delay:.0f} сек. перед отправкой в '{row.chat_name}'..."),
+            ),
+        )
+        SEND_SECONDS.observe(time.monotonic() - started)
+        SEND_OUTCOMES.inc(outcome=f"broadcast_{outcome}")
+        if outcome == "not_logged_in":
+            broadcast_store.set_status(broadcast_id, PAUSED)
+            break
+
+    await finish_broadcast(job)
+
+async def finish_broadcast(job: BroadcastJob) -> None:
+    """Итоговый статус рассылки и, если она завершена, файл с результатами по строкам."""
+    broadcast = broadcast_store.get(job.broadcast_id)
+    job.outcome = f"broadcast_{broadcast.status}"
+    if broadcast.status == PAUSED:
+        if job.error == "launch_error":
+            reason = "не удалось запустить браузер или загрузить WhatsApp Web. Продолжить:"
+        else:
+            reason = "сессия WhatsApp завершилась. Выполните /login, затем"
+        status_reporter.update(
+            job.status_message,
+            broadcast_progress_text(broadcast.id, f"⏸ Рассылка приостановлена: {reason} /broadcast resume {broadcast.id}"),
+            final=True,
+        )
+        return
+    if broadcast.status not in (DONE, CANCELLED):
+        return
+    title = "🏁 Рассылка завершена." if broadcast.status == DONE else "🛑 Рассылка отменена."
+    status_reporter.update(job.status_message, broadcast_progress_text(broadcast.id, title), final=True)
+    try:
+        await job.bot.send_document(
+            job.chat_id,
+            document=broadcast_store.result_csv(broadcast.id),
+            filename=f"broadcast_{broadcast.id}_result.csv",
+            caption=f"Результаты рассылки #{broadcast.id} по строкам файла '{broadcast.file_name}'.",
+        )
+    except Exception as e:
+        logger.warning(f"Не удалось отправить результаты рассылки #{broadcast.id}: {e}")
+
+
+async def process_send_job(job: SendJob | BroadcastJob | LoginJob) -> None:
+    # Пока задание выполняется, сессия пользователя не может быть усыплена
+    if isinstance(job, LoginJob):
+        async with browser_manager.in_use(job.user_id):
+            await run_login(job)
+        return
+    if isinstance(job, BroadcastJob):
+        # Длительность и результаты рассылки учитываются по строкам в run_broadcast
+        try:
+            async with browser_manager.in_use(job.user_id):
+                await run_broadcast(job)
+        finally:
+            active_broadcasts.discard(job.broadcast_id)
+        return
+    started = time.monotonic()
+    attempt = outbox.start_attempt(job.outbox_id) if job.outbox_id and outbox else 0
+    try:
+        async with browser_manager.in_use(job.user_id):
+            await run_send_job(job)
+    except asyncio.CancelledError:
+        # Остановка бота: запись журнала остается как есть и будет обработана после запуска
+        job.outcome = "interrupted"
+        raise
+    finally:
+        SEND_SECONDS.observe(time.monotonic() - started)
+        SEND_OUTCOMES.inc(outcome=job.outcome)
+        if attempt:
+            settle_outbox(job, attempt)
 
-            while True:
-                remaining = int(end_time - time.monotonic())
-                if remaining <= 0:
-                    await timer_msg.edit_text("🔄 Выполняю сброс состояния...")
-                    await take_screenshot(page, "wap_before_updating")
-                    await page.goto("https://web.whatsapp.com/", wait_until="domcontentloaded", timeout=15000)
-                    await asyncio.sleep(1)
-                    await timer_msg.delete()
-                    break
-
-                # обновляем каждые update_interval секунд
-                if remaining % update_interval == 0:
-                    try:
-                        await timer_msg.edit_text(
-                            f"⏳ Сбрасываю состояние WhatsApp для отправки нового сообщения через {remaining} сек..."
-                        )
-                    except Exception as e:
-                        if "message is not modified" not in str(e).lower():
-                            logger.warning(f"Не удалось обновить таймер: {e}")
-
-                await asyncio.sleep(1)
 
+# --- ЖУРНАЛ ОТПРАВОК ---
 
-        except Exception as e:
-            logger.error(f"Не удалось вернуться на главную страницу: {e}")
-            # Если даже это не удалось, возможно, браузер "умер", лучше перезапустить
-            await get_whatsapp_page(context, update.effective_user.id, force_new=True)
-            if timer_msg:
-                await timer_msg.edit_text("❌ Ошибка при сбросе состояния.")
+# Временные ошибки до нажатия "Отправить", после которых задание можно безопасно повторить
+RETRYABLE_OUTCOMES = ("error", "link_failed", "launch_error")
+
+OUTBOX_STATUS_LABELS = {
+    QUEUED: "⏳ ожидает отправки",
+    SENDING: "📤 отправляется",
+    SENT: "✅ отправлено, доставка не подтверждена",
+    DELIVERED: "✅ доставлено",
+    FAILED: "❌ не отправлено",
+}
+
+# Задания, ожидающие повтора после временной ошибки: таймер -> задание
+retry_timers: dict[asyncio.TimerHandle, SendJob] = {}
+
+def outcome_error_text(outcome: str, chat_name: str) -> str:
+    if outcome == "error":
+        return "ошибка при отправке"
+    return chat_error_text(outcome, chat_name).removeprefix("❌ ")
+
+def settle_outbox(job: SendJob, attempt: int) -> None:
+    """Записывает результат попытки в журнал и при временной ошибке назначает повтор с растущей паузой."""
+    if job.outcome == "interrupted":
+        return
+    if job.outcome == "delivered":
+        outbox.set_status(job.outbox_id, DELIVERED)
+    elif job.sending and job.outcome in ("unconfirmed", "not_found"):
+        outbox.set_status(job.outbox_id, SENT)
+    elif job.sending:
+        # Неизвестно, ушло ли сообщение: повтор мог бы его продублировать
+        outbox.set_status(job.outbox_id, FAILED, "ошибка после нажатия «Отправить», проверьте чат")
+    elif job.outcome in RETRYABLE_OUTCOMES and attempt < OUTBOX_MAX_ATTEMPTS:
+        delay = OUTBOX_RETRY_DELAY * 2 ** (attempt - 1)
+        outbox.set_status(job.outbox_id, QUEUED, f"попытка {attempt}: {outcome_error_text(job.outcome, job.chat_name)}")
+        status_reporter.update(
+            job.status_message,
+            f"🔁 Не удалось отправить (попытка {attempt} из {OUTBOX_MAX_ATTEMPTS}), повтор через {delay:.0f} сек.",
+            final=True,
+        )
+        schedule_retry(job, delay)
+    else:
+        outbox.set_status(job.outbox_id, FAILED, outcome_error_text(job.outcome, job.chat_name))
 
-        if download_path and os.path.exists(download_path):
-            os.remove(download_path)
-            logger.info(f"Временный файл удален: {download_path}")
+def schedule_retry(job: SendJob, delay: float) -> None:
+    def fire() -> None:
+        retry_timers.pop(handle, None)
+        job.outcome = "error"
+        send_queue.enqueue(job.user_id, job)
+
+    handle = asyncio.get_running_loop().call_later(delay, fire)
+    retry_timers[handle] = job
+
+async def resume_outbox(bot: Bot) -> None:
+    """После запуска: ставит в очередь не выполненные до остановки отправки и сообщает о прерванных."""
+    queued, interrupted = outbox.recover(owns=owns_user)
+    for entry in interrupted:
+        try:
+            await bot.send_message(
+                entry.chat_id,
+                f"⚠️ Бот был перезапущен во время отправки #{entry.id} в '{entry.chat_name}'. "
+                "Проверьте чат в WhatsApp: повторно это сообщение не отправляется.",
+            )
+        except Exception as e:
+            logger.warning(f"Не удалось уведомить о прерванной отправке #{entry.id}: {e}")
+    for entry in queued:
+        try:
+            msg_status = await bot.send_message(
+                entry.chat_id, f"🔄 Бот перезапущен, отправка #{entry.id} в '{entry.chat_name}' продолжается."
+            )
+        except Exception as e:
+            # Пользователь недоступен в Telegram (например, заблокировал бота): отправлять не от чьего имени
+            logger.warning(f"Не удалось уведомить о продолжении отправки #{entry.id}: {e}")
+            outbox.set_status(entry.id, FAILED, "не удалось связаться с пользователем в Telegram")
+            continue
+        status_reporter.track(msg_status)
+        send_queue.enqueue(entry.user_id, SendJob(
+            user_id=entry.user_id,
+            chat_id=entry.chat_id,
+            bot=bot,
+            chat_name=entry.chat_name,
+            message_text=entry.message_text,
+            file_id=entry.file_id,
+            file_name=entry.file_name,
+            status_message=msg_status,
+            outbox_id=entry.id,
+        ))
+    if queued or interrupted:
+        logger.info(f"Журнал отправок: продолжено {len(queued)}, прервано при остановке {len(interrupted)}.")
+
+def format_outbox_entry(entry: OutboxEntry) -> str:
+    what = f"📎 {entry.file_name}" if entry.file_id else (entry.message_text or "")[:40]
+    line = f"#{entry.id} · {format_job_time(entry.updated_at)} · {entry.chat_name}: {what}\n{OUTBOX_STATUS_LABELS[entry.status]}"
+    if entry.attempts > 1:
+        line += f", попыток: {entry.attempts}"
+    if entry.error and entry.status in (QUEUED, FAILED):
+        line += f" ({entry.error})"
+    return line
+
+async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not outbox:
+        await update.message.reply_text("Журнал отправок выключен.")
+        return
+    user_id = update.effective_user.id
+    if context.args:
+        if not context.args[0].lstrip('#').isdigit():
+            await update.message.reply_text("Используйте: `/status <номер отправки>`", parse_mode='Markdown')
+            return
+        entry = outbox.get(int(context.args[0].lstrip('#')))
+        if not entry or entry.user_id != user_id:
+            await update.message.reply_text(f"❌ Отправка {context.args[0]} не найдена.")
+            return
+        entries = [entry]
+    else:
+        entries = outbox.recent(user_id)
+        if not entries:
+            await update.message.reply_text("Отправок пока нет.")
+            return
+    await update.message.reply_text("📬 Отправки:\n\n" + "\n\n".join(format_outbox_entry(entry) for entry in entries))
+
+
+send_queue = SendQueue(process_send_job)
+
+# --- МЕТРИКИ ---
+
+metrics_registry = Registry()
+PHASE_SECONDS = metrics_registry.histogram("wa_phase_seconds", "Длительность фаз отправки и управления сессиями")
+SEND_SECONDS = metrics_registry.histogram("wa_send_seconds", "Полная длительность задания отправки")
+SEND_OUTCOMES = metrics_registry.counter("wa_send_outcomes_total", "Результаты заданий отправки")
+metrics_registry.gauge("wa_live_browsers", "Запущенные процессы Chromium", lambda: browser_manager.live_browsers)
+metrics_registry.gauge("wa_live_contexts", "Открытые контексты пользователей", lambda: len(browser_manager.sessions))
+metrics_registry.gauge("wa_ready_sessions", "Сессии с загруженным WhatsApp Web",
+                       lambda: sum(1 for s in browser_manager.sessions.values() if s.state == READY))
+metrics_registry.counter_fn("wa_hibernated_total", "Усыпленные сессии за время работы", lambda: browser_manager.hibernated_total)
+PACING_SIGNALS = metrics_registry.counter("wa_pacing_throttle_signals_total", "Признаки ограничений WhatsApp после отправки")
+metrics_registry.counter_fn("wa_pacing_wait_seconds_total", "Суммарные паузы темпа отправки", lambda: pacer.waited_seconds)
+metrics_registry.gauge("wa_pacing_slowed_accounts", "Аккаунты с замедленным темпом отправки", lambda: pacer.slowed_down())
+WATCHDOG_RECYCLES = metrics_registry.counter("wa_watchdog_recycles_total", "Сессии, пересозданные фоновой проверкой")
+metrics_registry.gauge("wa_chromium_rss_bytes", "Память драйвера Playwright и Chromium", lambda: int(browser_manager.rss_mb() * 1024 * 1024))
+metrics_registry.gauge("wa_queued_jobs", "Задания в очередях отправки", lambda: send_queue.total_pending())
+metrics_registry.gauge("wa_scheduled_jobs", "Ожидающие задания планировщика", lambda: scheduler.pending_count() if scheduler else 0)
+metrics_registry.gauge("wa_network_allowed_bytes_estimate", "Разрешенный трафик WhatsApp Web по Content-Length (оценка снизу)", lambda: network_policy.totals().allowed_bytes)
+metrics_registry.gauge("wa_network_blocked_requests", "Заблокированные запросы WhatsApp Web", lambda: network_policy.totals().blocked_requests)
+metrics_registry.gauge("wa_network_blocked_bytes_estimate", "Оценка сэкономленного трафика", lambda: network_policy.totals().blocked_bytes_estimate)
+metrics_registry.counter_fn("wa_status_edits_total", "Изменения статусных сообщений в Telegram", lambda: status_reporter.api_calls)
+metrics_registry.counter_fn("wa_status_edits_dropped_total", "Промежуточные статусы, замененные более новыми", lambda: status_reporter.dropped)
+metrics_registry.counter_fn("wa_status_retry_after_total", "Ответы RetryAfter от Telegram", lambda: status_reporter.retry_after_total)
+scheduler: Scheduler | None = None  # Создается при старте приложения
+broadcast_store: BroadcastStore | None = None  # Создается при старте приложения
+outbox: Outbox | None = None  # Создается при старте приложения
+watchdog: SessionWatchdog | None = None  # Создается при старте приложения
 
 
 # Обертка для send_command, чтобы сначала проверить лимит
@@ -505,22 +1564,497 @@ async def send_command_wrapper(update: Update, context: ContextTypes.DEFAULT_TYP
     await send_command_internal(update, context)
 
 
-# --- MAIN ---
+# --- ПЛАНИРОВЩИК ---
 
-def main() -> None:
+async def fire_scheduled_job(bot: Bot, job: ScheduledJob) -> None:
+    """
+    Ставит наступившее задание планировщика в очередь отправки пользователя. Задание записывается
+    в журнал отправок (вместо номера сообщения Telegram - минус номер задания), поэтому после
+    перезапуска оно выполняется из журнала, а повторный запуск того же задания ничего не отправляет.
+    """
+    outbox_id = None
+    if outbox:
+        entry, created = outbox.add(
+            job.user_id, job.chat_id, -job.id, job.chat_name, job.message_text, job.file_id, job.file_name,
+        )
+        if not created:
+            return  # задание уже передано в журнал до перезапуска
+        outbox_id = entry.id
+    ahead = send_queue.pending(job.user_id)
+    what = f"файла '{job.file_name}'" if job.file_id else "сообщения"
+    try:
+        msg_status = await bot.send_message(
+            job.chat_id,
+            f"⏰ Запланированное задание #{job.id}: отправка {what} в '{job.chat_name}'"
+            + (f" (позиция в очереди {ahead + 1})." if ahead else "...")
+        )
+    except Exception:
+        if outbox_id:
+            outbox.set_status(outbox_id, FAILED, "не удалось связаться с пользователем в Telegram")
+        raise
+    status_reporter.track(msg_status)
+    send_queue.enqueue(job.user_id, SendJob(
+        user_id=job.user_id,
+        chat_id=job.chat_id,
+        bot=bot,
+        chat_name=job.chat_name,
+        message_text=job.message_text,
+        file_id=job.file_id,
+        file_name=job.file_name,
+        status_message=msg_status,
+        outbox_id=outbox_id,
+    ))
+
+def format_job_time(run_at: float) -> str:
+    return datetime.datetime.fromtimestamp(run_at, SCHEDULE_TZ).strftime("%d.%m.%Y %H:%M")
+
+@command_wrapper
+async def schedule_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    message = update.effective_message
+    command_text = message.text or message.caption
+    attachment = message.effective_attachment
+    usage = (
+        "Используйте:\n"
+        "`/schedule \"Имя чата\" \"Когда\" \"Текст сообщения\"`\n"
+        "или прикрепите файл с подписью `/schedule \"Имя чата\" \"Когда\"`.\n\n"
+        "Время: `18:30`, `25.12 09:00`, `25.12.2025 09:00`, `+30m`, `+2h`."
+    )
+
+    try:
+        args = shlex.split(command_text)
+    except ValueError:
+        await message.reply_text("Ошибка в команде. Убедитесь, что все аргументы заключены в двойные кавычки.")
+        return
+
+    if attachment:
+        if not await check_document_attachment(message, attachment, '/schedule "Имя чата" "Когда"'):
+            return
+        expected_args = 3
+    else:
+        expected_args = 4
+    if len(args) != expected_args:
+        await message.reply_text("Неверный формат. " + usage, parse_mode='Markdown')
+        return
+
+    try:
+        run_at = parse_when(args[2], SCHEDULE_TZ)
+    except ValueError:
+        await message.reply_text("Не удалось разобрать время. " + usage, parse_mode='Markdown')
+        return
+    if run_at <= time.time():
+        await message.reply_text("⚠️ Указанное время уже прошло.")
+        return
+    if await reject_unknown_chat(message, update.effective_user.id, args[1].strip()):
+        return
 
-    for file in glob.glob(os.path.join(PLAYWRIGHT_STATE_DIR, "*.json")):
+    job_id = scheduler.add(
+        user_id=update.effective_user.id,
+        chat_id=message.chat_id,
+        chat_name=args[1].strip(),
+        run_at=run_at,
+        message_text=None if attachment else args[3].strip(),
+        file_id=attachment.file_id if attachment else None,
+        file_name=(attachment.file_name or f"{attachment.file_unique_id}.bin") if attachment else None,
+    )
+    await message.reply_text(
+        f"🗓 Задание #{job_id} запланировано на {format_job_time(run_at)}.\n"
+        f"Отменить: `/cancel {job_id}`",
+        parse_mode='Markdown'
+    )
+
+BROADCAST_USAGE = (
+    "Прикрепите CSV-файл получателей и в подписи укажите шаблон сообщения:\n"
+    "`/broadcast \"Здравствуйте, {name}! Заказ {order} готов.\"`\n\n"
+    "В файле обязательна колонка `chat` (название чата или номер `+79991234567`), "
+    "остальные колонки подставляются в шаблон по названиям.\n"
+    "`/broadcast resume <номер>` - продолжить приостановленную рассылку, "
+    "`/broadcast cancel <номер>` - отменить."
+)
+
+# Рассылки, которые стоят в очереди или выполняются в этом процессе
+active_broadcasts: set[int] = set()
+
+def enqueue_broadcast(bot: Bot, broadcast: Broadcast, msg_status: Message) -> None:
+    status_reporter.track(msg_status)
+    active_broadcasts.add(broadcast.id)
+    send_queue.enqueue(broadcast.user_id, BroadcastJob(
+        broadcast_id=broadcast.id,
+        user_id=broadcast.user_id,
+        chat_id=broadcast.chat_id,
+        bot=bot,
+        status_message=msg_status,
+    ))
+
+def check_broadcast_chat(user_id: int, index: ChatIndex, chat_name: str) -> str | None:
+    """Проверка получателя при разборе файла рассылки; возвращает текст ошибки."""
+    if chat_name.startswith("+") and not normalize_phone(chat_name):
+        return f"неверный номер '{chat_name}', укажите его в формате +79991234567."
+    suggestions = unknown_chat_suggestions(user_id, chat_name, index)
+    if suggestions:
+        return f"чат '{chat_name}' не найден, возможно: {', '.join(suggestions)}."
+    return None
+
+def read_broadcast_file(data: bytes, user_id: int, chat_id: int, template: str, file_name: str,
+                        index: ChatIndex) -> int:
+    """
+    Разбирает CSV потоково и сохраняет рассылку. Файлы из Excel бывают в cp1251, поэтому при ошибке
+    декодирования UTF-8 файл читается заново. Выбрасывает BroadcastValidationError.
+    Вызывается в отдельном потоке: разбор большого файла не должен останавливать остальных пользователей.
+    Получатели проверяются по index - копии индекса чатов, которую не меняет воркер отправки.
+    """
+    for encoding in ("utf-8-sig", "cp1251"):
+        errors: list[str] = []
+        stream = io.TextIOWrapper(io.BytesIO(data), encoding=encoding, newline="")
+        recipients = iter_recipients(
+            stream, template, errors, BROADCAST_MAX_ROWS, functools.partial(check_broadcast_chat, user_id, index),
+        )
         try:
-            os.remove(file)
-        except Exception as e:
-            logger.warning(f"Не удалось удалить старый state файл {file}: {e}")
+            return broadcast_store.create(user_id, chat_id, template, file_name, recipients, errors)
+        except UnicodeDecodeError:
+            continue
+    raise BroadcastValidationError(["Не удалось прочитать файл: сохраните его в кодировке UTF-8."], 1)
 
-    if not TELEGRAM_TOKEN:
-        logger.critical("TELEGRAM_TOKEN не задан в .env файле.")
+@command_wrapper
+async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    message = update.effective_message
+    command_text = message.text or message.caption
+    attachment = message.effective_attachment
+    user_id = update.effective_user.id
+
+    try:
+        args = shlex.split(command_text)
+    except ValueError:
+        await message.reply_text("Ошибка в команде. Убедитесь, что шаблон заключен в двойные кавычки.")
         return
 
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+    if not attachment:
+        if len(args) == 3 and args[1] in ("resume", "cancel") and args[2].lstrip('#').isdigit():
+            broadcast_id = int(args[2].lstrip('#'))
+            if args[1] == "resume":
+                await resume_broadcast(message, context.bot, user_id, broadcast_id)
+            else:
+                await cancel_broadcast(message, context.bot, user_id, broadcast_id)
+        else:
+            await message.reply_text(BROADCAST_USAGE, parse_mode='Markdown')
+        return
+
+    if not await check_document_attachment(message, attachment, '/broadcast "Шаблон сообщения"'):
+        return
+    if len(args) != 2 or not args[1].strip():
+        await message.reply_text("Неверный формат. " + BROADCAST_USAGE, parse_mode='Markdown')
+        return
+    if attachment.file_size and attachment.file_size > BROADCAST_MAX_FILE_MB * 1024 * 1024:
+        await message.reply_text(f"❌ Файл рассылки больше {BROADCAST_MAX_FILE_MB} МБ.")
+        return
+
+    telegram_file = await attachment.get_file()
+    data = bytes(await telegram_file.download_as_bytearray())
+    # Воркер отправки пополняет индекс чатов во время разбора, поэтому поток получает копию
+    index = get_chat_index(user_id).frozen_copy()
+    try:
+        broadcast_id = await asyncio.to_thread(
+            read_broadcast_file, data, user_id, message.chat_id, args[1].strip(), attachment.file_name or "broadcast.csv",
+            index,
+        )
+    except BroadcastValidationError as e:
+        more = f"\n… и еще {e.total_errors - len(e.errors)}" if e.total_errors > len(e.errors) else ""
+        await message.reply_text("❌ Рассылка не создана, исправьте файл:\n" + "\n".join(e.errors) + more)
+        return
 
+    broadcast = broadcast_store.get(broadcast_id)
+    ahead = send_queue.pending(user_id)
+    msg_status = await message.reply_text(
+        f"📣 Рассылка #{broadcast.id}: получателей {broadcast.total}."
+        + (f" Начнется после {ahead} заданий в очереди." if ahead else "")
+        + f"\nОтменить: /broadcast cancel {broadcast.id}"
+    )
+    enqueue_broadcast(context.bot, broadcast, msg_status)
+
+async def resume_broadcast(message: Message, bot: Bot, user_id: int, broadcast_id: int) -> None:
+    broadcast = broadcast_store.get(broadcast_id)
+    if not broadcast or broadcast.user_id != user_id:
+        await message.reply_text(f"❌ Рассылка #{broadcast_id} не найдена.")
+        return
+    if broadcast.id in active_broadcasts:
+        await message.reply_text(f"Рассылка #{broadcast_id} уже выполняется.")
+        return
+    if broadcast.status in (DONE, CANCELLED):
+        await message.reply_text(f"Рассылка #{broadcast_id} уже завершена.")
+        return
+    broadcast_store.set_status(broadcast.id, RUNNING)
+    msg_status = await message.reply_text(f"▶️ Рассылка #{broadcast.id} продолжается с места остановки.")
+    enqueue_broadcast(bot, broadcast, msg_status)
+
+async def cancel_broadcast(message: Message, bot: Bot, user_id: int, broadcast_id: int) -> None:
+    broadcast = broadcast_store.get(broadcast_id)
+    if not broadcast or broadcast.user_id != user_id:
+        await message.reply_text(f"❌ Рассылка #{broadcast_id} не найдена.")
+        return
+    if broadcast.status in (DONE, CANCELLED):
+        await message.reply_text(f"Рассылка #{broadcast_id} уже завершена.")
+        return
+    broadcast_store.set_status(broadcast.id, CANCELLED)
+    if broadcast.id in active_broadcasts:
+        # Итоги пришлет задание рассылки, когда закончит текущее сообщение
+        await message.reply_text(f"🛑 Рассылка #{broadcast.id} будет остановлена после текущего сообщения.")
+        return
+    msg_status = await message.reply_text(f"🛑 Рассылка #{broadcast.id} отменена.")
+    status_reporter.track(msg_status)
+    await finish_broadcast(BroadcastJob(broadcast.id, user_id, broadcast.chat_id, bot, msg_status))
+
+async def jobs_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    jobs = scheduler.list_pending(update.effective_user.id)
+    if not jobs:
+        await update.message.reply_text("Запланированных заданий нет.")
+        return
+    lines = []
+    for job in jobs:
+        what = f"📎 {job.file_name}" if job.file_id else (job.message_text or "")[:40]
+        lines.append(f"#{job.id} · {format_job_time(job.run_at)} · {job.chat_name}: {what}")
+    await update.message.reply_text("🗓 Запланированные задания:\n\n" + "\n".join(lines))
+
+async def cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not context.args or not context.args[0].lstrip('#').isdigit():
+        await update.message.reply_text("Используйте: `/cancel <номер задания>`", parse_mode='Markdown')
+        return
+    job_id = int(context.args[0].lstrip('#'))
+    if scheduler.cancel(update.effective_user.id, job_id):
+        await update.message.reply_text(f"🗑 Задание #{job_id} отменено.")
+    else:
+        await update.message.reply_text(f"❌ Задание #{job_id} не найдено или уже выполнено.")
+
+
+# --- СТАТИСТИКА ---
+
+def format_seconds(value: float | None) -> str:
+    return "—" if value is None else f"{value:.1f}"
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Сводка метрик для администратора: перцентили фаз, результаты отправок и состояние браузеров."""
+    if not ADMIN_ID or update.effective_user.id != ADMIN_ID:
+        return
+
+    lines = ["📊 *Статистика* (сек., p50 / p95 / p99 · количество)", ""]
+    histograms = [("send", SEND_SECONDS, ())] + [
+        (dict(key)["phase"], PHASE_SECONDS, key) for key in sorted(PHASE_SECONDS.series)
+    ]
+    for name, histogram, key in histograms:
+        labels = dict(key)
+        count = histogram.series.get(key, [None, 0, 0])[2]
+        if not count:
+            continue
+        p50, p95, p99 = (histogram.quantile(q, **labels) for q in (0.5, 0.95, 0.99))
+        lines.append(f"`{name}`: {format_seconds(p50)} / {format_seconds(p95)} / {format_seconds(p99)} · {count}")
+
+    outcomes = ", ".join(f"`{dict(k)['outcome']}`: {int(v)}" for k, v in sorted(SEND_OUTCOMES.values.items()))
+    lines += [
+        "",
+        f"Результаты: {outcomes or 'нет отправок'}",
+        f"Chromium: {browser_manager.live_browsers}, контекстов: {len(browser_manager.sessions)}, "
+        f"память: {browser_manager.rss_mb():.0f} МБ, усыплено: {browser_manager.hibernated_total}, "
+        f"пересоздано: {browser_manager.recycled_total}",
+        f"В очередях: {send_queue.total_pending()}, в планировщике: {scheduler.pending_count() if scheduler else 0}",
+    ]
+    if pacer.enabled:
+        signals = ", ".join(f"`{name}`: {count}" for name, count in sorted(pacer.signals.items()))
+        lines.append(f"Темп: паузы {pacer.waited_seconds:.0f} сек., замедлено аккаунтов: {pacer.slowed_down()}, "
+                     f"признаки ограничений: {signals or 'нет'}")
+    if network_policy.enabled:
+        lines.append(f"Трафик: {network_policy.totals().summary()}")
+    await update.message.reply_text("\n".join(lines), parse_mode='Markdown')
+
+
+# --- MAIN ---
+
+async def on_startup(application: Application) -> None:
+    global scheduler, watchdog, broadcast_store, outbox
+    reap_orphan_browsers(whole_deployment=WORKER_INDEX < 0)
+    scheduler = Scheduler(
+        SCHEDULER_DB_PATH,
+        functools.partial(fire_scheduled_job, application.bot),
+        grace_seconds=SCHEDULE_GRACE_SECONDS,
+        spread_seconds=SCHEDULE_SPREAD_SECONDS,
+        owns=owns_user,
+    )
+    browser_manager.start_maintenance()
+    watchdog = SessionWatchdog(
+        browser_manager,
+        check_login=watchdog_check_login,
+        on_recycled=on_session_recycled,
+        on_needs_qr=functools.partial(notify_needs_qr, application),
+        interval=WATCHDOG_INTERVAL,
+        page_timeout=WATCHDOG_PAGE_TIMEOUT,
+        max_heap_mb=MAX_PAGE_HEAP_MB,
+        failure_threshold=WATCHDOG_MAX_FAILURES,
+    )
+    watchdog.start()
+    if METRICS_PORT:
+        application.bot_data['metrics_server'] = await start_metrics_server(metrics_registry, METRICS_HOST, METRICS_PORT)
+    application.bot_data['restore_task'] = asyncio.create_task(restore_sessions())
+    if OUTBOX_DB_PATH:
+        outbox = Outbox(OUTBOX_DB_PATH)
+        await resume_outbox(application.bot)
+    broadcast_store = BroadcastStore(BROADCAST_DB_PATH)
+    for broadcast in broadcast_store.recover(owns=owns_user):
+        # Рассылки, прерванные остановкой бота, продолжаются с первой необработанной строки
+        try:
+            msg_status = await application.bot.send_message(
+                broadcast.chat_id, f"🔄 Бот перезапущен, рассылка #{broadcast.id} продолжается с места остановки."
+            )
+        except Exception as e:
+            logger.warning(f"Не удалось уведомить о продолжении рассылки #{broadcast.id}: {e}")
+            continue
+        enqueue_broadcast(application.bot, broadcast, msg_status)
+    missed = await scheduler.start()
+    for job in missed:
+        try:
+            await application.bot.send_message(
+                job.chat_id,
+                f"⚠️ Запланированное задание #{job.id} в '{job.chat_name}' на {format_job_time(job.run_at)} "
+                "пропущено: бот был недоступен дольше допустимого окна."
+            )
+        except Exception as e:
+            logger.warning(f"Не удалось уведомить о пропущенном задании {job.id}: {e}")
+
+def reap_orphan_browsers(whole_deployment: bool) -> None:
+    """
+    Завершает Chromium и драйверы Playwright, оставшиеся от прошлого запуска этой установки.
+    Воркер убирает только процессы своего номера, супервизор и одиночный процесс - все.
+    """
+    if not REAP_ORPHANS:
+        return
+    if whole_deployment:
+        killed = kill_orphans(INSTANCE_ENV, lambda tag: tag.startswith(f"{DEPLOYMENT_TAG}:"))
+    else:
+        killed = kill_orphans(INSTANCE_ENV, lambda tag: tag == INSTANCE_TAG)
+    if killed:
+        logger.warning(f"Завершены процессы браузера, оставшиеся от прошлого запуска: {len(killed)}.")
+
+async def on_stop(application: Application) -> None:
+    # Новые отправки больше не начинаются: прогрев, проверка сессий и планировщик останавливаются первыми
+    restore_task = application.bot_data.get('restore_task')
+    if restore_task:
+        restore_task.cancel()
+    if watchdog:
+        await watchdog.stop()
+    if scheduler:
+        await scheduler.stop()
+
+    # Повторы после временных ошибок остаются в журнале отправок и будут выполнены после запуска
+    waiting_retry = list(retry_timers.values())
+    for handle in retry_timers:
+        handle.cancel()
+    retry_timers.clear()
+
+    abandoned, interrupted = await send_queue.drain(SHUTDOWN_DRAIN_TIMEOUT)
+    for job in abandoned + interrupted + waiting_retry:
+        if not job.status_message:
+            continue
+        if isinstance(job, BroadcastJob):
+            # Рассылка остается незавершенной в базе и продолжится после запуска
+            text = f"⏸ Бот перезапускается, рассылка #{job.broadcast_id} продолжится после запуска."
+        elif isinstance(job, LoginJob):
+            text = "❌ Бот перезапускается, вход не выполнен. Повторите /login после запуска."
+        elif job.outbox_id and not job.sending:
+            text = f"⏸ Бот перезапускается, отправка #{job.outbox_id} будет выполнена после запуска."
+        elif job in interrupted:
+            text = "⚠️ Бот перезапускается, отправка прервана. Проверьте чат в WhatsApp."
+        else:
+            text = "❌ Бот перезапускается, отправка не выполнена. Повторите команду позже."
+        status_reporter.update(job.status_message, text, final=True)
+    if abandoned or interrupted:
+        logger.warning(f"При остановке не выполнено заданий: {len(abandoned)}, прервано: {len(interrupted)}.")
+
+    # Бот еще может обращаться к Telegram: дописываем итоговые статусы отправок
+    await status_reporter.stop()
+
+
+async def on_shutdown(application: Application) -> None:
+    metrics_server = application.bot_data.get('metrics_server')
+    if metrics_server:
+        metrics_server.close()
+    # Сохраняет сессии и закрывает контексты, Chromium и драйвер; зависшие процессы завершаются принудительно
+    await browser_manager.stop()
+    if broadcast_store:
+        broadcast_store.close()
+    if outbox:
+        outbox.close()
+    if network_policy.enabled:
+        logger.info(f"Фильтрация трафика за время работы: {network_policy.totals().summary()}")
+
+
+# --- НЕСКОЛЬКО ПРОЦЕССОВ ---
+
+async def route_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Супервизор: передает апдейт воркеру, который обслуживает пользователя."""
+    sender = update.effective_user or update.effective_chat
+    if sender:
+        context.bot_data['supervisor'].route(sender.id, update.to_dict())
+
+async def on_supervisor_startup(application: Application) -> None:
+    # Воркеры еще не запущены: все процессы браузера этой установки - остатки прошлого запуска
+    reap_orphan_browsers(whole_deployment=True)
+    supervisor = application.bot_data['supervisor'] = Supervisor(
+        WORKER_PROCESSES, os.path.abspath(__file__), stop_timeout=SHUTDOWN_DRAIN_TIMEOUT + 60,
+    )
+    supervisor.start()
+    resize_tasks: set[asyncio.Task] = set()
+
+    def reload_worker_count() -> None:
+        # SIGHUP: перечитать .env и перераспределить пользователей, если изменилось WORKER_PROCESSES
+        load_dotenv(override=True)
+        task = asyncio.create_task(supervisor.resize(max(1, int(os.getenv("WORKER_PROCESSES", supervisor.worker_count)))))
+        # Ссылка нужна, чтобы задачу не собрал сборщик мусора до завершения
+        resize_tasks.add(task)
+        task.add_done_callback(resize_done)
+
+    def resize_done(task: asyncio.Task) -> None:
+        resize_tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            logger.error(f"Не удалось изменить число воркеров: {task.exception()}")
+
+    if hasattr(signal, "SIGHUP"):
+        asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, reload_worker_count)
+
+async def on_supervisor_stop(application: Application) -> None:
+    await application.bot_data['supervisor'].stop()
+
+async def run_worker() -> None:
+    """Процесс-воркер: обрабатывает апдейты, которые супервизор передает через stdin."""
+    # Сигналы остановки получает супервизор, он закрывает stdin, и воркер штатно завершается
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    application = build_application(on_startup, on_stop, on_shutdown, persistent=True)
+    register_handlers(application)
+    async with application:
+        await on_startup(application)
+        await application.start()
+        logger.info(f"Воркер {WORKER_INDEX} из {WORKER_COUNT} готов.")
+        await read_worker_updates(lambda data: application.update_queue.put(Update.de_json(data, application.bot)))
+        await application.stop()
+        await on_stop(application)
+    await on_shutdown(application)
+
+
+# --- ЗАПУСК ---
+
+def build_application(post_init, post_stop, post_shutdown, persistent: bool = False) -> Application:
+    builder = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .concurrent_updates(PerUserUpdateProcessor(CONCURRENT_UPDATES))
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+    )
+    if TELEGRAM_API_URL:
+        builder = builder.base_url(TELEGRAM_API_URL)
+    if persistent and PERSISTENCE_DB_PATH:
+        builder = builder.persistence(SqlitePersistence(PERSISTENCE_DB_PATH, PERSISTENCE_INTERVAL, owns=owns_user))
+    return builder.build()
+
+def register_handlers(application: Application) -> None:
     send_handler = MessageHandler(
         (filters.TEXT & filters.Regex(r'^/send')) | 
         (filters.ATTACHMENT & filters.CaptionRegex(r'^/send')),
@@ -530,11 +2064,52 @@ def main() -> None:
     application.add_handler(CommandHandler("start", start_command))
     application.add_handler(CommandHandler("login", login))
     application.add_handler(send_handler)
+    application.add_handler(MessageHandler(
+        (filters.TEXT & filters.Regex(r'^/schedule')) |
+        (filters.ATTACHMENT & filters.CaptionRegex(r'^/schedule')),
+        schedule_command
+    ))
+    application.add_handler(MessageHandler(
+        (filters.TEXT & filters.Regex(r'^/broadcast')) |
+        (filters.ATTACHMENT & filters.CaptionRegex(r'^/broadcast')),
+        broadcast_command
+    ))
+    application.add_handler(CommandHandler("status", status_command))
+    application.add_handler(CommandHandler("jobs", jobs_command))
+    application.add_handler(CommandHandler("cancel", cancel_command))
+    application.add_handler(CommandHandler("stats", stats_command))
     # --- НОВОЕ: Добавляем обработчик для кнопки сброса счетчика ---
     application.add_handler(CallbackQueryHandler(reset_support_counter_callback, pattern='^reset_support_counter$'))
-    
-    logger.info("Бот запущен...")
-    application.run_polling()
+
+def main() -> None:
+    if not TELEGRAM_TOKEN:
+        logger.critical("TELEGRAM_TOKEN не задан в .env файле.")
+        return
+
+    if WORKER_INDEX >= 0:
+        asyncio.run(run_worker())
+        return
+
+    if WORKER_PROCESSES:
+        # Супервизору не нужны браузеры и обработчики команд: он только раздает апдейты воркерам
+        application = build_application(on_supervisor_startup, on_supervisor_stop, None)
+        application.add_handler(TypeHandler(Update, route_update))
+    else:
+        application = build_application(on_startup, on_stop, on_shutdown, persistent=True)
+        register_handlers(application)
+
+    if WEBHOOK_URL:
+        logger.info(f"Бот запущен в режиме вебхука на {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH}...")
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET or None,
+        )
+    else:
+        logger.info("Бот запущен...")
+        application.run_polling()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,330 @@
+# --- START OF FILE broadcast.py ---
+import csv
+import io
+import logging
+import sqlite3
+import string
+import time
+from dataclasses import dataclass
+
+logger = logging.getLogger(__name__)
+
+# Колонка CSV с получателем: название чата или номер +79991234567
+CHAT_COLUMNS = ("chat", "чат")
+MAX_MESSAGE_LENGTH = 4096
+MAX_REPORTED_ERRORS = 10
+
+# Статусы строки рассылки
+ROW_PENDING = "pending"
+ROW_SENDING = "sending"          # отправка начата; если бот упал в этот момент, строка не повторяется
+ROW_SENT = "sent"
+ROW_UNCONFIRMED = "unconfirmed"
+ROW_FAILED = "failed"
+ROW_INTERRUPTED = "interrupted"  # бот остановился во время отправки - результат неизвестен
+ROW_SKIPPED = "skipped"          # рассылка отменена до этой строки
+
+# Статусы рассылки
+DRAFT = "draft"                  # файл еще сохраняется; после сбоя такая рассылка удаляется
+RUNNING = "running"
+PAUSED = "paused"
+DONE = "done"
+CANCELLED = "cancelled"
+
+
+@dataclass
+class Broadcast:
+    id: int
+    user_id: int
+    chat_id: int
+    template: str
+    file_name: str
+    status: str
+    total: int
+
+
+@dataclass
+class BroadcastRow:
+    broadcast_id: int
+    row_no: int
+    line_no: int
+    chat_name: str
+    message: str
+    status: str = ROW_PENDING
+    error: str | None = None
+
+
+class BroadcastValidationError(Exception):
+    def __init__(self, errors: list[str], total_errors: int):
+        super().__init__(f"{total_errors} ошибок в файле рассылки")
+        self.errors = errors
+        self.total_errors = total_errors
+
+
+def template_fields(template: str) -> list[str]:
+    """Имена подстановок шаблона ({name}). Допускаются только простые имена колонок."""
+    fields = []
+    for _, field, spec, conversion in string.Formatter().parse(template):
+        if field is None:
+            continue
+        if not field or any(c in field for c in ".[]") or spec or conversion:
+            raise ValueError(f"Неподдерживаемая подстановка {{{field}}}: используйте {{имя_колонки}}")
+        fields.append(field)
+    return fields
+
+
+def iter_recipients(stream, template: str, errors: list[str], max_rows: int, check_chat=None):
+    """
+    Построчно читает CSV получателей и выдает (номер строки файла, чат, текст сообщения).
+    Ошибки не прерывают чтение, а копятся в errors, чтобы пользователь сразу увидел их все.
+    def check_chat(name) -> str | None: дополнительная проверка получателя, возвращает текст ошибки.
+    """
+    sample = stream.read(4096)
+    try:
+        dialect = csv.Sniffer().sniff(sample, delimiters=",;\t")
+    except csv.Error:
+        dialect = csv.excel
+    reader = csv.reader(_chain(sample, stream), dialect)
+
+    header = next(reader, None)
+    if not header:
+        errors.append("Файл пуст.")
+        return
+    columns = [name.strip() for name in header]
+    lowered = [name.casefold() for name in columns]
+    chat_index = next((lowered.index(name) for name in CHAT_COLUMNS if name in lowered), None)
+    if chat_index is None:
+        errors.append(f"Нет колонки с получателем: назовите ее '{CHAT_COLUMNS[0]}'.")
+        return
+    try:
+        fields = template_fields(template)
+    except ValueError as e:
+        errors.append(str(e))
+        return
+    missing = [field for field in fields if field not in columns]
+    if missing:
+        errors.append("В файле нет колонок для шаблона: " + ", ".join(missing) + f". Есть: {', '.join(columns)}.")
+        return
+
+    rows = 0
+    for values in reader:
+        line_no = reader.line_num
+        if not any(value.strip() for value in values):
+            continue
+        rows += 1
+        if rows > max_rows:
+            errors.append(f"Слишком много получателей: не больше {max_rows}.")
+            return
+        if len(values) < len(columns):
+            errors.append(f"Строка {line_no}: {len(values)} значений вместо {len(columns)}.")
+            continue
+        chat = values[chat_index].strip()
+        if not chat:
+            errors.append(f"Строка {line_no}: не указан получатель.")
+            continue
+        message = template.format_map({name: values[i].strip() for i, name in enumerate(columns)}).strip()
+        if not message:
+            errors.append(f"Строка {line_no}: пустое сообщение.")
+            continue
+        if len(message) > MAX_MESSAGE_LENGTH:
+            errors.append(f"Строка {line_no}: сообщение длиннее {MAX_MESSAGE_LENGTH} символов.")
+            continue
+        problem = check_chat(chat) if check_chat else None
+        if problem:
+            errors.append(f"Строка {line_no}: {problem}")
+            continue
+        yield line_no, chat, message
+    if not rows:
+        errors.append("В файле нет получателей.")
+
+
+def _chain(sample: str, stream):
+    """Строки файла для csv.reader: сначала уже прочитанный для определения формата фрагмент, затем остаток."""
+    buffer = io.StringIO(sample + stream.readline())
+    yield from buffer
+    yield from stream
+
+
+class BroadcastStore:
+    """
+    Рассылки и результаты по строкам в SQLite.
+
+    Каждая строка отмечается до и после отправки, поэтому прерванная рассылка продолжается
+    с первой необработанной строки, а строка, отправка которой шла в момент остановки,
+    не отправляется повторно (она попадает в отчет как прерванная).
+
+    create работает через собственное соединение и короткие транзакции, поэтому ее можно вызывать
+    в отдельном потоке, пока основной поток отмечает строки идущих рассылок.
+    """
+
+    def __init__(self, db_path: str):
+        self._db_path = db_path
+        self._db = sqlite3.connect(db_path)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            """CREATE TABLE IF NOT EXISTS broadcasts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                chat_id INTEGER NOT NULL,
+                template TEXT NOT NULL,
+                file_name TEXT NOT NULL,
+                status TEXT NOT NULL,
+                total INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                finished_at REAL
+            )"""
+        )
+        self._db.execute(
+            """CREATE TABLE IF NOT EXISTS broadcast_rows (
+                broadcast_id INTEGER NOT NULL,
+                row_no INTEGER NOT NULL,
+                line_no INTEGER NOT NULL,
+                chat_name TEXT NOT NULL,
+                message TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                error TEXT,
+                finished_at REAL,
+                PRIMARY KEY (broadcast_id, row_no)
+            )"""
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS broadcasts_status ON broadcasts (status)")
+        self._db.commit()
+
+    def close(self) -> None:
+        self._db.close()
+
+    def create(self, user_id: int, chat_id: int, template: str, file_name: str, recipients, errors: list[str]) -> int:
+        """
+        Сохраняет рассылку, построчно забирая получателей из recipients (iter_recipients).
+        Если после чтения в errors есть ошибки, ничего не сохраняется и выбрасывается BroadcastValidationError.
+        Строки пишутся пачками в отдельных транзакциях, чтобы не держать блокировку базы все время разбора;
+        до конца разбора рассылка остается черновиком (DRAFT) и при ошибке удаляется.
+        """
+        db = sqlite3.connect(self._db_path)
+        try:
+            with db:
+                broadcast_id = db.execute(
+                    "INSERT INTO broadcasts (user_id, chat_id, template, file_name, status, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                    (user_id, chat_id, template, file_name, DRAFT, time.time()),
+                ).lastrowid
+            try:
+                total = 0
+                batch = []
+                for line_no, chat, message in recipients:
+                    total += 1
+                    batch.append((broadcast_id, total, line_no, chat, message))
+                    if len(batch) >= 500:
+                        self._insert_rows(db, batch)
+                        batch = []
+                if errors:
+                    raise BroadcastValidationError(errors[:MAX_REPORTED_ERRORS], len(errors))
+                self._insert_rows(db, batch)
+                with db:
+                    db.execute("UPDATE broadcasts SET status = ?, total = ? WHERE id = ?", (RUNNING, total, broadcast_id))
+            except BaseException:
+                # Частично сохраненная рассылка не нужна
+                self._delete(db, broadcast_id)
+                raise
+        finally:
+            db.close()
+        return broadcast_id
+
+    @staticmethod
+    def _insert_rows(db: sqlite3.Connection, batch: list[tuple]) -> None:
+        with db:
+            db.executemany(
+                "INSERT INTO broadcast_rows (broadcast_id, row_no, line_no, chat_name, message) VALUES (?, ?, ?, ?, ?)",
+                batch,
+            )
+
+    @staticmethod
+    def _delete(db: sqlite3.Connection, broadcast_id: int) -> None:
+        with db:
+            db.execute("DELETE FROM broadcast_rows WHERE broadcast_id = ?", (broadcast_id,))
+            db.execute("DELETE FROM broadcasts WHERE id = ?", (broadcast_id,))
+
+    def get(self, broadcast_id: int) -> Broadcast | None:
+        row = self._db.execute(
+            "SELECT id, user_id, chat_id, template, file_name, status, total FROM broadcasts WHERE id = ?",
+            (broadcast_id,),
+        ).fetchone()
+        return Broadcast(*row) if row else None
+
+    def set_status(self, broadcast_id: int, status: str) -> None:
+        finished_at = time.time() if status in (DONE, CANCELLED) else None
+        with self._db:
+            self._db.execute("UPDATE broadcasts SET status = ?, finished_at = ? WHERE id = ?", (status, finished_at, broadcast_id))
+            if status == CANCELLED:
+                self._db.execute(
+                    "UPDATE broadcast_rows SET status = ? WHERE broadcast_id = ? AND status = ?",
+                    (ROW_SKIPPED, broadcast_id, ROW_PENDING),
+                )
+
+    def next_row(self, broadcast_id: int) -> BroadcastRow | None:
+        row = self._db.execute(
+            "SELECT broadcast_id, row_no, line_no, chat_name, message, status, error FROM broadcast_rows "
+            "WHERE broadcast_id = ? AND status = ? ORDER BY row_no LIMIT 1",
+            (broadcast_id, ROW_PENDING),
+        ).fetchone()
+        return BroadcastRow(*row) if row else None
+
+    def mark(self, row: BroadcastRow, status: str, error: str | None = None) -> None:
+        row.status, row.error = status, error
+        with self._db:
+            self._db.execute(
+                "UPDATE broadcast_rows SET status = ?, error = ?, finished_at = ? WHERE broadcast_id = ? AND row_no = ?",
+                (status, error, time.time() if status != ROW_SENDING else None, row.broadcast_id, row.row_no),
+            )
+
+    def counts(self, broadcast_id: int) -> dict[str, int]:
+        return dict(self._db.execute(
+            "SELECT status, COUNT(*) FROM broadcast_rows WHERE broadcast_id = ? GROUP BY status", (broadcast_id,),
+        ).fetchall())
+
+    def rows(self, broadcast_id: int):
+        """Все строки рассылки по порядку, без загрузки в память целиком."""
+        cursor = self._db.execute(
+            "SELECT broadcast_id, row_no, line_no, chat_name, message, status, error FROM broadcast_rows "
+            "WHERE broadcast_id = ? ORDER BY row_no",
+            (broadcast_id,),
+        )
+        for row in cursor:
+            yield BroadcastRow(*row)
+
+    def recover(self, owns=None) -> list[Broadcast]:
+        """
+        После перезапуска: строки, отправка которых шла в момент остановки, помечаются прерванными,
+        недописанные черновики удаляются, и возвращаются незавершенные рассылки
+        (в режиме нескольких процессов - только своих пользователей).
+        """
+        owns = owns or (lambda user_id: True)
+        drafts = self._db.execute("SELECT id, user_id FROM broadcasts WHERE status = ?", (DRAFT,)).fetchall()
+        for broadcast_id, user_id in drafts:
+            if owns(user_id):
+                self._delete(self._db, broadcast_id)
+        broadcasts = [
+            Broadcast(*row) for row in self._db.execute(
+                "SELECT id, user_id, chat_id, template, file_name, status, total FROM broadcasts WHERE status = ? ORDER BY id",
+                (RUNNING,),
+            ).fetchall()
+            if owns(row[1])
+        ]
+        with self._db:
+            for broadcast in broadcasts:
+                self._db.execute(
+                    "UPDATE broadcast_rows SET status = ?, error = ?, finished_at = ? WHERE broadcast_id = ? AND status = ?",
+                    (ROW_INTERRUPTED, "бот был остановлен во время отправки", time.time(), broadcast.id, ROW_SENDING),
+                )
+        return broadcasts
+
+    def result_csv(self, broadcast_id: int) -> bytes:
+        """Итоговый отчет: по строке на получателя со статусом и ошибкой."""
+        output = io.StringIO()
+        writer = csv.writer(output)
+        writer.writerow(["line", "chat", "status", "error"])
+        for row in self.rows(broadcast_id):
+            writer.writerow([row.line_no, row.chat_name, row.status, row.error or ""])
+        # BOM - чтобы Excel открыл UTF-8 без вопросов о кодировке
+        return ("\ufeff" + output.getvalue()).encode("utf-8")
+
+# --- END OF FILE broadcast.py ---
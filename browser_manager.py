@@ -0,0 +1,456 @@
+# --- START OF FILE browser_manager.py ---
+import asyncio
+import contextlib
+import logging
+import os
+import time
+from dataclasses import dataclass, field
+
+from playwright.async_api import async_playwright, Browser, BrowserContext, Page, Playwright
+
+from profile_store import ProfileStore
+from proc_utils import children_rss_mb, kill_descendants
+
+logger = logging.getLogger(__name__)
+
+# Состояния готовности сессии пользователя
+COLD = "cold"        # контекст не создан или страница WhatsApp еще не загружена
+WARMING = "warming"  # идет загрузка WhatsApp Web
+READY = "ready"      # WhatsApp Web загружен, вход выполнен
+EXPIRED = "expired"  # сохраненная сессия больше не действует, нужен новый QR-код
+
+# Переменная окружения, которой помечаются драйвер Playwright и все процессы Chromium бота
+# (они наследуют окружение). По ней после аварийного завершения находятся осиротевшие процессы
+INSTANCE_ENV = "WA_BOT_INSTANCE"
+
+
+@dataclass
+class Session:
+    """
+    Изолированный BrowserContext одного пользователя: внутри общего Chromium
+    или, для постоянного профиля, в собственном процессе (browser=None).
+    """
+    user_id: int
+    context: BrowserContext
+    browser: Browser | None
+    page: Page | None = None
+    state: str = COLD
+    last_used: float = field(default_factory=time.monotonic)
+    closed: bool = False
+
+    def connected(self) -> bool:
+        return self.browser.is_connected() if self.browser else not self.closed
+
+
+class BrowserManager:
+    """
+    Общий на весь процесс менеджер браузеров.
+
+    Держит один драйвер Playwright и небольшой пул процессов Chromium,
+    а каждому пользователю выдает собственный BrowserContext,
+    загруженный из его файла состояния (playwright_states/<id>.json).
+
+    Живые контексты ограничены по количеству (max_live_contexts) и по суммарной памяти
+    Chromium (max_rss_mb): при превышении, а также после idle_seconds простоя, давно не
+    использовавшиеся сессии усыпляются - storage_state сохраняется, контекст закрывается.
+    Следующее обращение к такой сессии прозрачно создает контекст заново.
+
+    С profile_store каждый аккаунт запускается в отдельном Chromium с постоянным профилем
+    (launch_persistent_context): сессия переживает перезапуск вместе с IndexedDB и кэшами WhatsApp Web.
+    """
+
+    def __init__(self, state_path_fn, launch_args: list[str], user_agent: str, pool_size: int = 1,
+                 context_hooks: list | None = None, max_live_contexts: int = 0, max_rss_mb: int = 0,
+                 idle_seconds: int = 0, launch_concurrency: int = 4, launch_interval: float = 0.5,
+                 instance_tag: str = "", profile_store: ProfileStore | None = None):
+        self._state_path_fn = state_path_fn
+        self._profiles = profile_store
+        self._last_profile_cleanup = 0.0
+        self._instance_tag = instance_tag
+        # async def hook(context, user_id) - вызывается для каждого нового контекста до создания страниц
+        self.context_hooks = list(context_hooks or [])
+        self._launch_args = launch_args
+        self._user_agent = user_agent
+        self._pool_size = max(1, pool_size)
+        self._max_live_contexts = max_live_contexts
+        self._max_rss_mb = max_rss_mb
+        self._idle_seconds = idle_seconds
+        self._launch_interval = launch_interval
+        self._launch_semaphore = asyncio.Semaphore(max(1, launch_concurrency))
+        self._launch_lock = asyncio.Lock()
+        self._last_launch = 0.0
+        self._in_use: dict[int, int] = {}
+        self._maintenance_task: asyncio.Task | None = None
+        # Проверки бюджета после создания контекста: ссылки держим, иначе задачу может собрать сборщик мусора
+        self._budget_tasks: set[asyncio.Task] = set()
+        self.hibernated_total = 0
+        self.recycled_total = 0
+
+        self._playwright: Playwright | None = None
+        self._browsers: list[Browser] = []
+        self._lock = asyncio.Lock()
+        self._user_locks: dict[int, asyncio.Lock] = {}
+        self.sessions: dict[int, Session] = {}
+        # Язык интерфейса WhatsApp каждого пользователя: определяется один раз и переживает усыпление сессии
+        self._ui_languages: dict[int, str] = {}
+
+    # --- Драйвер и процессы Chromium ---
+
+    async def _ensure_playwright(self) -> Playwright:
+        if self._playwright is None:
+            logger.info("Запуск общего драйвера Playwright...")
+            if self._instance_tag:
+                os.environ[INSTANCE_ENV] = self._instance_tag
+            self._playwright = await async_playwright().start()
+        return self._playwright
+
+    async def _launch_browser(self) -> Browser:
+        p = await self._ensure_playwright()
+        browser = await p.chromium.launch(headless=True, args=self._launch_args)
+        browser.on("disconnected", self._on_browser_disconnected)
+        logger.info("Запущен новый процесс Chromium (всего в пуле: %s).", len(self._browsers) + 1)
+        return browser
+
+    def _on_browser_disconnected(self, browser: Browser) -> None:
+        logger.warning("Процесс Chromium отключился, его сессии будут пересозданы при следующем обращении.")
+        if browser in self._browsers:
+            self._browsers.remove(browser)
+        for user_id in [uid for uid, s in self.sessions.items() if s.browser is browser]:
+            self.sessions.pop(user_id, None)
+
+    def _contexts_count(self, browser: Browser) -> int:
+        return sum(1 for s in self.sessions.values() if s.browser is browser)
+
+    async def _pick_browser(self) -> Browser:
+        """Возвращает наименее загруженный Chromium, при необходимости запуская новый."""
+        async with self._lock:
+            self._browsers = [b for b in self._browsers if b.is_connected()]
+            if len(self._browsers) < self._pool_size:
+                browser = await self._launch_browser()
+                self._browsers.append(browser)
+                return browser
+            return min(self._browsers, key=self._contexts_count)
+
+    @property
+    def live_browsers(self) -> int:
+        persistent = sum(1 for s in self.sessions.values() if s.browser is None and s.connected())
+        return sum(1 for b in self._browsers if b.is_connected()) + persistent
+
+    # --- Сессии пользователей ---
+
+    def _user_lock(self, user_id: int) -> asyncio.Lock:
+        lock = self._user_locks.get(user_id)
+        if lock is None:
+            lock = self._user_locks[user_id] = asyncio.Lock()
+        return lock
+
+    async def _wait_launch_turn(self) -> None:
+        """Не чаще одного создания контекста в launch_interval секунд."""
+        async with self._launch_lock:
+            delay = self._last_launch + self._launch_interval - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._last_launch = time.monotonic()
+
+    @contextlib.asynccontextmanager
+    async def launch_slot(self):
+        """
+        Ограничивает количество одновременно загружающихся сессий (контекст + загрузка WhatsApp Web),
+        чтобы волна пробуждений не загрузила сотни страниц разом.
+        """
+        async with self._launch_semaphore:
+            yield
+
+    def busy(self, user_id: int) -> bool:
+        return user_id in self._in_use
+
+    @contextlib.asynccontextmanager
+    async def in_use(self, user_id: int):
+        """Помечает сессию занятой: такие сессии не усыпляются."""
+        self._in_use[user_id] = self._in_use.get(user_id, 0) + 1
+        try:
+            yield
+        finally:
+            self._in_use[user_id] -= 1
+            if not self._in_use[user_id]:
+                del self._in_use[user_id]
+            session = self.sessions.get(user_id)
+            if session:
+                session.last_used = time.monotonic()
+
+    async def _open_persistent_session(self, user_id: int) -> Session:
+        """Запускает Chromium с постоянным профилем пользователя."""
+        p = await self._ensure_playwright()
+        fresh = not self._profiles.exists(user_id)
+        pw_context = await p.chromium.launch_persistent_context(
+            self._profiles.path(user_id),
+            headless=True,
+            args=self._launch_args,
+            user_agent=self._user_agent,
+        )
+        session = Session(user_id=user_id, context=pw_context, browser=None)
+
+        def on_close(_) -> None:
+            session.closed = True
+            if self.sessions.get(user_id) is session:
+                logger.warning("Chromium с профилем пользователя %s закрылся, сессия будет пересоздана.", user_id)
+                self.sessions.pop(user_id, None)
+
+        pw_context.on("close", on_close)
+        # Первый запуск профиля: переносим cookies и localStorage из прежнего JSON storage_state.
+        # Вход WhatsApp хранится в IndexedDB и не переносится - понадобится новый QR-код
+        user_state_path = self._state_path_fn(user_id)
+        if fresh and os.path.exists(user_state_path):
+            try:
+                cookies, seed_script = await asyncio.to_thread(ProfileStore.seed_script, user_state_path)
+                if cookies:
+                    await pw_context.add_cookies(cookies)
+                if seed_script:
+                    await pw_context.add_init_script(seed_script)
+            except Exception as e:
+                logger.warning(f"Не удалось перенести сессию пользователя {user_id} в профиль: {e}")
+            logger.info("Профиль пользователя %s создан из JSON-сессии: для входа нужен новый QR-код.", user_id)
+        self._profiles.touch(user_id)
+        logger.info("Запущен постоянный профиль пользователя %s (%s).", user_id, "новый" if fresh else "существующий")
+        return session
+
+    async def _open_session(self, user_id: int) -> Session:
+        await self._wait_launch_turn()
+        if self._profiles:
+            session = await self._open_persistent_session(user_id)
+            for hook in self.context_hooks:
+                await hook(session.context, user_id)
+            self.sessions[user_id] = session
+            self._schedule_budget_check()
+            return session
+
+        browser = await self._pick_browser()
+        user_state_path = self._state_path_fn(user_id)
+        storage_state = user_state_path if os.path.exists(user_state_path) else None
+
+        pw_context = await browser.new_context(
+            storage_state=storage_state,
+            user_agent=self._user_agent,
+        )
+        for hook in self.context_hooks:
+            await hook(pw_context, user_id)
+        session = Session(user_id=user_id, context=pw_context, browser=browser)
+        self.sessions[user_id] = session
+        logger.info("Создан контекст браузера для пользователя %s (state: %s).", user_id, bool(storage_state))
+        self._schedule_budget_check()
+        return session
+
+    def _schedule_budget_check(self) -> None:
+        """Проверяет бюджет в фоне, чтобы создание контекста не ждало усыпления чужих сессий."""
+        task = asyncio.create_task(self.enforce_budget())
+        self._budget_tasks.add(task)
+        task.add_done_callback(self._budget_check_done)
+
+    def _budget_check_done(self, task: asyncio.Task) -> None:
+        self._budget_tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            logger.error(f"Ошибка проверки бюджета сессий браузера: {task.exception()}")
+
+    @staticmethod
+    async def _take_page(session: Session) -> Page:
+        # Постоянный контекст запускается сразу с пустой вкладкой - используем ее
+        blank = [p for p in session.context.pages if not p.is_closed()] if session.browser is None else []
+        return blank[0] if blank else await session.context.new_page()
+
+    async def get_page(self, user_id: int, force_new: bool = False) -> Page:
+        """
+        Возвращает страницу WhatsApp пользователя, создавая контекст при необходимости.
+        При force_new контекст пользователя закрывается и создается заново; общий Chromium не трогается.
+        """
+        async with self._user_lock(user_id):
+            session = self.sessions.get(user_id)
+            if session and (force_new or not session.connected()):
+                await self._close_session(session)
+                session = None
+
+            if session is None:
+                session = await self._open_session(user_id)
+
+            session.last_used = time.monotonic()
+            if session.page and not session.page.is_closed():
+                return session.page
+
+            # Новая страница еще не загрузила WhatsApp Web
+            session.state = COLD
+            try:
+                session.page = await self._take_page(session)
+            except Exception as e:
+                logger.error(f"Не удалось создать страницу в существующем контексте пользователя {user_id}: {e}")
+                await self._close_session(session)
+                session = await self._open_session(user_id)
+                session.page = await self._take_page(session)
+            return session.page
+
+    def readiness(self, user_id: int) -> str:
+        session = self.sessions.get(user_id)
+        return session.state if session else COLD
+
+    def set_readiness(self, user_id: int, state: str) -> None:
+        session = self.sessions.get(user_id)
+        if session:
+            session.state = state
+
+    def ui_language(self, user_id: int) -> str | None:
+        return self._ui_languages.get(user_id)
+
+    def set_ui_language(self, user_id: int, lang: str | None) -> None:
+        if lang:
+            self._ui_languages[user_id] = lang
+        else:
+            self._ui_languages.pop(user_id, None)
+
+    def get_context(self, user_id: int) -> BrowserContext | None:
+        session = self.sessions.get(user_id)
+        return session.context if session else None
+
+    async def save_state(self, user_id: int) -> bool:
+        session = self.sessions.get(user_id)
+        if not session:
+            return False
+        await session.context.storage_state(path=self._state_path_fn(user_id))
+        return True
+
+    async def _close_session(self, session: Session) -> None:
+        self.sessions.pop(session.user_id, None)
+        try:
+            await session.context.close()
+        except Exception as e:
+            logger.warning(f"Ошибка при закрытии контекста пользователя {session.user_id}: {e}")
+        if session.browser is None and self._profiles:
+            # Профиль закрыт - теперь его кэши можно безопасно удалить, если он вырос больше квоты
+            await asyncio.to_thread(self._profiles.trim, session.user_id)
+
+    async def close_session(self, user_id: int) -> None:
+        async with self._user_lock(user_id):
+            session = self.sessions.get(user_id)
+            if session:
+                await self._close_session(session)
+
+    # --- Усыпление сессий ---
+
+    async def _retire(self, user_id: int, save: bool) -> bool:
+        """Закрывает свободную сессию, при save сначала сохранив storage_state. Занятые сессии не трогаются."""
+        if user_id in self._in_use:
+            return False
+        async with self._user_lock(user_id):
+            session = self.sessions.get(user_id)
+            if not session or user_id in self._in_use:
+                return False
+            if save and session.state == READY:
+                try:
+                    # Зависшая страница не должна задерживать закрытие надолго
+                    await asyncio.wait_for(session.context.storage_state(path=self._state_path_fn(user_id)), 15)
+                except Exception as e:
+                    logger.warning(f"Не удалось сохранить состояние пользователя {user_id} перед закрытием сессии: {e}")
+            await self._close_session(session)
+        return True
+
+    async def hibernate(self, user_id: int) -> bool:
+        """Сохраняет storage_state и закрывает контекст. Занятые сессии не трогаются."""
+        if not await self._retire(user_id, save=True):
+            return False
+        self.hibernated_total += 1
+        logger.info("Сессия пользователя %s усыплена.", user_id)
+        return True
+
+    async def recycle(self, user_id: int, save: bool = True) -> bool:
+        """Закрывает неисправную сессию; следующее обращение создаст контекст заново."""
+        if not await self._retire(user_id, save):
+            return False
+        self.recycled_total += 1
+        logger.info("Сессия пользователя %s пересоздается.", user_id)
+        return True
+
+    def _eviction_candidates(self) -> list[Session]:
+        """Свободные сессии, от давно не использовавшихся к недавним."""
+        return sorted(
+            (s for s in self.sessions.values() if s.user_id not in self._in_use),
+            key=lambda s: s.last_used,
+        )
+
+    def rss_mb(self) -> float:
+        return children_rss_mb()
+
+    async def enforce_budget(self) -> None:
+        """Усыпляет давно не использовавшиеся сессии, пока не выполнены лимиты по количеству и памяти."""
+        if self._max_live_contexts:
+            for session in self._eviction_candidates()[:max(0, len(self.sessions) - self._max_live_contexts)]:
+                await self.hibernate(session.user_id)
+        if self._max_rss_mb:
+            for session in self._eviction_candidates():
+                rss = self.rss_mb()
+                if rss <= self._max_rss_mb:
+                    break
+                logger.info("Chromium использует %.0f МБ при лимите %s МБ.", rss, self._max_rss_mb)
+                await self.hibernate(session.user_id)
+
+    async def _maintenance(self) -> None:
+        while True:
+            await asyncio.sleep(60)
+            try:
+                if self._idle_seconds:
+                    idle_since = time.monotonic() - self._idle_seconds
+                    for session in self._eviction_candidates():
+                        if session.last_used > idle_since:
+                            break
+                        await self.hibernate(session.user_id)
+                await self.enforce_budget()
+                await self.cleanup_profiles()
+            except Exception as e:
+                logger.error(f"Ошибка обслуживания сессий браузера: {e}")
+
+    async def cleanup_profiles(self, force: bool = False) -> None:
+        """Удаляет давно не открывавшиеся профили, не чаще раза в час."""
+        if not self._profiles or (not force and time.monotonic() - self._last_profile_cleanup < 3600):
+            return
+        self._last_profile_cleanup = time.monotonic()
+        await asyncio.to_thread(self._profiles.cleanup, set(self.sessions))
+
+    def start_maintenance(self) -> None:
+        if self._maintenance_task is None:
+            self._maintenance_task = asyncio.create_task(self._maintenance())
+
+    async def _save_and_close(self, session: Session) -> None:
+        if session.state == READY:
+            try:
+                await asyncio.wait_for(session.context.storage_state(path=self._state_path_fn(session.user_id)), 10)
+            except Exception as e:
+                logger.warning(f"Не удалось сохранить состояние пользователя {session.user_id} при остановке: {e}")
+        await self._close_session(session)
+
+    async def stop(self, timeout: float = 30.0) -> None:
+        """
+        Сохраняет storage_state загруженных сессий и параллельно закрывает контексты, затем процессы Chromium
+        и драйвер Playwright. Все, что не закрылось за отведенное время, завершается принудительно.
+        """
+        if self._maintenance_task:
+            self._maintenance_task.cancel()
+            self._maintenance_task = None
+        for task in list(self._budget_tasks):
+            task.cancel()
+        sessions = list(self.sessions.values())
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(self._save_and_close(s) for s in sessions), return_exceptions=True), timeout
+            )
+        except asyncio.TimeoutError:
+            logger.warning(f"Контексты браузера не закрылись за {timeout:.0f} сек.")
+        try:
+            await asyncio.wait_for(asyncio.gather(*(b.close() for b in self._browsers), return_exceptions=True), 10)
+            if self._playwright is not None:
+                await asyncio.wait_for(self._playwright.stop(), 10)
+        except asyncio.TimeoutError:
+            logger.warning("Chromium или драйвер Playwright не остановились вовремя.")
+        self._browsers.clear()
+        self._playwright = None
+        killed = kill_descendants(INSTANCE_ENV)
+        if killed:
+            logger.warning(f"Принудительно завершены зависшие процессы браузера: {len(killed)}.")
+        logger.info(f"Менеджер браузеров остановлен, сохранено сессий: {sum(1 for s in sessions if s.state == READY)}.")
+
+# --- END OF FILE browser_manager.py ---
@@ -0,0 +1,145 @@
+# --- START OF FILE chat_index.py ---
+import copy
+import difflib
+import json
+import logging
+import os
+import time
+
+from playwright.async_api import Page
+
+logger = logging.getLogger(__name__)
+
+# Название чата - первый span[title] в элементе списка чатов
+_HARVEST_VISIBLE_JS = """() => {
+    const pane = document.querySelector('#pane-side');
+    if (!pane) return null;
+    const titles = [];
+    for (const item of pane.querySelectorAll('div[role="listitem"], div[role="row"]')) {
+        const span = item.querySelector('span[title]');
+        if (span && span.title) titles.push(span.title);
+    }
+    return titles;
+}"""
+
+# Полный обход: прокручиваем виртуализированный список чатов сверху вниз и собираем все названия
+_HARVEST_FULL_JS = """async () => {
+    const pane = document.querySelector('#pane-side');
+    if (!pane) return null;
+    const titles = new Set();
+    const collect = () => {
+        for (const item of pane.querySelectorAll('div[role="listitem"], div[role="row"]')) {
+            const span = item.querySelector('span[title]');
+            if (span && span.title) titles.add(span.title);
+        }
+    };
+    pane.scrollTop = 0;
+    let last = -1;
+    for (let i = 0; i < 500 && pane.scrollTop !== last; i++) {
+        collect();
+        last = pane.scrollTop;
+        pane.scrollTop = last + pane.clientHeight * 0.8;
+        await new Promise(r => setTimeout(r, 120));
+    }
+    collect();
+    pane.scrollTop = 0;
+    return Array.from(titles);
+}"""
+
+
+def _key(name: str) -> str:
+    return " ".join(name.split()).casefold()
+
+
+class ChatIndex:
+    """
+    Индекс названий чатов одного аккаунта WhatsApp.
+
+    Собирается из DOM списка чатов и дополняется при каждом сбросе интерфейса.
+    Хранится в памяти, снимок сохраняется рядом с файлом сессии (playwright_states/<id>.chats.json).
+    """
+
+    def __init__(self, snapshot_path: str):
+        self.snapshot_path = snapshot_path
+        self.names: dict[str, str] = {}  # нормализованное имя -> имя как в WhatsApp
+        self.complete = False  # был ли выполнен полный обход списка
+        self.updated_at = 0.0
+        self._load()
+
+    def _load(self) -> None:
+        if not os.path.exists(self.snapshot_path):
+            return
+        try:
+            with open(self.snapshot_path, encoding="utf-8") as f:
+                data = json.load(f)
+            self.names = {_key(name): name for name in data.get("names", [])}
+            self.complete = data.get("complete", False)
+            self.updated_at = data.get("updated_at", 0.0)
+        except Exception as e:
+            logger.warning(f"Не удалось прочитать индекс чатов {self.snapshot_path}: {e}")
+
+    def save(self) -> None:
+        tmp_path = self.snapshot_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(
+                {"names": sorted(self.names.values()), "complete": self.complete, "updated_at": self.updated_at},
+                f, ensure_ascii=False,
+            )
+        os.replace(tmp_path, self.snapshot_path)
+
+    def merge(self, titles: list[str]) -> int:
+        """Добавляет названия в индекс. Возвращает количество новых."""
+        added = 0
+        for title in titles:
+            key = _key(title)
+            if key and self.names.get(key) != title:
+                added += key not in self.names
+                self.names[key] = title
+        self.updated_at = time.time()
+        return added
+
+    def frozen_copy(self) -> "ChatIndex":
+        """Копия для чтения в другом потоке: merge в основном потоке ее не меняет."""
+        clone = copy.copy(self)
+        clone.names = dict(self.names)
+        return clone
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def lookup(self, name: str) -> str | None:
+        """Возвращает точное название чата (с учетом регистра и пробелов в WhatsApp) или None."""
+        return self.names.get(_key(name))
+
+    def suggest(self, name: str, limit: int = 3) -> list[str]:
+        """Похожие названия для подсказки "возможно, вы имели в виду"."""
+        key = _key(name)
+        matches = difflib.get_close_matches(key, self.names.keys(), n=limit, cutoff=0.6)
+        # Добавляем чаты, в названии которых встречается введенная строка
+        for k in self.names:
+            if len(matches) >= limit:
+                break
+            if key and key in k and k not in matches:
+                matches.append(k)
+        return [self.names[k] for k in matches]
+
+    async def refresh_visible(self, page: Page) -> int:
+        """Дешевое инкрементальное обновление: только видимая часть списка чатов."""
+        titles = await page.evaluate(_HARVEST_VISIBLE_JS)
+        added = self.merge(titles or [])
+        if added:
+            self.save()
+        return added
+
+    async def refresh_full(self, page: Page) -> int:
+        """Полный обход списка чатов с прокруткой. Выполняется один раз после входа."""
+        titles = await page.evaluate(_HARVEST_FULL_JS)
+        if titles is None:
+            return 0
+        added = self.merge(titles)
+        self.complete = True
+        self.save()
+        logger.info(f"Индекс чатов {self.snapshot_path}: полный обход, {len(self)} чатов.")
+        return added
+
+# --- END OF FILE chat_index.py ---
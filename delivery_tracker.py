@@ -0,0 +1,151 @@
+# --- START OF FILE delivery_tracker.py ---
+import asyncio
+import logging
+import time
+import uuid
+
+from playwright.async_api import BrowserContext, Page
+
+logger = logging.getLogger(__name__)
+
+BINDING_NAME = "__waDeliveryEvent"
+
+# Статусы исходящего сообщения в порядке возрастания
+STATUSES = ("created", "pending", "sent", "delivered", "read")
+
+# Идемпотентный скрипт: ставится как init script контекста и при необходимости выполняется повторно.
+# arm(token) запоминает уже существующие исходящие сообщения, а MutationObserver находит новое
+# исходящее сообщение ([data-id^="true_"]) и сообщает в Python только смены его статуса.
+TRACKER_JS = """(() => {
+    if (window.__waTracker) return;
+    const LABELS = {
+        'ожидает': 'pending', 'pending': 'pending',
+        'отправлено': 'sent', 'sent': 'sent',
+        'доставлено': 'delivered', 'delivered': 'delivered',
+        'прочитано': 'read', 'read': 'read',
+    };
+    const ICONS = {'msg-time': 'pending', 'msg-check': 'sent', 'msg-dblcheck': 'delivered'};
+    const ORDER = ['created', 'pending', 'sent', 'delivered', 'read'];
+    const trackers = new Map();
+
+    const statusOf = (node) => {
+        let best = null;
+        for (const el of node.querySelectorAll('[aria-label], [data-icon]')) {
+            const label = (el.getAttribute('aria-label') || '').trim().toLowerCase();
+            const status = LABELS[label] || ICONS[el.getAttribute('data-icon')];
+            if (status && (!best || ORDER.indexOf(status) > ORDER.indexOf(best))) best = status;
+        }
+        return best;
+    };
+
+    const outgoing = () => document.querySelectorAll('#main [data-id^="true_"]');
+
+    window.__waTracker = {
+        arm(token) {
+            const known = new Set(Array.from(outgoing(), el => el.getAttribute('data-id')));
+            const state = {msgId: null, status: null, observer: null};
+            const report = (status) => {
+                if (ORDER.indexOf(status) <= ORDER.indexOf(state.status)) return;
+                state.status = status;
+                window.__waDeliveryEvent(token, state.msgId, status);
+                if (status === 'read') this.disarm(token);
+            };
+            const check = () => {
+                if (!state.msgId) {
+                    for (const el of outgoing()) {
+                        const id = el.getAttribute('data-id');
+                        if (!known.has(id)) { state.msgId = id; report('created'); break; }
+                    }
+                    if (!state.msgId) return;
+                }
+                const node = document.querySelector(`[data-id="${CSS.escape(state.msgId)}"]`);
+                const status = node && statusOf(node);
+                if (status) report(status);
+            };
+            state.observer = new MutationObserver(check);
+            state.observer.observe(document.body, {
+                childList: true, subtree: true, attributes: true,
+                attributeFilter: ['aria-label', 'data-icon', 'data-id'],
+            });
+            trackers.set(token, state);
+        },
+        disarm(token) {
+            const state = trackers.get(token);
+            if (state) { state.observer.disconnect(); trackers.delete(token); }
+        },
+    };
+})()"""
+
+
+class DeliveryWaiter:
+    """Отслеживание одного исходящего сообщения: события sent/delivered/read приходят из MutationObserver."""
+
+    def __init__(self, tracker: "DeliveryTracker", page: Page, token: str):
+        self._tracker = tracker
+        self._page = page
+        self.token = token
+        self.message_id: str | None = None
+        self.status: str | None = None
+        self._events = {status: asyncio.Event() for status in STATUSES}
+        self._armed_at = time.monotonic()
+        self._reached: dict[str, float] = {}  # статус -> секунд от начала отслеживания
+
+    def _update(self, message_id: str, status: str) -> None:
+        self.message_id = message_id
+        if status not in self._events:
+            return
+        self.status = status
+        elapsed = time.monotonic() - self._armed_at
+        # Более поздний статус подразумевает все предыдущие
+        for s in STATUSES[:STATUSES.index(status) + 1]:
+            self._events[s].set()
+            self._reached.setdefault(s, elapsed)
+        logger.info(f"Сообщение {message_id}: статус '{status}'.")
+
+    def seconds_to(self, status: str) -> float | None:
+        """Через сколько секунд после начала отслеживания сообщение получило статус (None - еще не получило)."""
+        return self._reached.get(status)
+
+    async def wait_for(self, status: str, timeout: float) -> bool:
+        try:
+            await asyncio.wait_for(self._events[status].wait(), timeout=timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def close(self) -> None:
+        self._tracker._waiters.pop(self.token, None)
+        try:
+            if not self._page.is_closed():
+                await self._page.evaluate("t => window.__waTracker && window.__waTracker.disarm(t)", self.token)
+        except Exception as e:
+            logger.debug(f"Не удалось снять отслеживание доставки: {e}")
+
+
+class DeliveryTracker:
+    """Подтверждение доставки конкретного отправленного сообщения без опроса DOM."""
+
+    def __init__(self):
+        self._waiters: dict[str, DeliveryWaiter] = {}
+
+    async def install(self, context: BrowserContext, user_id: int | None = None) -> None:
+        """Подключает binding и скрипт отслеживания к контексту браузера. Вызывается при создании контекста."""
+        await context.expose_binding(BINDING_NAME, self._on_event)
+        await context.add_init_script(TRACKER_JS)
+
+    def _on_event(self, source, token: str, message_id: str, status: str) -> None:
+        waiter = self._waiters.get(token)
+        if waiter:
+            waiter._update(message_id, status)
+
+    async def arm(self, page: Page) -> DeliveryWaiter:
+        """Начинает отслеживание. Вызывать до нажатия кнопки "Отправить"."""
+        token = uuid.uuid4().hex
+        waiter = DeliveryWaiter(self, page, token)
+        self._waiters[token] = waiter
+        # Страница могла быть загружена до установки init script
+        await page.evaluate(TRACKER_JS)
+        await page.evaluate("t => window.__waTracker.arm(t)", token)
+        return waiter
+
+# --- END OF FILE delivery_tracker.py ---
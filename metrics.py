@@ -0,0 +1,176 @@
+# --- START OF FILE metrics.py ---
+import asyncio
+import bisect
+import contextlib
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм в секундах: от быстрых операций на странице до долгих ожиданий доставки
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 3, 5, 7.5, 10, 15, 20, 30, 45, 60, 90, 120)
+
+
+def _labels_text(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self.values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        lines += [f"{self.name}{_labels_text(k)} {v}" for k, v in sorted(self.values.items())]
+        return lines
+
+
+class Histogram:
+    """
+    Гистограмма с фиксированными корзинами, как в Prometheus.
+    Запись - один bisect и два сложения, поэтому инструментирование можно держать всегда включенным.
+    """
+
+    def __init__(self, name: str, help_text: str, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self.series: dict[tuple, list] = {}  # labels -> [counts по корзинам + Inf, sum, count]
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def quantile(self, q: float, **labels) -> float | None:
+        """Оценка квантиля линейной интерполяцией внутри корзины."""
+        series = self.series.get(tuple(sorted(labels.items())))
+        if not series or not series[2]:
+            return None
+        rank = q * series[2]
+        cumulative = 0
+        for i, count in enumerate(series[0]):
+            if cumulative + count >= rank and count:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.buckets[-1]
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total, count) in sorted(self.series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_labels_text(key + (('le', bound),))} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels_text(key)} {total}")
+            lines.append(f"{self.name}_count{_labels_text(key)} {count}")
+        return lines
+
+
+class Gauge:
+    """Значение вычисляется функцией в момент чтения метрик."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, fn):
+        self.name = name
+        self.help_text = help_text
+        self.fn = fn
+
+    def render(self) -> list[str]:
+        try:
+            value = self.fn()
+        except Exception as e:
+            logger.warning(f"Не удалось вычислить метрику {self.name}: {e}")
+            return []
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}", f"{self.name} {value}"]
+
+
+class CounterFunc(Gauge):
+    """Счетчик, который ведет сам компонент (например, BrowserManager.hibernated_total): значение читается функцией."""
+
+    kind = "counter"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: list = []
+
+    def counter(self, name: str, help_text: str) -> Counter:
+        metric = Counter(name, help_text)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help_text: str, buckets=DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, help_text, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(self, name: str, help_text: str, fn) -> Gauge:
+        metric = Gauge(name, help_text, fn)
+        self.metrics.append(metric)
+        return metric
+
+    def counter_fn(self, name: str, help_text: str, fn) -> CounterFunc:
+        metric = CounterFunc(name, help_text, fn)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+async def start_metrics_server(registry: Registry, host: str, port: int) -> asyncio.AbstractServer:
+    """Минимальный HTTP-сервер, отдающий метрики в текстовом формате Prometheus на /metrics."""
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            # Заголовки запроса не нужны, но их надо дочитать
+            while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.decode(errors="replace").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                status, body = "200 OK", registry.render().encode()
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except Exception as e:
+            logger.debug(f"Ошибка обработки запроса метрик: {e}")
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    logger.info(f"Метрики доступны на http://{host}:{port}/metrics")
+    return server
+
+# --- END OF FILE metrics.py ---
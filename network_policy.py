@@ -0,0 +1,123 @@
+# --- START OF FILE network_policy.py ---
+import logging
+from dataclasses import dataclass, field
+from urllib.parse import urlsplit
+
+from playwright.async_api import BrowserContext, Request, Response, Route
+
+logger = logging.getLogger(__name__)
+
+# Хосты телеметрии: запросы к ним (любым методом) подменяются пустым ответом
+DEFAULT_STUB_HOSTS = ("crashlogs.whatsapp.net", "dit.whatsapp.net")
+# Хосты медиа: аватары, превью и вложения чатов. Блокируются только GET-запросы,
+# загрузка наших файлов (POST на mmg.whatsapp.net) проходит
+DEFAULT_MEDIA_HOSTS = ("pps.whatsapp.net", "mmg.whatsapp.net", ".cdn.whatsapp.net")
+# Типичные размеры ответов для оценки сэкономленного трафика, пока нет собственной статистики
+_TYPICAL_SIZES = {"image": 15_000, "media": 150_000, "font": 40_000}
+
+
+@dataclass
+class NetworkStats:
+    """Счетчики трафика одного аккаунта."""
+    allowed_requests: int = 0
+    allowed_bytes: int = 0  # по Content-Length: оценка снизу
+    blocked_requests: int = 0
+    blocked_bytes_estimate: int = 0
+    blocked_by_type: dict[str, int] = field(default_factory=dict)
+
+    def summary(self) -> str:
+        return (
+            f"разрешено {self.allowed_requests} запросов (не меньше {self.allowed_bytes / 1024 / 1024:.1f} МБ), "
+            f"заблокировано {self.blocked_requests} (~{self.blocked_bytes_estimate / 1024 / 1024:.1f} МБ)"
+        )
+
+
+def _host_matches(host: str, patterns) -> bool:
+    return any(host == p or (p.startswith(".") and host.endswith(p)) or host.endswith("." + p) for p in patterns)
+
+
+class NetworkPolicy:
+    """
+    Фильтрация сетевых запросов WhatsApp Web на уровне BrowserContext.
+
+    Изображения, медиа и шрифты (GET) не загружаются, телеметрия подменяется пустым ответом.
+    Документ, скрипты, стили, XHR/fetch и WebSocket проходят всегда, поэтому вход по QR-коду
+    (он рисуется на canvas) и отправка продолжают работать.
+
+    Цена фильтра: пока в контексте включен перехват запросов, Chromium не использует HTTP-кэш,
+    и каждая перезагрузка WhatsApp Web заново скачивает приложение; каждый запрос проходит через Python.
+    Запросы, которые обслуживает Service Worker WhatsApp, перехват не видит вовсе. Поэтому фильтр
+    включается только явно. Объем разрешенного трафика считается по Content-Length и занижен
+    для ответов без этого заголовка (сжатых, chunked).
+    """
+
+    def __init__(self, enabled: bool = False, block_types=("image", "media", "font"),
+                 stub_hosts=DEFAULT_STUB_HOSTS, media_hosts=DEFAULT_MEDIA_HOSTS, allow_hosts=()):
+        self.enabled = enabled
+        self.block_types = set(block_types)
+        self.stub_hosts = tuple(stub_hosts)
+        self.media_hosts = tuple(media_hosts)
+        self.allow_hosts = tuple(allow_hosts)
+        self.stats: dict[int, NetworkStats] = {}
+        self._type_sizes: dict[str, tuple[int, int]] = {}  # тип -> (сумма байт, количество)
+
+    async def install(self, context: BrowserContext, user_id: int) -> None:
+        """Подключает фильтр к контексту пользователя. Вызывается при создании контекста."""
+        if not self.enabled:
+            return
+        stats = self.stats.setdefault(user_id, NetworkStats())
+
+        async def handle(route: Route, request: Request) -> None:
+            action = self.decide(request)
+            if action == "continue":
+                await route.continue_()
+                return
+            stats.blocked_requests += 1
+            stats.blocked_by_type[request.resource_type] = stats.blocked_by_type.get(request.resource_type, 0) + 1
+            stats.blocked_bytes_estimate += self._estimate_size(request.resource_type)
+            if action == "stub":
+                await route.fulfill(status=204, body=b"")
+            else:
+                await route.abort("blockedbyclient")
+
+        def on_response(response: Response) -> None:
+            if response.from_service_worker:
+                return
+            size = int(response.headers.get("content-length") or 0)
+            stats.allowed_requests += 1
+            stats.allowed_bytes += size
+            resource_type = response.request.resource_type
+            if size and resource_type in self.block_types:
+                total, count = self._type_sizes.get(resource_type, (0, 0))
+                self._type_sizes[resource_type] = (total + size, count + 1)
+
+        await context.route("**/*", handle)
+        context.on("response", on_response)
+
+    def decide(self, request: Request) -> str:
+        """Возвращает "continue", "stub" или "abort"."""
+        host = urlsplit(request.url).hostname or ""
+        if _host_matches(host, self.allow_hosts):
+            return "continue"
+        if _host_matches(host, self.stub_hosts):
+            return "stub"
+        if request.method != "GET":
+            return "continue"
+        if request.resource_type in self.block_types or _host_matches(host, self.media_hosts):
+            return "abort"
+        return "continue"
+
+    def _estimate_size(self, resource_type: str) -> int:
+        total, count = self._type_sizes.get(resource_type, (0, 0))
+        return total // count if count else _TYPICAL_SIZES.get(resource_type, 0)
+
+    def totals(self) -> NetworkStats:
+        result = NetworkStats()
+        for stats in self.stats.values():
+            result.allowed_requests += stats.allowed_requests
+            result.allowed_bytes += stats.allowed_bytes
+            result.blocked_requests += stats.blocked_requests
+            result.blocked_bytes_estimate += stats.blocked_bytes_estimate
+        return result
+
+# --- END OF FILE network_policy.py ---
@@ -0,0 +1,150 @@
+# --- START OF FILE outbox.py ---
+import logging
+import sqlite3
+import time
+from dataclasses import dataclass
+
+logger = logging.getLogger(__name__)
+
+# Состояния записи исходящей отправки
+QUEUED = "queued"        # ждет в очереди (или повтора после временной ошибки)
+SENDING = "sending"      # нажата кнопка "Отправить": повторять уже нельзя, сообщение могло уйти
+SENT = "sent"            # сообщение ушло, доставка не подтверждена
+DELIVERED = "delivered"
+FAILED = "failed"
+
+FINISHED = (SENT, DELIVERED, FAILED)
+
+
+@dataclass
+class OutboxEntry:
+    id: int
+    user_id: int
+    chat_id: int
+    message_id: int
+    chat_name: str
+    message_text: str | None
+    file_id: str | None
+    file_name: str | None
+    status: str
+    attempts: int
+    error: str | None
+    updated_at: float
+
+
+_COLUMNS = "id, user_id, chat_id, message_id, chat_name, message_text, file_id, file_name, status, attempts, error, updated_at"
+
+
+class Outbox:
+    """
+    Журнал отправок в SQLite, ключ - команда Telegram (chat_id, message_id). Для заданий
+    планировщика вместо message_id записывается минус номер задания.
+
+    Повторно доставленный Telegram апдейт или перезапуск бота не приводят к повторной отправке:
+    запись создается один раз, а после запуска ожидавшие отправки ставятся в очередь снова.
+    Отправка, прерванная после нажатия "Отправить", не повторяется - она помечается как неудачная
+    с просьбой проверить чат. Каждая смена состояния - одна короткая транзакция в WAL без fsync.
+    """
+
+    def __init__(self, db_path: str):
+        self._db = sqlite3.connect(db_path)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            """CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                chat_id INTEGER NOT NULL,
+                message_id INTEGER NOT NULL,
+                chat_name TEXT NOT NULL,
+                message_text TEXT,
+                file_id TEXT,
+                file_name TEXT,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                UNIQUE (chat_id, message_id)
+            )"""
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS outbox_status ON outbox (status)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS outbox_user ON outbox (user_id, id)")
+        self._db.commit()
+
+    def close(self) -> None:
+        self._db.close()
+
+    def add(self, user_id: int, chat_id: int, message_id: int, chat_name: str, message_text: str | None = None,
+            file_id: str | None = None, file_name: str | None = None) -> tuple[OutboxEntry, bool]:
+        """Создает запись для команды. Возвращает (запись, создана ли она сейчас); для повтора команды - существующую."""
+        existing = self._find(chat_id, message_id)
+        if existing:
+            return existing, False
+        now = time.time()
+        with self._db:
+            # OR IGNORE - на случай, если ту же команду одновременно записал другой процесс
+            cur = self._db.execute(
+                "INSERT OR IGNORE INTO outbox (user_id, chat_id, message_id, chat_name, message_text, file_id, file_name, "
+                "status, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (user_id, chat_id, message_id, chat_name, message_text, file_id, file_name, QUEUED, now, now),
+            )
+        if cur.rowcount:
+            return self.get(cur.lastrowid), True
+        return self._find(chat_id, message_id), False
+
+    def _find(self, chat_id: int, message_id: int) -> OutboxEntry | None:
+        row = self._db.execute(
+            f"SELECT {_COLUMNS} FROM outbox WHERE chat_id = ? AND message_id = ?", (chat_id, message_id),
+        ).fetchone()
+        return OutboxEntry(*row) if row else None
+
+    def get(self, entry_id: int) -> OutboxEntry | None:
+        row = self._db.execute(f"SELECT {_COLUMNS} FROM outbox WHERE id = ?", (entry_id,)).fetchone()
+        return OutboxEntry(*row) if row else None
+
+    def recent(self, user_id: int, limit: int = 5) -> list[OutboxEntry]:
+        rows = self._db.execute(
+            f"SELECT {_COLUMNS} FROM outbox WHERE user_id = ? ORDER BY id DESC LIMIT ?", (user_id, limit),
+        ).fetchall()
+        return [OutboxEntry(*row) for row in rows]
+
+    def start_attempt(self, entry_id: int) -> int:
+        """Отмечает начало очередной попытки. Возвращает ее номер."""
+        with self._db:
+            self._db.execute(
+                "UPDATE outbox SET attempts = attempts + 1, updated_at = ? WHERE id = ?", (time.time(), entry_id),
+            )
+        return self._db.execute("SELECT attempts FROM outbox WHERE id = ?", (entry_id,)).fetchone()[0]
+
+    def set_status(self, entry_id: int, status: str, error: str | None = None) -> None:
+        with self._db:
+            self._db.execute(
+                "UPDATE outbox SET status = ?, error = ?, updated_at = ? WHERE id = ?",
+                (status, error, time.time(), entry_id),
+            )
+
+    def recover(self, owns=None, keep_days: int = 30) -> tuple[list[OutboxEntry], list[OutboxEntry]]:
+        """
+        После перезапуска возвращает (ожидающие отправки, прерванные после нажатия "Отправить").
+        Прерванные помечаются неудачными; записи старше keep_days дней удаляются.
+        В режиме нескольких процессов каждый обрабатывает только своих пользователей.
+        """
+        owns = owns or (lambda user_id: True)
+        with self._db:
+            if keep_days:
+                self._db.execute(
+                    f"DELETE FROM outbox WHERE status IN ({', '.join('?' * len(FINISHED))}) AND updated_at < ?",
+                    (*FINISHED, time.time() - keep_days * 86400),
+                )
+        rows = self._db.execute(
+            f"SELECT {_COLUMNS} FROM outbox WHERE status IN (?, ?) ORDER BY id", (QUEUED, SENDING),
+        ).fetchall()
+        entries = [OutboxEntry(*row) for row in rows if owns(row[1])]
+        queued = [entry for entry in entries if entry.status == QUEUED]
+        interrupted = [entry for entry in entries if entry.status == SENDING]
+        for entry in interrupted:
+            self.set_status(entry.id, FAILED, "бот остановился во время отправки")
+        return queued, interrupted
+
+# --- END OF FILE outbox.py ---
@@ -0,0 +1,99 @@
+# --- START OF FILE pacing.py ---
+import asyncio
+import logging
+import random
+import time
+from dataclasses import dataclass, field
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class _Bucket:
+    tokens: float
+    updated_at: float = field(default_factory=time.monotonic)
+    slowdown: float = 1.0  # во сколько раз сейчас замедлено пополнение из-за признаков ограничений
+
+
+class Pacer:
+    """
+    Темп отправки для каждого аккаунта WhatsApp (token bucket).
+
+    Подряд можно отправить до burst сообщений, дальше - не чаще per_minute в минуту. Ожидание
+    случайно растягивается на долю jitter, чтобы интервалы не были одинаковыми. Если WhatsApp
+    показывает признаки ограничений (report с сигналом), пополнение замедляется вдвое, вплоть
+    до max_slowdown раз, а после каждой спокойной отправки постепенно возвращается к норме.
+    Отправки одного аккаунта выполняются последовательно воркером очереди, поэтому блокировки не нужны.
+    """
+
+    def __init__(self, burst: int = 3, per_minute: float = 6.0, jitter: float = 0.3,
+                 max_slowdown: float = 8.0, recovery: float = 0.8):
+        self._burst = max(1, burst)
+        self._rate = per_minute / 60.0  # 0 - без ограничений
+        self._jitter = jitter
+        self._max_slowdown = max(1.0, max_slowdown)
+        self._recovery = recovery
+        self._buckets: dict[int, _Bucket] = {}
+
+        self.waited_seconds = 0.0
+        self.signals: dict[str, int] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self._rate > 0
+
+    def _refill(self, user_id: int) -> _Bucket:
+        now = time.monotonic()
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = self._buckets[user_id] = _Bucket(tokens=float(self._burst), updated_at=now)
+        else:
+            rate = self._rate / bucket.slowdown
+            bucket.tokens = min(float(self._burst), bucket.tokens + (now - bucket.updated_at) * rate)
+            bucket.updated_at = now
+        return bucket
+
+    def delay(self, user_id: int) -> float:
+        """Сколько секунд (без случайной добавки) ждать следующей отправки аккаунта."""
+        if not self.enabled:
+            return 0.0
+        bucket = self._refill(user_id)
+        if bucket.tokens >= 1:
+            return 0.0
+        return (1 - bucket.tokens) / (self._rate / bucket.slowdown)
+
+    async def acquire(self, user_id: int) -> float:
+        """Дожидается разрешения на отправку и расходует его. Возвращает время ожидания в секундах."""
+        wait = self.delay(user_id)
+        if wait > 0:
+            wait *= random.uniform(1.0, 1.0 + self._jitter)
+            await asyncio.sleep(wait)
+            self.waited_seconds += wait
+            self._refill(user_id)
+        if self.enabled:
+            bucket = self._buckets[user_id]
+            # После ожидания с добавкой токенов может быть чуть больше 1; отрицательным баланс не становится
+            bucket.tokens = max(0.0, bucket.tokens - 1)
+        return wait
+
+    def report(self, user_id: int, signal: str | None) -> None:
+        """Результат отправки: signal - признак ограничений со стороны WhatsApp или None, если все спокойно."""
+        if not self.enabled:
+            return
+        bucket = self._refill(user_id)
+        if signal is None:
+            slowdown = bucket.slowdown * self._recovery
+            bucket.slowdown = slowdown if slowdown > 1.05 else 1.0
+            return
+        self.signals[signal] = self.signals.get(signal, 0) + 1
+        bucket.slowdown = min(self._max_slowdown, bucket.slowdown * 2)
+        # Запас на серию отправок сгорает: следующая отправка ждет полный (уже увеличенный) интервал
+        bucket.tokens = 0.0
+        logger.warning(f"Признак ограничений WhatsApp у пользователя {user_id} ({signal}): "
+                       f"темп отправки замедлен в {bucket.slowdown:.0f} раз.")
+
+    def slowed_down(self) -> int:
+        """Количество аккаунтов, темп которых сейчас снижен."""
+        return sum(1 for bucket in self._buckets.values() if bucket.slowdown > 1.0)
+
+# --- END OF FILE pacing.py ---
@@ -0,0 +1,126 @@
+# --- START OF FILE proc_utils.py ---
+import os
+import signal
+
+# Работает только на Linux (через /proc). На других системах функции возвращают пустые значения,
+# и ограничения по памяти просто не применяются.
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def _parent_map() -> dict[int, int]:
+    parents = {}
+    if not os.path.isdir("/proc"):
+        return parents
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat", "rb") as f:
+                stat = f.read()
+            # Имя процесса в скобках может содержать пробелы, поэтому разбираем после последней ')'
+            fields = stat[stat.rindex(b")") + 2:].split()
+            parents[int(entry)] = int(fields[1])
+        except (OSError, ValueError):
+            continue
+    return parents
+
+
+def descendant_pids(root: int | None = None) -> list[int]:
+    """Все потомки процесса (по умолчанию - текущего): драйвер Playwright и процессы Chromium."""
+    root = root or os.getpid()
+    children: dict[int, list[int]] = {}
+    for pid, ppid in _parent_map().items():
+        children.setdefault(ppid, []).append(pid)
+    result, stack = [], [root]
+    while stack:
+        for child in children.get(stack.pop(), []):
+            result.append(child)
+            stack.append(child)
+    return result
+
+
+def rss_bytes(pid: int) -> int:
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def cmdline(pid: int) -> str:
+    try:
+        with open(f"/proc/{pid}/cmdline", "rb") as f:
+            return f.read().replace(b"\0", b" ").decode(errors="replace")
+    except OSError:
+        return ""
+
+
+def children_rss_mb(root: int | None = None) -> float:
+    """Суммарный RSS всех дочерних процессов (драйвер + Chromium) в мегабайтах."""
+    return sum(rss_bytes(pid) for pid in descendant_pids(root)) / 1024 / 1024
+
+
+def environ_value(pid: int, name: str) -> str | None:
+    """Значение переменной окружения, с которой был запущен процесс (только процессы того же пользователя)."""
+    try:
+        with open(f"/proc/{pid}/environ", "rb") as f:
+            environ = f.read()
+    except OSError:
+        return None
+    prefix = name.encode() + b"="
+    for item in environ.split(b"\0"):
+        if item.startswith(prefix):
+            return item[len(prefix):].decode(errors="replace")
+    return None
+
+
+def _has_live_owner(pid: int, parents: dict[int, int]) -> bool:
+    """Есть ли среди предков процесса живой интерпретатор Python (кроме init и subreaper-ов без python)."""
+    seen = set()
+    pid = parents.get(pid, 0)
+    while pid > 1 and pid not in seen:
+        seen.add(pid)
+        if "python" in os.path.basename(cmdline(pid).split(" ", 1)[0]):
+            return True
+        pid = parents.get(pid, 0)
+    return False
+
+
+def kill_orphans(name: str, match) -> list[int]:
+    """
+    Завершает осиротевшие процессы, помеченные переменной окружения name, значение которой
+    удовлетворяет match(value). Процессы, у которых еще жив процесс-владелец на Python
+    (другой экземпляр бота), и потомки текущего процесса не трогаются. Возвращает список pid.
+    """
+    parents = _parent_map()
+    own = set(descendant_pids()) | {os.getpid()}
+    killed = []
+    for pid in parents:
+        if pid in own:
+            continue
+        value = environ_value(pid, name)
+        if value is None or not match(value) or _has_live_owner(pid, parents):
+            continue
+        try:
+            os.kill(pid, signal.SIGKILL)
+            killed.append(pid)
+        except OSError:
+            continue
+    return killed
+
+
+def kill_descendants(name: str) -> list[int]:
+    """Завершает еще живых потомков текущего процесса, помеченных переменной окружения name."""
+    killed = []
+    for pid in descendant_pids():
+        if environ_value(pid, name) is None:
+            continue
+        try:
+            os.kill(pid, signal.SIGKILL)
+            killed.append(pid)
+        except OSError:
+            continue
+    return killed
+
+# --- END OF FILE proc_utils.py ---
@@ -0,0 +1,129 @@
+# --- START OF FILE profile_store.py ---
+import json
+import logging
+import os
+import shutil
+import time
+
+logger = logging.getLogger(__name__)
+
+# Подкаталоги профиля Chromium, которые можно удалять без потери сессии: HTTP-кэш и кэши шейдеров.
+# IndexedDB, Local Storage и Service Worker (из них WhatsApp Web загружается без синхронизации) не трогаются
+DISPOSABLE_DIRS = ("Cache", "Code Cache", "GPUCache", "DawnCache", "DawnGraphiteCache", "DawnWebGPUCache",
+                   "GrShaderCache", "GraphiteDawnCache", "ShaderCache", "blob_storage")
+
+
+def dir_size(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                continue
+    return total
+
+
+class ProfileStore:
+    """
+    Постоянные профили Chromium (user data dir), по одному каталогу на аккаунт.
+
+    В отличие от JSON storage_state, профиль хранит IndexedDB и кэши service worker, поэтому
+    WhatsApp Web открывается из него за секунды, без повторной синхронизации. Размер профиля
+    ограничивается quota_mb (при превышении после закрытия сессии удаляются кэши), а профили,
+    которые не открывались max_age_days дней, удаляются целиком. В режиме нескольких процессов
+    каталог общий, и каждый процесс удаляет только профили своих пользователей (owns).
+    """
+
+    def __init__(self, root: str, quota_mb: int = 0, max_age_days: int = 0, owns=None):
+        self.root = root
+        self._quota_mb = quota_mb
+        self._max_age_days = max_age_days
+        self._owns = owns or (lambda user_id: True)
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, user_id: int) -> str:
+        return os.path.join(self.root, str(user_id))
+
+    def exists(self, user_id: int) -> bool:
+        return os.path.isdir(os.path.join(self.path(user_id), "Default"))
+
+    def touch(self, user_id: int) -> None:
+        """Отмечает использование профиля: по времени изменения каталога работает очистка старых профилей."""
+        try:
+            os.utime(self.path(user_id))
+        except OSError:
+            pass
+
+    def size_mb(self, user_id: int) -> float:
+        return dir_size(self.path(user_id)) / 1024 / 1024
+
+    def trim(self, user_id: int) -> None:
+        """Удаляет кэши закрытого профиля, если он превысил квоту. Вызывать только для закрытой сессии."""
+        if not self._quota_mb:
+            return
+        size = self.size_mb(user_id)
+        if size <= self._quota_mb:
+            return
+        profile = os.path.join(self.path(user_id), "Default")
+        for name in DISPOSABLE_DIRS:
+            shutil.rmtree(os.path.join(profile, name), ignore_errors=True)
+            shutil.rmtree(os.path.join(self.path(user_id), name), ignore_errors=True)
+        trimmed = self.size_mb(user_id)
+        logger.info(f"Профиль пользователя {user_id}: {size:.0f} МБ -> {trimmed:.0f} МБ после очистки кэшей.")
+        if trimmed > self._quota_mb:
+            logger.warning(f"Профиль пользователя {user_id} занимает {trimmed:.0f} МБ при квоте {self._quota_mb} МБ.")
+
+    def cleanup(self, active_user_ids) -> list[int]:
+        """
+        Удаляет профили своих пользователей, не открывавшиеся дольше max_age_days дней.
+        Открытые сейчас профили не удаляются и заодно отмечаются как используемые: сессия может жить дольше срока.
+        """
+        if not self._max_age_days:
+            return []
+        for user_id in active_user_ids:
+            self.touch(user_id)
+        expire_before = time.time() - self._max_age_days * 86400
+        removed = []
+        for name in os.listdir(self.root):
+            if not name.isdigit() or int(name) in active_user_ids or not self._owns(int(name)):
+                continue
+            path = os.path.join(self.root, name)
+            try:
+                if os.path.getmtime(path) >= expire_before:
+                    continue
+            except OSError:
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            removed.append(int(name))
+        if removed:
+            logger.info(f"Удалены неиспользуемые профили браузера: {len(removed)}.")
+        return removed
+
+    @staticmethod
+    def seed_script(storage_state_path: str) -> tuple[list, str | None]:
+        """
+        Перенос данных из JSON storage_state в новый профиль: возвращает cookies и скрипт,
+        который один раз заполняет localStorage нужных источников.
+
+        Сам вход WhatsApp Web хранится в IndexedDB, которой в storage_state нет, поэтому после
+        переноса пользователю нужно заново отсканировать QR-код (/login).
+        """
+        with open(storage_state_path, encoding="utf-8") as f:
+            state = json.load(f)
+        origins = {
+            origin["origin"]: {item["name"]: item["value"] for item in origin.get("localStorage", [])}
+            for origin in state.get("origins", [])
+        }
+        script = None
+        if origins:
+            script = (
+                "(() => { const origins = " + json.dumps(origins) + ";"
+                " const items = origins[location.origin];"
+                " if (!items || localStorage.getItem('__profile_seeded')) return;"
+                " for (const [k, v] of Object.entries(items)) localStorage.setItem(k, v);"
+                " localStorage.setItem('__profile_seeded', '1'); })();"
+            )
+        return state.get("cookies", []), script
+
+# --- END OF FILE profile_store.py ---
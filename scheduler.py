@@ -0,0 +1,265 @@
+# --- START OF FILE scheduler.py ---
+import asyncio
+import datetime
+import heapq
+import logging
+import re
+import sqlite3
+import time
+from dataclasses import dataclass
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ScheduledJob:
+    id: int
+    user_id: int
+    chat_id: int
+    chat_name: str
+    run_at: float
+    message_text: str | None = None
+    file_id: str | None = None
+    file_name: str | None = None
+    status: str = "pending"
+
+
+_JOB_COLUMNS = "id, user_id, chat_id, chat_name, run_at, message_text, file_id, file_name, status"
+
+
+class Scheduler:
+    """
+    Встроенный планировщик отложенных отправок.
+
+    Задания хранятся в SQLite, а в памяти держится только куча (run_at, id),
+    поэтому десятки тысяч ожидающих заданий не требуют опроса базы:
+    единственная задача спит до ближайшего срока и просыпается при добавлении нового задания.
+    """
+
+    def __init__(self, db_path: str, fire_cb, grace_seconds: float = 3600, spread_seconds: float = 1.0, owns=None):
+        self._db_path = db_path
+        self._fire_cb = fire_cb  # async def fire_cb(job: ScheduledJob)
+        # def owns(user_id) -> bool: в режиме нескольких процессов каждый обслуживает только задания своих пользователей
+        self._owns = owns or (lambda user_id: True)
+        self._grace_seconds = grace_seconds
+        self._spread_seconds = spread_seconds
+
+        self._db: sqlite3.Connection | None = None
+        self._heap: list[tuple[float, int]] = []
+        self._cancelled: set[int] = set()
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._last_fire = 0.0
+
+    # --- Хранилище ---
+
+    def _connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self._db_path)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute(
+            """CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                chat_id INTEGER NOT NULL,
+                chat_name TEXT NOT NULL,
+                run_at REAL NOT NULL,
+                message_text TEXT,
+                file_id TEXT,
+                file_name TEXT,
+                status TEXT NOT NULL DEFAULT 'pending',
+                created_at REAL NOT NULL
+            )"""
+        )
+        db.execute("CREATE INDEX IF NOT EXISTS jobs_status_run_at ON jobs (status, run_at)")
+        db.execute("CREATE INDEX IF NOT EXISTS jobs_user_status ON jobs (user_id, status)")
+        db.commit()
+        return db
+
+    def _finish(self, job_id: int, status: str) -> None:
+        """Завершает сработавшее задание, если его не отменили, пока выполнялся fire_cb."""
+        cur = self._db.execute("UPDATE jobs SET status = ? WHERE id = ? AND status = 'pending'", (status, job_id))
+        self._db.commit()
+        if not cur.rowcount:
+            # cancel() успел отметить задание, но в куче его уже нет - ленивое удаление не нужно
+            self._cancelled.discard(job_id)
+
+    def _load(self, job_id: int) -> ScheduledJob | None:
+        row = self._db.execute(f"SELECT {_JOB_COLUMNS} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return ScheduledJob(*row) if row else None
+
+    # --- Публичный интерфейс ---
+
+    async def start(self) -> list[ScheduledJob]:
+        """
+        Загружает ожидающие задания и запускает таймер.
+        Задания, просроченные дольше grace_seconds, помечаются как пропущенные и возвращаются вызывающему.
+        Просроченные в пределах окна будут выполнены сразу после старта (с разнесением по времени).
+        """
+        self._db = self._connect()
+        now = time.time()
+        missed = [
+            job for job in (
+                ScheduledJob(*row) for row in self._db.execute(
+                    f"SELECT {_JOB_COLUMNS} FROM jobs WHERE status = 'pending' AND run_at < ?",
+                    (now - self._grace_seconds,),
+                )
+            ) if self._owns(job.user_id)
+        ]
+        if missed:
+            self._db.executemany("UPDATE jobs SET status = 'missed' WHERE id = ?", [(j.id,) for j in missed])
+            self._db.commit()
+
+        self._heap = [
+            (run_at, job_id) for job_id, run_at, user_id in
+            self._db.execute("SELECT id, run_at, user_id FROM jobs WHERE status = 'pending'")
+            if self._owns(user_id)
+        ]
+        heapq.heapify(self._heap)
+        logger.info(f"Планировщик: загружено {len(self._heap)} заданий, пропущено {len(missed)}.")
+
+        self._task = asyncio.create_task(self._run())
+        return missed
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._db:
+            self._db.close()
+            self._db = None
+
+    def add(self, user_id: int, chat_id: int, chat_name: str, run_at: float,
+            message_text: str | None = None, file_id: str | None = None, file_name: str | None = None) -> int:
+        cur = self._db.execute(
+            "INSERT INTO jobs (user_id, chat_id, chat_name, run_at, message_text, file_id, file_name, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (user_id, chat_id, chat_name, run_at, message_text, file_id, file_name, time.time()),
+        )
+        self._db.commit()
+        heapq.heappush(self._heap, (run_at, cur.lastrowid))
+        self._wakeup.set()
+        return cur.lastrowid
+
+    def cancel(self, user_id: int, job_id: int) -> bool:
+        cur = self._db.execute(
+            "UPDATE jobs SET status = 'cancelled' WHERE id = ? AND user_id = ? AND status = 'pending'",
+            (job_id, user_id),
+        )
+        self._db.commit()
+        if cur.rowcount:
+            # Из кучи запись удаляется лениво, при извлечении
+            self._cancelled.add(job_id)
+            return True
+        return False
+
+    def list_pending(self, user_id: int, limit: int = 20) -> list[ScheduledJob]:
+        return [
+            ScheduledJob(*row) for row in self._db.execute(
+                f"SELECT {_JOB_COLUMNS} FROM jobs WHERE user_id = ? AND status = 'pending' ORDER BY run_at LIMIT ?",
+                (user_id, limit),
+            )
+        ]
+
+    def pending_count(self) -> int:
+        return len(self._heap) - len(self._cancelled)
+
+    # --- Таймер ---
+
+    async def _sleep(self, timeout: float | None) -> None:
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _run(self) -> None:
+        while True:
+            if not self._heap:
+                await self._sleep(None)
+                continue
+
+            run_at, job_id = self._heap[0]
+            # Задания, наступившие одновременно, выполняются не чаще одного раза в spread_seconds
+            fire_at = max(run_at, self._last_fire + self._spread_seconds)
+            delay = fire_at - time.time()
+            if delay > 0:
+                await self._sleep(delay)
+                continue
+
+            heapq.heappop(self._heap)
+            if job_id in self._cancelled:
+                self._cancelled.discard(job_id)
+                continue
+
+            job = self._load(job_id)
+            if not job or job.status != "pending":
+                continue
+            self._last_fire = time.time()
+            try:
+                await self._fire_cb(job)
+            except Exception as e:
+                logger.error(f"Планировщик: ошибка при запуске задания {job_id}: {e}")
+                self._finish(job_id, "failed")
+                continue
+            # Отмечаем только после передачи задания: если бот остановится раньше, задание сработает
+            # после запуска, а повторную отправку отсекает fire_cb (журнал отправок)
+            self._finish(job_id, "fired")
+
+
+_RELATIVE_RE = re.compile(r"^\+?(\d+)\s*(м|мин|m|min|ч|h|д|d)$", re.IGNORECASE)
+_RELATIVE_UNITS = {"м": 60, "мин": 60, "m": 60, "min": 60, "ч": 3600, "h": 3600, "д": 86400, "d": 86400}
+_ABSOLUTE_FORMATS = ("%d.%m.%Y %H:%M", "%Y-%m-%d %H:%M", "%d.%m %H:%M", "%H:%M")
+
+
+def _next_date_without_year(text: str, now: datetime.datetime) -> datetime.datetime | None:
+    """
+    "25.12 09:00" -> ближайший такой момент после now. Год подставляется до разбора:
+    без него strptime берет 1900 год, и "29.02" считается несуществующей датой.
+    """
+    for year in range(now.year, now.year + 9):  # 29 февраля бывает раз в 4 года, а в 2100 году - через 8 лет
+        try:
+            parsed = datetime.datetime.strptime(f"{text} {year}", "%d.%m %H:%M %Y").replace(tzinfo=now.tzinfo)
+        except ValueError:
+            continue
+        if parsed > now:
+            return parsed
+    return None
+
+
+def parse_when(text: str, tz: datetime.tzinfo | None = None, now: datetime.datetime | None = None) -> float:
+    """
+    Разбирает время отправки и возвращает unix-время.
+    Поддерживаются "+30m", "+2ч", "18:30", "25.12 09:00", "25.12.2025 09:00" и "2025-12-25 09:00".
+    Время без даты, которое уже прошло сегодня, переносится на завтра.
+    """
+    text = text.strip()
+    now = now or datetime.datetime.now(tz)
+
+    match = _RELATIVE_RE.match(text)
+    if match:
+        return now.timestamp() + int(match.group(1)) * _RELATIVE_UNITS[match.group(2).lower()]
+
+    for fmt in _ABSOLUTE_FORMATS:
+        if fmt == "%d.%m %H:%M":
+            parsed = _next_date_without_year(text, now)
+            if parsed is None:
+                continue
+            return parsed.timestamp()
+        try:
+            parsed = datetime.datetime.strptime(text, fmt)
+        except ValueError:
+            continue
+        if fmt == "%H:%M":
+            parsed = now.replace(hour=parsed.hour, minute=parsed.minute, second=0, microsecond=0, tzinfo=None)
+            if parsed.replace(tzinfo=now.tzinfo) <= now:
+                parsed += datetime.timedelta(days=1)
+        return parsed.replace(tzinfo=now.tzinfo).timestamp()
+
+    raise ValueError(f"Не удалось разобрать время: {text}")
+
+# --- END OF FILE scheduler.py ---
@@ -0,0 +1,114 @@
+# --- START OF FILE send_queue.py ---
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class SendQueue:
+    """
+    Очереди отправки по аккаунтам.
+
+    На каждого пользователя заводится своя asyncio.Queue и ровно один воркер,
+    который последовательно выполняет задания и единолично владеет страницей WhatsApp.
+    Обработчики Telegram только ставят задание в очередь и сразу получают позицию и ETA.
+    """
+
+    def __init__(self, runner, default_job_seconds: float = 20.0, idle_timeout: float = 300.0):
+        self._runner = runner  # async def runner(job)
+        self._default_job_seconds = default_job_seconds
+        self._idle_timeout = idle_timeout
+
+        self._queues: dict[int, asyncio.Queue] = {}
+        self._workers: dict[int, asyncio.Task] = {}
+        self._running: dict[int, float] = {}  # user_id -> время начала текущего задания
+        self._current: dict[int, object] = {}  # user_id -> выполняемое задание
+        self._avg_duration: dict[int, float] = {}
+
+    def avg_job_seconds(self, user_id: int) -> float:
+        return self._avg_duration.get(user_id, self._default_job_seconds)
+
+    def pending(self, user_id: int) -> int:
+        """Количество заданий пользователя: в очереди плюс выполняемое сейчас."""
+        queue = self._queues.get(user_id)
+        return (queue.qsize() if queue else 0) + (1 if user_id in self._running else 0)
+
+    def total_pending(self) -> int:
+        return sum(queue.qsize() for queue in self._queues.values()) + len(self._running)
+
+    def eta(self, user_id: int, ahead: int) -> float:
+        """Оценка времени (сек.) до начала задания, перед которым стоят ahead заданий."""
+        avg = self.avg_job_seconds(user_id)
+        eta = ahead * avg
+        started = self._running.get(user_id)
+        if started is not None:
+            # Текущее задание уже частично выполнено
+            eta -= min(time.monotonic() - started, avg)
+        return max(0.0, eta)
+
+    def enqueue(self, user_id: int, job) -> tuple[int, float]:
+        """Ставит задание в очередь пользователя. Возвращает (позицию, ETA в секундах)."""
+        ahead = self.pending(user_id)
+        queue = self._queues.setdefault(user_id, asyncio.Queue())
+        queue.put_nowait(job)
+
+        worker = self._workers.get(user_id)
+        if worker is None or worker.done():
+            self._workers[user_id] = asyncio.create_task(self._worker(user_id, queue))
+
+        return ahead + 1, self.eta(user_id, ahead)
+
+    async def _worker(self, user_id: int, queue: asyncio.Queue) -> None:
+        logger.info("Запущен воркер очереди отправки для пользователя %s.", user_id)
+        while True:
+            try:
+                job = await asyncio.wait_for(queue.get(), timeout=self._idle_timeout)
+            except asyncio.TimeoutError:
+                if queue.empty():
+                    # Между проверкой и удалением нет await, поэтому enqueue не может вклиниться
+                    self._workers.pop(user_id, None)
+                    self._queues.pop(user_id, None)
+                    logger.info("Воркер очереди отправки пользователя %s остановлен по простою.", user_id)
+                    return
+                continue
+
+            started = self._running[user_id] = time.monotonic()
+            self._current[user_id] = job
+            try:
+                await self._runner(job)
+            except Exception as e:
+                logger.error(f"Необработанная ошибка в задании отправки пользователя {user_id}: {e}")
+            finally:
+                self._running.pop(user_id, None)
+                self._current.pop(user_id, None)
+                duration = time.monotonic() - started
+                prev = self._avg_duration.get(user_id)
+                # Скользящее среднее длительности задания для оценки ETA
+                self._avg_duration[user_id] = duration if prev is None else prev * 0.7 + duration * 0.3
+                queue.task_done()
+
+    async def drain(self, timeout: float) -> tuple[list, list]:
+        """
+        Остановка: ждет не дольше timeout секунд, пока будут выполнены все задания, затем останавливает воркеры.
+        Возвращает (невыполненные задания из очередей, прерванные на середине задания).
+        """
+        if self._queues:
+            logger.info(f"Ожидание завершения заданий отправки: {self.total_pending()}...")
+            try:
+                await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in list(self._queues.values()))), timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"Задания отправки не завершились за {timeout:.0f} сек.")
+
+        abandoned = [queue.get_nowait() for queue in self._queues.values() for _ in range(queue.qsize())]
+        interrupted = list(self._current.values())
+        for worker in self._workers.values():
+            worker.cancel()
+        if self._workers:
+            # Прерванное задание еще сбрасывает страницу в finally, но ждать его бесконечно нельзя
+            await asyncio.wait(list(self._workers.values()), timeout=10)
+        self._workers.clear()
+        self._queues.clear()
+        return abandoned, interrupted
+
+# --- END OF FILE send_queue.py ---
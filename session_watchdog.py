@@ -0,0 +1,150 @@
+# --- START OF FILE session_watchdog.py ---
+import asyncio
+import logging
+
+from browser_manager import BrowserManager, Session, READY, EXPIRED
+
+logger = logging.getLogger(__name__)
+
+# Причина, по которой сессии нужен новый QR-код (ее возвращает check_login)
+NEEDS_QR = "needs_qr"
+# Причины, после которых проверять повторно бессмысленно: сессия пересоздается сразу
+FATAL_REASONS = ("browser", "page_closed", "memory")
+
+
+class SessionWatchdog:
+    """
+    Фоновая проверка живых сессий браузера.
+
+    Раз в interval секунд у каждой свободной загруженной сессии проверяются: подключение к Chromium,
+    отзывчивость страницы, куча JavaScript страницы (max_heap_mb) и состояние входа (check_login).
+    Неисправная сессия закрывается заранее, до следующей отправки, и on_recycled может сразу прогреть
+    ее заново. Медленная страница или неопределенное состояние входа - еще не неисправность: сессия
+    пересоздается (с сохранением состояния) только после failure_threshold неудачных проверок подряд.
+    Если WhatsApp разлогинил пользователя, сессия помечается EXPIRED и вызывается on_needs_qr;
+    повторные уведомления после перезапуска отсекает сам on_needs_qr.
+    """
+
+    def __init__(self, browser_manager: BrowserManager, check_login, on_recycled, on_needs_qr,
+                 interval: float = 120, page_timeout: float = 10, max_heap_mb: int = 0, concurrency: int = 4,
+                 failure_threshold: int = 3):
+        self._browser_manager = browser_manager
+        # async def check_login(page) -> str | None: None - вход в порядке, NEEDS_QR или другая причина пересоздания
+        self._check_login = check_login
+        # def on_recycled(user_id, reason) - исправная до этого сессия закрыта как неисправная
+        self._on_recycled = on_recycled
+        # async def on_needs_qr(user_id) - сессии нужен новый QR-код
+        self._on_needs_qr = on_needs_qr
+        self._interval = interval
+        self._page_timeout = page_timeout
+        self._max_heap_mb = max_heap_mb
+        self._failure_threshold = max(1, failure_threshold)
+        self._failures: dict[int, int] = {}  # user_id -> неудачных проверок подряд
+        self._semaphore = asyncio.Semaphore(max(1, concurrency))
+        self._notified: set[int] = set()
+        self._task: asyncio.Task | None = None
+
+        self.checks = 0
+        self.recycled: dict[str, int] = {}
+
+    def start(self) -> None:
+        if self._task is None and self._interval > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self._interval)
+            try:
+                await self.check_all()
+            except Exception as e:
+                logger.error(f"Ошибка проверки сессий браузера: {e}")
+
+    async def check_all(self) -> None:
+        sessions = [s for s in self._browser_manager.sessions.values() if s.state in (READY, EXPIRED)]
+        await asyncio.gather(*(self._check_guarded(session) for session in sessions))
+
+    async def _check_guarded(self, session: Session) -> None:
+        async with self._semaphore:
+            if self._browser_manager.busy(session.user_id):
+                return  # идет отправка или вход - проверим в следующий раз
+            try:
+                await self._check(session)
+            except Exception as e:
+                logger.warning(f"Не удалось проверить сессию пользователя {session.user_id}: {e}")
+
+    async def _check(self, session: Session) -> None:
+        user_id = session.user_id
+        self.checks += 1
+        if session.state == EXPIRED:
+            await self._expired(session)
+            return
+
+        reason = await self._diagnose(session)
+        if self._browser_manager.sessions.get(user_id) is not session:
+            return  # сессию усыпили или пересоздали во время проверки - ошибки относятся к закрытому контексту
+        if reason is None:
+            self._notified.discard(user_id)
+            self._failures.pop(user_id, None)
+            return
+        if reason == NEEDS_QR:
+            self._failures.pop(user_id, None)
+            session.state = EXPIRED
+            await self._expired(session)
+            return
+
+        if reason not in FATAL_REASONS:
+            failures = self._failures[user_id] = self._failures.get(user_id, 0) + 1
+            if failures < self._failure_threshold:
+                logger.info(f"Сессия пользователя {user_id}: проверка не удалась ({reason}), {failures} из {self._failure_threshold}.")
+                return
+        self._failures.pop(user_id, None)
+        logger.warning(f"Сессия пользователя {user_id} неисправна ({reason}), пересоздаю.")
+        # Состояние входа сохраняется заранее: медленная страница могла быть вполне рабочей
+        if await self._browser_manager.recycle(user_id, save=reason not in ("browser", "page_closed")):
+            self.recycled[reason] = self.recycled.get(reason, 0) + 1
+            self._on_recycled(user_id, reason)
+
+    async def _diagnose(self, session: Session) -> str | None:
+        """Возвращает причину пересоздания сессии, NEEDS_QR или None, если сессия исправна."""
+        if not session.connected():
+            return "browser"
+        page = session.page
+        if page is None or page.is_closed():
+            return "page_closed"
+        try:
+            await asyncio.wait_for(page.evaluate("1"), self._page_timeout)
+        except Exception:
+            return "unresponsive"
+
+        if self._max_heap_mb:
+            cdp = await session.context.new_cdp_session(page)
+            try:
+                heap = await asyncio.wait_for(cdp.send("Runtime.getHeapUsage"), self._page_timeout)
+            finally:
+                await cdp.detach()
+            heap_mb = heap["usedSize"] / 1024 / 1024
+            if heap_mb > self._max_heap_mb:
+                logger.info(f"Страница пользователя {session.user_id} занимает {heap_mb:.0f} МБ при лимите {self._max_heap_mb} МБ.")
+                return "memory"
+
+        return await self._check_login(page)
+
+    async def _expired(self, session: Session) -> None:
+        user_id = session.user_id
+        if user_id not in self._notified:
+            self._notified.add(user_id)
+            logger.info(f"Сессии пользователя {user_id} нужен новый QR-код.")
+            try:
+                await self._on_needs_qr(user_id)
+            except Exception as e:
+                logger.warning(f"Не удалось уведомить пользователя {user_id} о завершении сессии: {e}")
+        # Разлогиненный контекст только занимает память: /login создаст его заново
+        await self._browser_manager.recycle(user_id, save=False)
+
+# --- END OF FILE session_watchdog.py ---
@@ -0,0 +1,212 @@
+# --- START OF FILE sqlite_persistence.py ---
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+logger = logging.getLogger(__name__)
+
+# Живые объекты Playwright нельзя сохранять: после перезапуска они бессмысленны. Сейчас они живут
+# в BrowserManager, а не в user_data, но ключи из старых версий бота отсекаются на всякий случай
+NON_PERSISTENT_KEYS = frozenset({"browser", "playwright_context", "whatsapp_page"})
+
+
+class SqlitePersistence(BasePersistence):
+    """
+    Хранение user_data в SQLite с отложенной записью.
+
+    Application сам копит изменения и раз в update_interval секунд передает данные пользователей,
+    которые отправляли команды. Здесь каждое значение сравнивается с уже записанным, и в базу
+    одной транзакцией в отдельном потоке уходят только изменившиеся ключи, поэтому обработка команд
+    не ждет диска. Записанные и ожидающие записи значения сгруппированы по пользователю, так что
+    сравнение стоит пропорционально ключам одного пользователя, а не всех.
+    Значения хранятся в JSON; то, что в JSON не сериализуется, не сохраняется.
+    bot_data, chat_data и callback_data не сохраняются: в bot_data лежат задачи и серверы текущего процесса.
+    """
+
+    __slots__ = ("_db_path", "_owns", "_db", "_saved", "_dirty", "_writer", "_write_lock", "_skipped")
+
+    def __init__(self, db_path: str, update_interval: float = 5.0, owns=None):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self._db_path = db_path
+        # def owns(user_id) -> bool: в режиме нескольких процессов каждый загружает только своих пользователей
+        self._owns = owns or (lambda user_id: True)
+        self._db: sqlite3.Connection | None = None
+        self._saved: dict[int, dict[str, str]] = {}  # пользователь -> ключ -> записанный JSON
+        self._dirty: dict[int, dict[str, str | None]] = {}  # None - ключ удален
+        self._writer: asyncio.Task | None = None
+        self._write_lock = asyncio.Lock()
+        self._skipped: set[tuple[int, str]] = set()  # о несериализуемых ключах предупреждаем один раз
+
+    # --- Хранилище ---
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            # Запись идет из потока asyncio.to_thread, но всегда под _write_lock - по одной за раз
+            db = sqlite3.connect(self._db_path, check_same_thread=False, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute(
+                """CREATE TABLE IF NOT EXISTS user_data (
+                    user_id INTEGER NOT NULL,
+                    key TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (user_id, key)
+                )"""
+            )
+            db.commit()
+            self._db = db
+        return self._db
+
+    def _write(self, changes: dict[int, dict[str, str | None]]) -> None:
+        db = self._connect()
+        now = time.time()
+        items = [(user_id, key, value) for user_id, keys in changes.items() for key, value in keys.items()]
+        with db:
+            db.executemany(
+                "INSERT INTO user_data (user_id, key, value, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (user_id, key) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at",
+                [(user_id, key, value, now) for user_id, key, value in items if value is not None],
+            )
+            db.executemany(
+                "DELETE FROM user_data WHERE user_id = ? AND key = ?",
+                [(user_id, key) for user_id, key, value in items if value is None],
+            )
+
+    async def _write_dirty(self) -> None:
+        async with self._write_lock:
+            while self._dirty:
+                changes, self._dirty = self._dirty, {}
+                try:
+                    await asyncio.to_thread(self._write, changes)
+                except Exception as e:
+                    logger.error(f"Не удалось сохранить данные пользователей ({len(changes)}): {e}")
+                    # Вернем несохраненное в очередь, не затирая более свежие изменения
+                    for user_id, keys in changes.items():
+                        dirty = self._dirty.setdefault(user_id, {})
+                        for key, value in keys.items():
+                            dirty.setdefault(key, value)
+                    return
+                for user_id, keys in changes.items():
+                    saved = self._saved.setdefault(user_id, {})
+                    for key, value in keys.items():
+                        if value is None:
+                            saved.pop(key, None)
+                        else:
+                            saved[key] = value
+                    if not saved:
+                        del self._saved[user_id]
+
+    def _schedule_write(self) -> None:
+        # Application передает всех пользователей одного цикла сохранения разом через gather,
+        # поэтому задача записи стартует после них и пишет их изменения одной транзакцией
+        if self._dirty and (self._writer is None or self._writer.done()):
+            self._writer = asyncio.create_task(self._write_dirty())
+
+    # --- user_data ---
+
+    async def get_user_data(self) -> dict[int, dict]:
+        rows = await asyncio.to_thread(
+            lambda: self._connect().execute("SELECT user_id, key, value FROM user_data").fetchall()
+        )
+        user_data: dict[int, dict] = {}
+        for user_id, key, value in rows:
+            if not self._owns(user_id):
+                continue
+            try:
+                user_data.setdefault(user_id, {})[key] = json.loads(value)
+            except ValueError:
+                logger.warning(f"Поврежденное значение '{key}' пользователя {user_id} пропущено.")
+                continue
+            self._saved.setdefault(user_id, {})[key] = value
+        logger.info(f"Загружены данные {len(user_data)} пользователей из {self._db_path}.")
+        return user_data
+
+    def _pending(self, user_id: int) -> tuple[dict[str, str], dict[str, str | None]]:
+        return self._saved.get(user_id, {}), self._dirty.get(user_id, {})
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        saved, dirty = self._pending(user_id)
+        changes: dict[str, str | None] = {}
+        present = set()
+        for key, value in data.items():
+            if not isinstance(key, str) or key in NON_PERSISTENT_KEYS:
+                continue
+            item = (user_id, key)
+            try:
+                encoded = json.dumps(value, ensure_ascii=False, sort_keys=True)
+            except (TypeError, ValueError):
+                if item not in self._skipped:
+                    self._skipped.add(item)
+                    logger.warning(f"Значение '{key}' пользователя {user_id} не сериализуется в JSON и не сохраняется.")
+                continue
+            present.add(key)
+            if dirty.get(key, saved.get(key)) != encoded:
+                changes[key] = encoded
+        for key in {*saved, *dirty} - present:
+            if dirty.get(key, saved.get(key)) is not None:
+                changes[key] = None
+        if changes:
+            self._dirty.setdefault(user_id, {}).update(changes)
+        self._schedule_write()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        saved, dirty = self._pending(user_id)
+        if saved or dirty:
+            self._dirty[user_id] = dict.fromkeys({*saved, *dirty})
+        self._schedule_write()
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        pass
+
+    async def flush(self) -> None:
+        if self._writer:
+            await self._writer
+        await self._write_dirty()
+        if self._db:
+            self._db.close()
+            self._db = None
+
+    # --- Не сохраняется ---
+
+    async def get_chat_data(self) -> dict[int, dict]:
+        return {}
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def get_conversations(self, name: str) -> dict:
+        return {}
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        pass
+
+# --- END OF FILE sqlite_persistence.py ---
@@ -0,0 +1,181 @@
+# --- START OF FILE status_reporter.py ---
+import asyncio
+import datetime
+import logging
+import time
+from dataclasses import dataclass, field
+
+from telegram import Message
+from telegram.error import BadRequest, RetryAfter
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class _PendingEdit:
+    message: Message
+    text: str
+    final: bool
+    kwargs: dict = field(default_factory=dict)
+    not_before: float = 0.0  # промежуточный статус не показывается раньше этого момента
+
+
+class StatusReporter:
+    """
+    Обновление статусных сообщений Telegram с объединением и ограничением частоты.
+
+    Для каждого сообщения хранится только последний желаемый текст: промежуточные статусы,
+    которые устарели до отправки, просто отбрасываются. Промежуточный статус показывается не раньше
+    чем через progress_delay секунд после предыдущего изменения сообщения, поэтому быстрая отправка
+    обходится ответом на команду и одним итоговым редактированием. Итоговые статусы (final=True)
+    не откладываются и не теряются.
+
+    Частота вызовов ограничена по чату (chat_interval) и глобально (global_rate в секунду),
+    при RetryAfter чат ставится на паузу на указанное Telegram время.
+    """
+
+    def __init__(self, progress_delay: float = 3.0, chat_interval: float = 1.0, global_rate: float = 25.0):
+        self._progress_delay = progress_delay
+        self._chat_interval = chat_interval
+        self._global_interval = 1.0 / global_rate if global_rate > 0 else 0.0
+
+        self._pending: dict[tuple[int, int], _PendingEdit] = {}
+        self._shown: dict[tuple[int, int], tuple[str, float]] = {}  # текст на экране и время его показа
+        self._chat_ready_at: dict[int, float] = {}
+        self._busy_chats: set[int] = set()
+        self._next_global = 0.0
+        self._wakeup = asyncio.Event()
+        self._worker: asyncio.Task | None = None
+        self._inflight: set[asyncio.Task] = set()
+
+        self.api_calls = 0
+        self.dropped = 0
+        self.retry_after_total = 0
+
+    @staticmethod
+    def _key(message: Message) -> tuple[int, int]:
+        return message.chat_id, message.message_id
+
+    def track(self, message: Message) -> None:
+        """Регистрирует только что отправленное статусное сообщение: это тоже вызов API в чате."""
+        now = time.monotonic()
+        self._shown[self._key(message)] = (message.text, now)
+        self._set_chat_ready(message.chat_id, max(self._chat_ready_at.get(message.chat_id, 0.0), now + self._chat_interval))
+
+    def _set_chat_ready(self, chat_id: int, ready_at: float) -> None:
+        """Запоминает, когда в чате можно следующее изменение; прошедшие сроки забываются, чтобы словарь не рос."""
+        now = time.monotonic()
+        for stale in [chat for chat, at in self._chat_ready_at.items() if at <= now]:
+            del self._chat_ready_at[stale]
+        self._chat_ready_at[chat_id] = ready_at
+
+    def current_text(self, message: Message) -> str | None:
+        """Последний заказанный текст сообщения (еще не показанный или уже на экране)."""
+        key = self._key(message)
+        pending = self._pending.get(key)
+        if pending:
+            return pending.text
+        shown = self._shown.get(key)
+        return shown[0] if shown else message.text
+
+    def update(self, message: Message, text: str, final: bool = False, **kwargs) -> None:
+        """Заказывает новый текст сообщения. Не ждет Telegram: изменение будет отправлено воркером."""
+        key = self._key(message)
+        previous = self._pending.get(key)
+        if previous:
+            if previous.final and not final:
+                return  # итоговый статус не перезаписывается промежуточным
+            self.dropped += 1
+        shown = self._shown.get(key)
+        if shown and shown[0] == text and not previous:
+            return
+        not_before = 0.0 if final else (shown[1] if shown else time.monotonic()) + self._progress_delay
+        self._pending[key] = _PendingEdit(message, text, final, kwargs, not_before)
+
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+        self._wakeup.set()
+
+    def _due_at(self, edit: _PendingEdit) -> float:
+        return max(edit.not_before, self._chat_ready_at.get(edit.message.chat_id, 0.0))
+
+    async def _run(self) -> None:
+        while self._pending:
+            self._wakeup.clear()
+            now = time.monotonic()
+            ready = [
+                (key, edit) for key, edit in self._pending.items()
+                if edit.message.chat_id not in self._busy_chats and self._due_at(edit) <= now
+            ]
+            if not ready:
+                waiting = [self._due_at(e) for e in self._pending.values() if e.message.chat_id not in self._busy_chats]
+                timeout = max(0.0, min(waiting) - now) if waiting else None
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            # Итоговые статусы - в первую очередь
+            ready.sort(key=lambda item: not item[1].final)
+            for key, edit in ready:
+                chat_id = edit.message.chat_id
+                # Несколько сообщений одного чата могли созреть одновременно: после первого
+                # остальные ждут chat_interval и останутся в очереди до следующего круга
+                if chat_id in self._busy_chats or self._due_at(edit) > time.monotonic():
+                    continue
+                delay = self._next_global - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                self._next_global = time.monotonic() + self._global_interval
+                if self._pending.get(key) is not edit:
+                    continue  # пока ждали, текст успел смениться - возьмем новый на следующем круге
+                del self._pending[key]
+                self._busy_chats.add(chat_id)
+                # Интервал отсчитывается от вызова, даже если он завершится ошибкой
+                self._set_chat_ready(chat_id, time.monotonic() + self._chat_interval)
+                task = asyncio.create_task(self._edit(key, edit))
+                self._inflight.add(task)
+                task.add_done_callback(self._inflight.discard)
+
+    async def _edit(self, key: tuple[int, int], edit: _PendingEdit) -> None:
+        chat_id = edit.message.chat_id
+        try:
+            self.api_calls += 1
+            await edit.message.edit_text(edit.text, **edit.kwargs)
+            self._shown[key] = (edit.text, time.monotonic())
+            self._set_chat_ready(chat_id, time.monotonic() + self._chat_interval)
+        except RetryAfter as e:
+            retry_after = e.retry_after
+            seconds = retry_after.total_seconds() if isinstance(retry_after, datetime.timedelta) else float(retry_after)
+            self.retry_after_total += 1
+            logger.warning(f"Telegram просит подождать {seconds:.0f} сек. перед изменением сообщений в чате {chat_id}.")
+            self._set_chat_ready(chat_id, time.monotonic() + seconds)
+            # Повторяем, если за это время не заказали более новый текст
+            self._pending.setdefault(key, edit)
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                logger.warning(f"Не удалось обновить статус в чате {chat_id}: {e}")
+            self._shown[key] = (edit.text, time.monotonic())
+        except Exception as e:
+            logger.warning(f"Не удалось обновить статус в чате {chat_id}: {e}")
+        finally:
+            self._busy_chats.discard(chat_id)
+            if edit.final and key not in self._pending:
+                self._shown.pop(key, None)
+            if self._pending and (self._worker is None or self._worker.done()):
+                self._worker = asyncio.create_task(self._run())
+            self._wakeup.set()
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        """Отбрасывает промежуточные статусы и дожидается отправки итоговых (не дольше timeout секунд)."""
+        for key in [key for key, edit in self._pending.items() if not edit.final]:
+            del self._pending[key]
+        deadline = time.monotonic() + timeout
+        while (self._pending or self._inflight) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if self._worker:
+            self._worker.cancel()
+            self._worker = None
+
+# --- END OF FILE status_reporter.py ---
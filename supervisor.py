@@ -0,0 +1,173 @@
+# --- START OF FILE supervisor.py ---
+import asyncio
+import json
+import logging
+import os
+import sys
+import zlib
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Сколько апдейтов держать для упавшего воркера, пока он перезапускается
+WORKER_BACKLOG_LIMIT = 1000
+
+
+def worker_for(user_id: int, worker_count: int) -> int:
+    """Номер воркера пользователя. crc32 не зависит от PYTHONHASHSEED, поэтому распределение стабильно между запусками."""
+    return zlib.crc32(str(user_id).encode()) % worker_count
+
+
+class Supervisor:
+    """
+    Режим нескольких процессов: супервизор получает апдейты Telegram и раздает их воркерам.
+
+    Каждый воркер - отдельный процесс `bot.py` со своими браузерами, сессиями и очередями отправки.
+    Пользователь всегда попадает в один и тот же воркер (worker_for), поэтому его сессия живет
+    ровно в одном процессе. Апдейты передаются воркеру построчно в JSON через stdin; закрытие stdin
+    означает штатную остановку. Упавший воркер перезапускается с нарастающей паузой, а апдейты
+    для него копятся в очереди. Апдейт удаляется из очереди только после того, как записан в stdin,
+    поэтому при падении воркера или перераспределении порядок апдейтов пользователя сохраняется.
+    """
+
+    def __init__(self, worker_count: int, script_path: str, extra_env=None, stop_timeout: float = 60.0):
+        self.worker_count = worker_count
+        # Сколько ждать штатной остановки воркера: он дожидается начатых отправок и сохраняет сессии
+        self._stop_timeout = stop_timeout
+        self._script_path = script_path
+        # def extra_env(index) -> dict: дополнительные переменные окружения воркера
+        self._extra_env = extra_env or (lambda index: {})
+        self._pending: list[deque] = []  # по воркеру: (user_id, строка) в порядке поступления
+        self._ready: list[asyncio.Event] = []
+        self._held: list[tuple[int, str]] = []  # апдейты, пришедшие во время перераспределения
+        self._resizing = False
+        self._tasks: list[asyncio.Task] = []
+        self._feeders: dict[int, asyncio.Task] = {}
+        self._processes: dict[int, asyncio.subprocess.Process] = {}
+        self._stopping = False
+        self.restarts = 0
+
+    def start(self) -> None:
+        self._stopping = False
+        self._pending = [deque() for _ in range(self.worker_count)]
+        self._ready = [asyncio.Event() for _ in range(self.worker_count)]
+        self._tasks = [asyncio.create_task(self._run_worker(i)) for i in range(self.worker_count)]
+        logger.info(f"Супервизор: запущено воркеров: {self.worker_count}.")
+
+    def route(self, user_id: int, update_data: dict) -> None:
+        self._put(user_id, json.dumps(update_data, ensure_ascii=False))
+
+    def _put(self, user_id: int, line: str) -> None:
+        if self._resizing:
+            # Старые воркеры останавливаются, новые еще не запущены: апдейт дождется нового распределения
+            self._held.append((user_id, line))
+            return
+        index = worker_for(user_id, self.worker_count)
+        if len(self._pending[index]) >= WORKER_BACKLOG_LIMIT:
+            logger.error(f"Очередь воркера {index} переполнена, апдейт пользователя {user_id} отброшен.")
+            return
+        self._pending[index].append((user_id, line))
+        self._ready[index].set()
+
+    async def _run_worker(self, index: int) -> None:
+        delay = 1.0
+        while not self._stopping:
+            env = {**os.environ, "WORKER_INDEX": str(index), "WORKER_COUNT": str(self.worker_count), **self._extra_env(index)}
+            process = await asyncio.create_subprocess_exec(
+                sys.executable, self._script_path, stdin=asyncio.subprocess.PIPE, env=env,
+            )
+            self._processes[index] = process
+            logger.info(f"Воркер {index} запущен (pid {process.pid}).")
+            started = asyncio.get_running_loop().time()
+            writer = self._feeders[index] = asyncio.create_task(self._feed(index, process))
+            code = await process.wait()
+            writer.cancel()
+            self._feeders.pop(index, None)
+            self._processes.pop(index, None)
+            if self._stopping:
+                break
+            # Воркер, проработавший больше минуты, считается здоровым: пауза перед перезапуском сбрасывается
+            if asyncio.get_running_loop().time() - started > 60:
+                delay = 1.0
+            self.restarts += 1
+            logger.error(f"Воркер {index} завершился с кодом {code}, перезапуск через {delay:.0f} сек.")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30.0)
+
+    async def _feed(self, index: int, process: asyncio.subprocess.Process) -> None:
+        pending, ready = self._pending[index], self._ready[index]
+        while True:
+            if not pending:
+                ready.clear()
+                await ready.wait()
+                continue
+            _, line = pending[0]
+            try:
+                process.stdin.write(line.encode() + b"\n")
+                await process.stdin.drain()
+            except (BrokenPipeError, ConnectionResetError):
+                # Воркер упал: апдейт остается первым в очереди и уйдет перезапущенному процессу
+                return
+            # Снимаем апдейт только после записи: отмена задачи в любой момент его не теряет
+            pending.popleft()
+
+    async def stop(self, timeout: float | None = None) -> None:
+        """Закрывает stdin воркеров и ждет их штатной остановки; зависшие процессы завершаются принудительно."""
+        timeout = self._stop_timeout if timeout is None else timeout
+        self._stopping = True
+        # Сначала перестаем писать в stdin: запись в закрытый pipe молча теряет данные
+        feeders = list(self._feeders.values())
+        for feeder in feeders:
+            feeder.cancel()
+        await asyncio.gather(*feeders, return_exceptions=True)
+        processes = list(self._processes.values())
+        for process in processes:
+            if process.stdin and not process.stdin.is_closing():
+                process.stdin.close()
+        try:
+            await asyncio.wait_for(asyncio.gather(*(p.wait() for p in processes)), timeout)
+        except asyncio.TimeoutError:
+            for process in processes:
+                if process.returncode is None:
+                    logger.warning(f"Воркер pid {process.pid} не остановился за {timeout:.0f} сек., завершаю принудительно.")
+                    process.kill()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+        self._processes.clear()
+
+    async def resize(self, worker_count: int) -> None:
+        """
+        Меняет количество воркеров. Все воркеры штатно останавливаются (сохраняя сессии) и запускаются заново,
+        чтобы ни одна сессия не оказалась открыта в двух процессах одновременно.
+        """
+        if worker_count == self.worker_count:
+            return
+        logger.info(f"Супервизор: перераспределение пользователей с {self.worker_count} на {worker_count} воркеров.")
+        self._resizing = True
+        try:
+            await self.stop()
+        finally:
+            # Сначала недоставленные старым воркерам апдейты, затем пришедшие во время остановки
+            backlog = [item for pending in self._pending for item in pending] + self._held
+            self._held = []
+            self._resizing = False
+            self.worker_count = worker_count
+            self.start()
+            for user_id, line in backlog:
+                self._put(user_id, line)
+
+
+async def read_worker_updates(on_update) -> None:
+    """В процессе воркера: читает апдейты из stdin до EOF и передает каждый в on_update(dict)."""
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader(limit=2 ** 24)
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    while line := await reader.readline():
+        try:
+            await on_update(json.loads(line))
+        except Exception as e:
+            logger.error(f"Не удалось обработать апдейт от супервизора: {e}")
+
+# --- END OF FILE supervisor.py ---
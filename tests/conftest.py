@@ -0,0 +1,8 @@
+# --- START OF FILE tests/conftest.py ---
+import os
+import sys
+
+# Модули бота лежат в корне репозитория
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# --- END OF FILE tests/conftest.py ---
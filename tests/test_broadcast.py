@@ -0,0 +1,81 @@
+# --- START OF FILE tests/test_broadcast.py ---
+import io
+
+import pytest
+
+from broadcast import BroadcastStore, BroadcastValidationError, RUNNING, iter_recipients
+
+
+def recipients(text: str, template: str = "Привет, {name}!", max_rows: int = 100, check_chat=None):
+    errors: list[str] = []
+    rows = list(iter_recipients(io.StringIO(text), template, errors, max_rows, check_chat))
+    return rows, errors
+
+
+def test_template_filled_from_columns():
+    rows, errors = recipients("chat,name\nИван Петров,Иван\n+79991234567,Мария\n")
+    assert errors == []
+    assert rows == [(2, "Иван Петров", "Привет, Иван!"), (3, "+79991234567", "Привет, Мария!")]
+
+
+def test_semicolon_and_quoted_values():
+    rows, errors = recipients('Чат;name\n"Отдел; продажи";Коллеги\n')
+    assert errors == []
+    assert rows == [(2, "Отдел; продажи", "Привет, Коллеги!")]
+
+
+def test_blank_lines_skipped():
+    rows, errors = recipients("chat,name\n\nА,Б\n,\n")
+    assert errors == []
+    assert [row[1] for row in rows] == ["А"]
+
+
+def test_missing_chat_column():
+    rows, errors = recipients("name\nИван\n")
+    assert rows == [] and "chat" in errors[0]
+
+
+def test_missing_template_column():
+    rows, errors = recipients("chat\nИван\n")
+    assert rows == [] and "name" in errors[0]
+
+
+def test_row_errors_collected():
+    rows, errors = recipients("chat,name\n,Иван\nМария\nОльга,Оля\n", check_chat=lambda chat: "нет" if chat == "Ольга" else None)
+    assert rows == []
+    assert errors == [
+        "Строка 2: не указан получатель.",
+        "Строка 3: 1 значений вместо 2.",
+        "Строка 4: нет",
+    ]
+
+
+def test_row_limit():
+    rows, errors = recipients("chat,name\nА,1\nБ,2\nВ,3\n", max_rows=2)
+    assert errors == ["Слишком много получателей: не больше 2."]
+
+
+def test_empty_file():
+    assert recipients("") == ([], ["Файл пуст."])
+
+
+def test_create_and_rollback(tmp_path):
+    store = BroadcastStore(str(tmp_path / "broadcasts.sqlite3"))
+    errors: list[str] = []
+    text = "chat,name\n" + "".join(f"Чат {i},Имя {i}\n" for i in range(1200))
+    broadcast_id = store.create(1, 1, "Привет, {name}!", "list.csv",
+                                iter_recipients(io.StringIO(text), "Привет, {name}!", errors, 5000), errors)
+    broadcast = store.get(broadcast_id)
+    assert (broadcast.status, broadcast.total) == (RUNNING, 1200)
+    assert store.next_row(broadcast_id).message == "Привет, Имя 0!"
+
+    errors = []
+    with pytest.raises(BroadcastValidationError):
+        store.create(1, 1, "Привет, {name}!", "bad.csv",
+                     iter_recipients(io.StringIO("chat,name\nА,1\n,2\n"), "Привет, {name}!", errors, 5000), errors)
+    # От неудачной рассылки не остается ни записи, ни строк
+    assert store.get(broadcast_id + 1) is None
+    assert store.recover() == [broadcast]
+    store.close()
+
+# --- END OF FILE tests/test_broadcast.py ---
@@ -0,0 +1,54 @@
+# --- START OF FILE tests/test_metrics.py ---
+import pytest
+
+from metrics import Histogram, Registry
+
+
+def histogram(*values, **labels) -> Histogram:
+    h = Histogram("t", "test", buckets=(1, 2, 4))
+    for value in values:
+        h.observe(value, **labels)
+    return h
+
+
+def test_empty():
+    assert histogram().quantile(0.5) is None
+    assert histogram(1, phase="a").quantile(0.5, phase="b") is None
+
+
+def test_interpolation_inside_bucket():
+    h = histogram(0.5, 0.5, 3, 3)
+    assert h.quantile(0.5) == pytest.approx(1.0)
+    assert h.quantile(0.75) == pytest.approx(3.0)
+    assert h.quantile(1.0) == pytest.approx(4.0)
+
+
+def test_empty_buckets_skipped():
+    # Между 1 и 2 наблюдений нет: квантиль не должен попасть в пустую корзину
+    h = histogram(0.5, 3)
+    assert h.quantile(0.5) == pytest.approx(1.0)
+    assert 2 < h.quantile(0.9) <= 4
+
+
+def test_overflow_clamped_to_last_bound():
+    assert histogram(10, 20).quantile(0.99) == 4
+
+
+def test_labels_are_separate_series():
+    h = Histogram("t", "test", buckets=(1, 2, 4))
+    h.observe(0.5, phase="fast")
+    h.observe(3, phase="slow")
+    assert h.quantile(0.5, phase="fast") <= 1
+    assert h.quantile(0.5, phase="slow") > 2
+
+
+def test_callback_counter_and_gauge_types():
+    registry = Registry()
+    registry.counter_fn("t_total", "test", lambda: 3)
+    registry.gauge("t_current", "test", lambda: 1)
+    lines = registry.render().splitlines()
+    assert "# TYPE t_total counter" in lines
+    assert "t_total 3" in lines
+    assert "# TYPE t_current gauge" in lines
+
+# --- END OF FILE tests/test_metrics.py ---
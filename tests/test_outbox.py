@@ -0,0 +1,63 @@
+# --- START OF FILE tests/test_outbox.py ---
+import time
+
+import pytest
+
+from outbox import DELIVERED, FAILED, QUEUED, SENDING, Outbox
+
+
+@pytest.fixture
+def outbox(tmp_path):
+    outbox = Outbox(str(tmp_path / "outbox.sqlite3"))
+    yield outbox
+    outbox.close()
+
+
+def test_same_command_recorded_once(outbox):
+    entry, created = outbox.add(1, 100, 5, "Чат", message_text="Привет")
+    again, created_again = outbox.add(1, 100, 5, "Чат", message_text="Привет")
+    assert created and not created_again
+    assert again == entry
+    other, created_other = outbox.add(1, 100, 6, "Чат", message_text="Привет")
+    assert created_other and other.id == entry.id + 1  # без пропусков в нумерации
+
+
+def test_attempts_and_status(outbox):
+    entry, _ = outbox.add(1, 100, 5, "Чат", file_id="f", file_name="a.pdf")
+    assert outbox.start_attempt(entry.id) == 1
+    assert outbox.start_attempt(entry.id) == 2
+    outbox.set_status(entry.id, DELIVERED)
+    entry = outbox.get(entry.id)
+    assert (entry.status, entry.attempts, entry.error) == (DELIVERED, 2, None)
+    assert [e.id for e in outbox.recent(1)] == [entry.id]
+    assert outbox.recent(2) == []
+
+
+def test_recover_requeues_and_fails_interrupted(outbox):
+    queued, _ = outbox.add(1, 100, 1, "Чат", message_text="a")
+    sending, _ = outbox.add(1, 100, 2, "Чат", message_text="b")
+    outbox.set_status(sending.id, SENDING)
+    done, _ = outbox.add(1, 100, 3, "Чат", message_text="c")
+    outbox.set_status(done.id, DELIVERED)
+    foreign, _ = outbox.add(2, 200, 1, "Чат", message_text="d")
+
+    pending, interrupted = outbox.recover(owns=lambda user_id: user_id == 1)
+    assert [e.id for e in pending] == [queued.id]
+    assert [e.id for e in interrupted] == [sending.id]
+    # Отправка, прерванная после нажатия "Отправить", не повторяется
+    assert outbox.get(sending.id).status == FAILED
+    assert outbox.get(done.id).status == DELIVERED
+    assert outbox.get(foreign.id).status == QUEUED
+    assert outbox.recover(owns=lambda user_id: user_id == 1) == ([outbox.get(queued.id)], [])
+
+
+def test_recover_removes_old_finished(outbox, monkeypatch):
+    old, _ = outbox.add(1, 100, 1, "Чат", message_text="a")
+    outbox.set_status(old.id, DELIVERED)
+    stale, _ = outbox.add(1, 100, 2, "Чат", message_text="b")
+    monkeypatch.setattr(time, "time", lambda: 10 ** 10)
+    outbox.recover(keep_days=30)
+    assert outbox.get(old.id) is None
+    assert outbox.get(stale.id) is not None  # ожидающие отправки не удаляются
+
+# --- END OF FILE tests/test_outbox.py ---
@@ -0,0 +1,86 @@
+# --- START OF FILE tests/test_pacing.py ---
+import asyncio
+
+import pytest
+
+import pacing
+from pacing import Pacer
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+    async def sleep(self, seconds: float) -> None:
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(pacing.time, "monotonic", clock.monotonic)
+    monkeypatch.setattr(pacing.asyncio, "sleep", clock.sleep)
+    return clock
+
+
+def test_burst_then_rate(clock):
+    pacer = Pacer(burst=3, per_minute=6, jitter=0)
+    waits = [asyncio.run(pacer.acquire(1)) for _ in range(5)]
+    assert waits[:3] == [0, 0, 0]
+    assert waits[3] == pytest.approx(10) and waits[4] == pytest.approx(10)
+    assert pacer.waited_seconds == pytest.approx(20)
+
+
+def test_accounts_are_independent(clock):
+    pacer = Pacer(burst=1, per_minute=6, jitter=0)
+    asyncio.run(pacer.acquire(1))
+    assert pacer.delay(1) == pytest.approx(10)
+    assert pacer.delay(2) == 0
+
+
+def test_tokens_refill_over_time(clock):
+    pacer = Pacer(burst=2, per_minute=6, jitter=0)
+    asyncio.run(pacer.acquire(1))
+    asyncio.run(pacer.acquire(1))
+    clock.now += 15  # полтора токена
+    assert pacer.delay(1) == 0
+    asyncio.run(pacer.acquire(1))
+    assert pacer.delay(1) == pytest.approx(5)
+    clock.now += 600  # запас не копится больше burst
+    asyncio.run(pacer.acquire(1))
+    asyncio.run(pacer.acquire(1))
+    assert pacer.delay(1) == pytest.approx(10)
+
+
+def test_signal_slows_down_and_recovers(clock):
+    pacer = Pacer(burst=3, per_minute=6, jitter=0, max_slowdown=4, recovery=0.5)
+    pacer.report(1, "slow_sent")
+    assert pacer.delay(1) == pytest.approx(20)
+    pacer.report(1, "slow_sent")
+    pacer.report(1, "slow_sent")
+    assert pacer.delay(1) == pytest.approx(40)  # не больше max_slowdown
+    assert pacer.signals == {"slow_sent": 3}
+    assert pacer.slowed_down() == 1
+    pacer.report(1, None)
+    pacer.report(1, None)
+    assert pacer.slowed_down() == 0
+
+
+def test_jitter_only_stretches_wait(clock, monkeypatch):
+    monkeypatch.setattr(pacing.random, "uniform", lambda low, high: high)
+    pacer = Pacer(burst=1, per_minute=6, jitter=0.3)
+    asyncio.run(pacer.acquire(1))
+    assert asyncio.run(pacer.acquire(1)) == pytest.approx(13)
+
+
+def test_disabled(clock):
+    pacer = Pacer(per_minute=0)
+    assert not pacer.enabled
+    assert [asyncio.run(pacer.acquire(1)) for _ in range(10)] == [0.0] * 10
+    pacer.report(1, "throttle_banner")
+    assert pacer.signals == {}
+
+# --- END OF FILE tests/test_pacing.py ---
@@ -0,0 +1,72 @@
+# --- START OF FILE tests/test_scheduler.py ---
+import asyncio
+import datetime
+import time
+
+import pytest
+
+from scheduler import Scheduler, parse_when
+
+NOW = datetime.datetime(2026, 10, 17, 12, 0)
+
+
+def when(text: str) -> datetime.datetime:
+    return datetime.datetime.fromtimestamp(parse_when(text, now=NOW))
+
+
+def test_relative():
+    assert when("+30m") == NOW + datetime.timedelta(minutes=30)
+    assert when("+2ч") == NOW + datetime.timedelta(hours=2)
+    assert when("1d") == NOW + datetime.timedelta(days=1)
+
+
+def test_time_today_or_tomorrow():
+    assert when("18:30") == datetime.datetime(2026, 10, 17, 18, 30)
+    assert when("09:00") == datetime.datetime(2026, 10, 18, 9, 0)
+
+
+def test_full_dates():
+    assert when("25.12.2026 09:00") == datetime.datetime(2026, 12, 25, 9, 0)
+    assert when("2026-12-25 09:00") == datetime.datetime(2026, 12, 25, 9, 0)
+
+
+def test_date_without_year_rolls_over():
+    assert when("25.12 09:00") == datetime.datetime(2026, 12, 25, 9, 0)
+    assert when("17.10 11:00") == datetime.datetime(2027, 10, 17, 11, 0)
+
+
+def test_february_29_uses_next_leap_year():
+    assert when("29.02 10:00") == datetime.datetime(2028, 2, 29, 10, 0)
+
+
+@pytest.mark.parametrize("text", ["31.02 10:00", "завтра", "25:00", ""])
+def test_invalid(text):
+    with pytest.raises(ValueError):
+        parse_when(text, now=NOW)
+
+
+def test_cancel_during_fire_is_kept(tmp_path):
+    async def scenario():
+        scheduler = None
+
+        async def fire(job):
+            # Пользователь отменяет задание, пока оно передается на отправку
+            assert scheduler.cancel(job.user_id, job.id)
+
+        scheduler = Scheduler(str(tmp_path / "jobs.db"), fire, spread_seconds=0)
+        await scheduler.start()
+        job_id = scheduler.add(1, 1, "chat", time.time(), message_text="hi")
+        for _ in range(100):
+            await asyncio.sleep(0.01)
+            status = scheduler._db.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()[0]
+            if status != "pending":
+                break
+        pending = scheduler.pending_count()
+        await scheduler.stop()
+        return status, pending
+
+    status, pending = asyncio.run(scenario())
+    assert status == "cancelled"
+    assert pending == 0
+
+# --- END OF FILE tests/test_scheduler.py ---
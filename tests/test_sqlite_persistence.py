@@ -0,0 +1,65 @@
+# --- START OF FILE tests/test_sqlite_persistence.py ---
+import asyncio
+import sqlite3
+
+from sqlite_persistence import SqlitePersistence
+
+
+def stored(path) -> dict:
+    with sqlite3.connect(path) as db:
+        return {(user_id, key): value for user_id, key, value in db.execute("SELECT user_id, key, value FROM user_data")}
+
+
+def test_round_trip_and_changed_keys_only(tmp_path):
+    path = str(tmp_path / "bot_data.sqlite3")
+
+    async def first_run():
+        persistence = SqlitePersistence(path)
+        assert await persistence.get_user_data() == {}
+        await persistence.update_user_data(1, {"count": 1, "lang": "ru", "page": object()})
+        await persistence.update_user_data(2, {"count": 7})
+        await persistence.flush()
+
+    async def second_run():
+        persistence = SqlitePersistence(path)
+        assert await persistence.get_user_data() == {1: {"count": 1, "lang": "ru"}, 2: {"count": 7}}
+        # Неизменившиеся значения не пишутся повторно
+        await persistence.update_user_data(1, {"count": 1, "lang": "ru"})
+        assert persistence._dirty == {}
+        await persistence.update_user_data(1, {"count": 2})  # lang удален
+        await persistence.drop_user_data(2)
+        await persistence.flush()
+
+    asyncio.run(first_run())
+    asyncio.run(second_run())
+    assert stored(path) == {(1, "count"): "2"}
+
+
+def test_owned_users_only(tmp_path):
+    path = str(tmp_path / "bot_data.sqlite3")
+
+    async def run():
+        persistence = SqlitePersistence(path)
+        await persistence.get_user_data()
+        await persistence.update_user_data(1, {"a": 1})
+        await persistence.update_user_data(2, {"a": 2})
+        await persistence.flush()
+        worker = SqlitePersistence(path, owns=lambda user_id: user_id == 2)
+        return await worker.get_user_data()
+
+    assert asyncio.run(run()) == {2: {"a": 2}}
+
+
+def test_non_persistent_keys_skipped(tmp_path):
+    path = str(tmp_path / "bot_data.sqlite3")
+
+    async def run():
+        persistence = SqlitePersistence(path)
+        await persistence.get_user_data()
+        await persistence.update_user_data(1, {"browser": "x", "qr_notified": True})
+        await persistence.flush()
+
+    asyncio.run(run())
+    assert stored(path) == {(1, "qr_notified"): "true"}
+
+# --- END OF FILE tests/test_sqlite_persistence.py ---
@@ -0,0 +1,43 @@
+# --- START OF FILE tests/test_status_reporter.py ---
+import asyncio
+import time
+
+from status_reporter import StatusReporter
+
+
+class FakeMessage:
+    def __init__(self, chat_id: int, message_id: int, calls: list):
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.text = "🔄 В очереди..."
+        self._calls = calls
+
+    async def edit_text(self, text: str, **kwargs) -> None:
+        self._calls.append((self.chat_id, self.message_id, time.monotonic()))
+        self.text = text
+
+
+def test_edits_in_one_chat_spaced_by_chat_interval():
+    async def run():
+        reporter = StatusReporter(progress_delay=0, chat_interval=0.1, global_rate=1000)
+        calls: list = []
+        messages = [FakeMessage(1, n, calls) for n in range(5)] + [FakeMessage(2, 0, calls)]
+        for message in messages:
+            reporter.track(message)
+        # Все итоговые статусы созревают одновременно, как при остановке бота
+        await asyncio.sleep(0.1)
+        for message in messages:
+            reporter.update(message, "✅ Готово", final=True)
+        await reporter.stop(timeout=5)
+        return calls
+
+    calls = asyncio.run(run())
+    assert len(calls) == 6
+    same_chat = [at for chat_id, _, at in calls if chat_id == 1]
+    gaps = [later - earlier for earlier, later in zip(same_chat, same_chat[1:])]
+    assert all(gap >= 0.095 for gap in gaps), gaps
+    # Другой чат не ждет очереди первого
+    other = next(at for chat_id, _, at in calls if chat_id == 2)
+    assert other - same_chat[0] < 0.05
+
+# --- END OF FILE tests/test_status_reporter.py ---
@@ -0,0 +1,70 @@
+# --- START OF FILE tests/test_update_processor.py ---
+import asyncio
+import datetime
+
+from telegram import Chat, Message, Update, User
+
+from update_processor import PerUserUpdateProcessor
+
+
+def make_update(update_id: int, user_id: int) -> Update:
+    message = Message(
+        message_id=update_id,
+        date=datetime.datetime.now(datetime.timezone.utc),
+        chat=Chat(id=user_id, type=Chat.PRIVATE),
+        from_user=User(id=user_id, first_name="u", is_bot=False),
+        text=f"/send {update_id}",
+    )
+    return Update(update_id=update_id, message=message)
+
+
+async def handle(log: list, user_id: int, n: int, delay: float) -> None:
+    log.append(("start", user_id, n))
+    await asyncio.sleep(delay)
+    log.append(("end", user_id, n))
+
+
+def test_same_user_in_order_other_users_in_parallel():
+    async def run():
+        processor = PerUserUpdateProcessor(max_concurrent_updates=8)
+        log: list = []
+        # Первая команда пользователя 1 самая долгая: следующие все равно должны ждать ее
+        delays = [0.05, 0.01, 0.0, 0.02]
+        tasks = [
+            asyncio.create_task(processor.process_update(make_update(n, 1), handle(log, 1, n, delay)))
+            for n, delay in enumerate(delays)
+        ]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.create_task(processor.process_update(make_update(100, 2), handle(log, 2, 0, 0.0))))
+        await asyncio.gather(*tasks)
+        return processor, log
+
+    processor, log = asyncio.run(run())
+    user_1 = [(event, n) for event, user_id, n in log if user_id == 1]
+    assert user_1 == [(event, n) for n in range(4) for event in ("start", "end")]
+    # Пользователь 2 не ждал, пока закончится долгая команда пользователя 1
+    assert log.index(("end", 2, 0)) < log.index(("end", 1, 0))
+    assert processor._locks == {}
+
+
+def test_concurrency_limit_shared_by_users():
+    async def run():
+        processor = PerUserUpdateProcessor(max_concurrent_updates=2)
+        running, peak = 0, 0
+
+        async def work():
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+
+        await asyncio.gather(
+            *(processor.process_update(make_update(n, n), work()) for n in range(5)),
+            processor.process_update(object(), work()),  # апдейт без пользователя
+        )
+        return peak
+
+    assert asyncio.run(run()) == 2
+
+# --- END OF FILE tests/test_update_processor.py ---
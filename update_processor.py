@@ -0,0 +1,64 @@
+# --- START OF FILE update_processor.py ---
+import asyncio
+from typing import Any, Awaitable
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Параллельная обработка апдейтов с сохранением порядка для каждого пользователя.
+
+    Апдейты разных пользователей обрабатываются одновременно (не больше max_concurrent_updates),
+    а апдейты одного пользователя - строго по очереди, в порядке поступления: долгий /login
+    одного пользователя больше не задерживает остальных, а его собственные команды не перемешиваются.
+    """
+
+    __slots__ = ("_locks",)
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._locks: dict[int, tuple[asyncio.Lock, int]] = {}  # ключ -> (замок, сколько апдейтов его ждут)
+
+    @staticmethod
+    def _key(update: object) -> int | None:
+        if not isinstance(update, Update):
+            return None
+        if update.effective_user:
+            return update.effective_user.id
+        if update.effective_chat:
+            return update.effective_chat.id
+        return None
+
+    async def process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        key = self._key(update)
+        if key is None:
+            await super().process_update(update, coroutine)
+            return
+
+        lock, waiters = self._locks.get(key) or (asyncio.Lock(), 0)
+        self._locks[key] = (lock, waiters + 1)
+        try:
+            # Замок пользователя берется до общего семафора: очередь команд одного пользователя
+            # не занимает слоты параллельной обработки. asyncio.Lock отдается ожидающим по очереди,
+            # поэтому порядок апдейтов сохраняется
+            async with lock:
+                await super().process_update(update, coroutine)
+        finally:
+            lock, waiters = self._locks[key]
+            if waiters > 1:
+                self._locks[key] = (lock, waiters - 1)
+            else:
+                del self._locks[key]
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+# --- END OF FILE update_processor.py ---
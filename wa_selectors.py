@@ -0,0 +1,105 @@
+# --- START OF FILE wa_selectors.py ---
+import re
+from dataclasses import dataclass
+
+from playwright.async_api import Page
+
+# Языки интерфейса WhatsApp Web, для которых известны подписи элементов
+LANG_RU = "ru"
+LANG_EN = "en"
+
+
+@dataclass(frozen=True)
+class UiSelectors:
+    """Селекторы элементов WhatsApp Web для одного языка интерфейса."""
+    lang: str | None
+    search_box: str
+    message_box: str
+    attach_button: str
+    send_button: str
+    document_button: re.Pattern  # имя кнопки «Документ» в меню вложений
+    document_label: str          # span с подписью внутри этой кнопки
+    use_here_button: re.Pattern
+    phone_disconnected: re.Pattern
+    loading_error: re.Pattern
+    invalid_phone: re.Pattern  # номер из ссылки send?phone= не зарегистрирован в WhatsApp
+    throttle_banner: re.Pattern  # признаки ограничений или потери связи во время отправки
+
+
+_LABELS = {
+    LANG_RU: {
+        "search": "Поиск или новый чат",
+        "message": "Введите сообщение",
+        "attach": "Прикрепить",
+        "send": "Отправить",
+        "document": "Документ",
+        "use_here": "Использовать здесь",
+        "phone_disconnected": "Телефон не подключ",
+        "loading_error": "Компьютер не подключ|Не удалось (загрузить|подключиться)",
+        "invalid_phone": "Номер телефона.{0,40}недействител",
+        "throttle_banner": "Ожидание этого сообщения|Телефон не подключ|Компьютер не подключ|Повторное подключение|Подключение к WhatsApp",
+    },
+    LANG_EN: {
+        "search": "Search or start a new chat",
+        "message": "Type a message",
+        "attach": "Attach",
+        "send": "Send",
+        "document": "Document",
+        "use_here": "Use here",
+        "phone_disconnected": "Phone not connected",
+        "loading_error": "Computer not connected|Couldn.t (load|connect)",
+        "invalid_phone": "Phone number shared via url is invalid",
+        "throttle_banner": "Waiting for this message|Phone not connected|Computer not connected|Trying to reach phone|Connecting to WhatsApp",
+    },
+}
+
+
+def _build(lang: str | None, langs: list[str]) -> UiSelectors:
+    labels = [_LABELS[code] for code in langs]
+
+    def attr(selector: str, key: str) -> str:
+        return ", ".join(f'{selector}="{label[key]}"]' for label in labels)
+
+    def names(key: str) -> str:
+        return "|".join(label[key] for label in labels)
+
+    return UiSelectors(
+        lang=lang,
+        search_box=attr("div[aria-placeholder", "search"),
+        message_box=attr("div[aria-placeholder", "message"),
+        attach_button=attr("[aria-label", "attach"),
+        send_button=attr("[aria-label", "send"),
+        document_button=re.compile(f"^({names('document')})$"),
+        document_label=", ".join(f'span:has-text("{label["document"]}")' for label in labels),
+        use_here_button=re.compile(f"^({names('use_here')})$", re.IGNORECASE),
+        phone_disconnected=re.compile(names("phone_disconnected"), re.IGNORECASE),
+        loading_error=re.compile(names("loading_error"), re.IGNORECASE),
+        invalid_phone=re.compile(names("invalid_phone"), re.IGNORECASE),
+        throttle_banner=re.compile(names("throttle_banner"), re.IGNORECASE),
+    )
+
+
+REGISTRY: dict[str, UiSelectors] = {lang: _build(lang, [lang]) for lang in _LABELS}
+# Пока язык не определен (вход, первая загрузка), используются подписи всех известных языков сразу
+ANY_LANGUAGE = _build(None, list(_LABELS))
+
+
+def selectors_for(lang: str | None) -> UiSelectors:
+    return REGISTRY.get(lang, ANY_LANGUAGE)
+
+
+# Язык определяется по тому, подпись какого языка у поля поиска; запасной вариант - атрибут lang документа
+_DETECT_JS = """(placeholders) => {
+    for (const [lang, placeholder] of Object.entries(placeholders)) {
+        if (document.querySelector(`div[aria-placeholder="${placeholder}"]`)) return lang;
+    }
+    return (document.documentElement.lang || '').slice(0, 2).toLowerCase() || null;
+}"""
+
+
+async def detect_ui_language(page: Page) -> str | None:
+    """Определяет язык интерфейса загруженного WhatsApp Web. Возвращает None, если язык неизвестен."""
+    lang = await page.evaluate(_DETECT_JS, {code: labels["search"] for code, labels in _LABELS.items()})
+    return lang if lang in REGISTRY else None
+
+# --- END OF FILE wa_selectors.py ---